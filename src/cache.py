@@ -0,0 +1,82 @@
+import os
+import json
+import hashlib
+import numpy as np
+from pathlib import Path
+
+# Version of the cached maps, to be bumped whenever the code making them
+# changes its output for the same parameters, so old maps are not reused
+FORMAT = 2
+
+
+class SampleCache:
+    """
+    Content-addressed on-disk cache of derived per-sample maps.
+    Maps are stored as .npy files named by a hash of the source file
+    (path, mtime, size), dataset tag, processing parameters, SHT backend
+    and cache FORMAT, and the least recently used ones are evicted when maxsize (GB) is exceeded.
+    """
+    def __init__(self, path=None, maxsize=20.0):
+        if path == None:
+            path = os.environ.get("C3PP_CACHE", "~/.cache/c3pp")
+        self.path = Path(path).expanduser()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.maxsize = maxsize * 1024**3
+        self.size = None
+
+    def key(self, filename, tag, **params):
+        """
+        Key identifying tag in filename as it is now, processed with params.
+        """
+        from src.sht import backend
+
+        stat = os.stat(filename)
+        params.update(file=os.path.abspath(filename), mtime=stat.st_mtime_ns, size=stat.st_size, tag=tag, sht=backend(), format=FORMAT)
+        return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, key):
+        file = self.path / f"{key}.npy"
+        try:
+            data = np.load(file)
+        except (OSError, ValueError):
+            return None
+        # Mark as recently used
+        os.utime(file)
+        return data
+
+    def put(self, key, data):
+        file = self.path / f"{key}.npy"
+        # Write under a temporary name so readers never see partial files
+        tmp = self.path / f"{key}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, data)
+        os.replace(tmp, file)
+
+        if self.size == None:
+            self.size = sum(p.stat().st_size for p in self.path.glob("*.npy"))
+        else:
+            self.size += file.stat().st_size
+        if self.size > self.maxsize:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used maps until the cache fits in maxsize.
+        """
+        files = []
+        for file in self.path.glob("*.npy"):
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue # Evicted by another process
+            files.append((stat.st_mtime, stat.st_size, file))
+        files.sort()
+        self.size = sum(size for mtime, size, file in files)
+        for mtime, size, file in files:
+            if self.size <= self.maxsize:
+                break
+            try:
+                file.unlink()
+            except FileNotFoundError:
+                pass
+            self.size -= size
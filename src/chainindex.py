@@ -0,0 +1,144 @@
+import os
+import sys
+import json
+
+
+class ChainIndex:
+    """
+    Catalog of a commander hdf chain file, built in a single scan.
+    Records the sample ids and, per dataset, its shape, dtype, chunk layout,
+    size and the number of samples containing it, plus the value of scalar
+    datasets such as */amp_lmax. The catalog is cached as json next to the
+    chain (filename.index.json) and rebuilt when the file's mtime or size
+    changes.
+    """
+    def __init__(self, filename, rebuild=False):
+        self.filename = filename
+        self.path = f"{filename}.index.json"
+        self.resolved = {}
+
+        stat = os.stat(filename)
+        self.stamp = {"mtime": stat.st_mtime_ns, "size": stat.st_size}
+        catalog = None if rebuild else self.load()
+        if catalog == None:
+            catalog = self.scan()
+            self.save(catalog)
+        self.samples = catalog["samples"]
+        self.datasets = catalog["datasets"]
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if catalog.get("stamp") != self.stamp:
+            return None
+        return catalog
+
+    def save(self, catalog):
+        # Read-only chain directories just go without a cached index
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(catalog, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+    def scan(self):
+        """
+        Visits every dataset of every {sample}/ group once.
+        """
+        import h5py
+        import numpy as np
+
+        datasets = {}
+        with h5py.File(self.filename, "r") as f:
+            samples = sorted(int(key) for key in f.keys() if key.isdigit())
+            for sample in samples:
+                def visit(name, obj):
+                    if not isinstance(obj, h5py.Dataset):
+                        return
+                    shape = list(obj.shape)
+                    value = None
+                    if shape == [] and obj.dtype.kind in "iuf":
+                        value = obj[()].item()
+                    info = datasets.get(name)
+                    if info == None:
+                        datasets[name] = {
+                            "shape": shape,
+                            "dtype": obj.dtype.str,
+                            "chunks": list(obj.chunks) if obj.chunks else None,
+                            "nbytes": int(np.prod(shape, dtype=np.int64)) * obj.dtype.itemsize,
+                            "storage": obj.id.get_storage_size(),
+                            "value": value,
+                            "count": 1,
+                            "first": sample,
+                        }
+                        return
+                    info["count"] += 1
+                    info["storage"] += obj.id.get_storage_size()
+                    # Only report shape and value if the same in all samples
+                    if info["shape"] != shape:
+                        info["shape"] = None
+                    if info["value"] != value:
+                        info["value"] = None
+                f[str(sample).zfill(6)].visititems(visit)
+        return {"stamp": self.stamp, "samples": samples, "datasets": datasets}
+
+    @property
+    def last(self):
+        """
+        Last sample in chain. Exits if the chain has no samples.
+        """
+        if not self.samples:
+            print(f"No samples in {self.filename}. Exiting")
+            sys.exit()
+        return self.samples[-1]
+
+    def shape(self, dataset):
+        return tuple(self.datasets[dataset]["shape"])
+
+    def value(self, dataset):
+        """
+        Value of scalar dataset if the same in all samples, else None.
+        """
+        info = self.datasets.get(dataset)
+        return None if info == None else info["value"]
+
+    def resolve(self, dataset):
+        """
+        Dataset to read in place of dataset: the map if alms are empty,
+        the alms if no map is stored.
+        """
+        if dataset in self.resolved:
+            return self.resolved[dataset]
+        info = self.datasets.get(dataset)
+        name = dataset
+        if info == None:
+            print(f"Found no dataset called {dataset}")
+            print(f"Trying alms instead {dataset[:-3]}alm")
+            name = f"{dataset[:-3]}alm"
+        elif info["shape"] and len(info["shape"]) > 1 and info["shape"][-1] == 0:
+            print(f"WARNING! {dataset} is empty, switching to map.")
+            name = f"{dataset[:-3]}map"
+        if name not in self.datasets:
+            print(f"Dataset {name} not found in {self.filename}. Exiting")
+            sys.exit()
+        self.resolved[dataset] = name
+        return name
+
+    def __str__(self):
+        lines = [
+            "{:-^80}".format(f" {self.filename} "),
+            f"{len(self.samples)} samples, {self.samples[0] if self.samples else '-'} to {self.samples[-1] if self.samples else '-'}",
+            f"{'dataset':<32}{'shape':>16}{'dtype':>7}{'chunks':>12}{'samples':>8}{'MB':>9}",
+        ]
+        for name, info in sorted(self.datasets.items()):
+            shape = "varies" if info["shape"] == None else "x".join(str(n) for n in info["shape"]) or str(info["value"])
+            chunks = "x".join(str(n) for n in info["chunks"]) if info["chunks"] else "-"
+            lines.append(f"{name:<32}{shape:>16}{info['dtype']:>7}{chunks:>12}{info['count']:>8}{info['storage']/1024**2:>9.2f}")
+        total = sum(info["storage"] for info in self.datasets.values())
+        lines.append(f"Total {total/1024**2:.2f} MB")
+        return "\n".join(lines)
@@ -224,13 +224,15 @@ def crosspec(input1, input2, output, beam1, beam2, mask,):
 @click.option("-minchain", default=1, help="lowest chain number, c0002 [ex. 2] (default=1)",)
 @click.option("-maxchain", default=1, help="max number of chains c0005 [ex. 5] (default=1)",)
 @click.option("-chaindir", default=None, type=click.STRING, help="Base of chain directory, overwrites chain iteration from input file name to iteration over chain directories, BP_chain_c15 to BP_chain_c19 [ex. 'BP_chain', with minchain = 15 and maxchain = 19]",)
-@click.option("-fwhm", default=0.0, help="FWHM in arcmin")
+@click.option("-fwhm", multiple=True, default=[0.0], type=click.FLOAT, help="FWHM in arcmin, repeat for one output per FWHM (output_{fwhm}arcmin) from a single pass",)
 @click.option("-nside", default=None, type=click.INT, help="Nside for down-grading maps before calculation",)
 @click.option("-zerospin", is_flag=True, help="If smoothing, treat maps as zero-spin maps.",)
 @click.option("-missing", is_flag=True, help="If files are missing, drop them. Else, exit computation",)
 @click.option("-pixweight", default=None, type=click.STRING, help="Path to healpy pixel weights.",)
+@click.option("-nproc", default=1, type=click.INT, help="Number of processes to reduce chains/sample ranges on",)
+@click.option("-state", default=None, type=click.STRING, help="Sidecar file keeping accumulators, later runs only read new samples",)
 def fits_mean(
-        input, output, min, max, minchain, maxchain, chaindir, fwhm, nside, zerospin, missing, pixweight):
+        input, output, min, max, minchain, maxchain, chaindir, fwhm, nside, zerospin, missing, pixweight, nproc, state):
     """
     Calculates the mean over sample range from fits-files.
     ex. res_030_c0001_k000001.fits res_030_20-100_mean_40arcmin.fits -min 20 -max 100 -fwhm 40 -maxchain 3\n
@@ -239,7 +241,7 @@ def fits_mean(
     Note: the input file name must have the 'c0001' chain identifier and the 'k000001' sample identifier. The -min/-max and -chainmin/-chainmax options set the actual samples/chains to be used in the calculation 
     """
 
-    fits_handler(input, min, max, minchain, maxchain, chaindir, output, fwhm, nside, zerospin, missing, pixweight, np.mean, write=True)
+    fits_handler(input, min, max, minchain, maxchain, chaindir, output, list(fwhm), nside, zerospin, missing, pixweight, np.mean, write=True, nproc=nproc, state=state)
 
 @commands_fits.command()
 @click.argument("input", type=click.STRING)
@@ -249,13 +251,15 @@ def fits_mean(
 @click.option("-minchain", default=1, help="lowest chain number, c0002 [ex. 2] (default=1)",)
 @click.option("-maxchain", default=1, help="max number of chains c0005 [ex. 5] (default=1)",)
 @click.option("-chaindir", default=None,type=click.STRING, help="Base of chain directory, overwrites chain iteration from input file name to iteration over chain directories, BP_chain_c15 to BP_chain_c19 [ex. 'BP_chain', with minchain = 15 and maxchain = 19]",)
-@click.option("-fwhm", default=0.0, help="FWHM in arcmin")
+@click.option("-fwhm", multiple=True, default=[0.0], type=click.FLOAT, help="FWHM in arcmin, repeat for one output per FWHM (output_{fwhm}arcmin) from a single pass",)
 @click.option("-nside", default=None, type=click.INT, help="Nside for down-grading maps before calculation",)
 @click.option("-zerospin", is_flag=True, help="If smoothing, treat maps as zero-spin maps.",)
 @click.option("-missing", is_flag=True, help="If files are missing, drop them. Else, exit computation",)
 @click.option("-pixweight", default=None, type=click.STRING, help="Path to healpy pixel weights.",)
+@click.option("-nproc", default=1, type=click.INT, help="Number of processes to reduce chains/sample ranges on",)
+@click.option("-state", default=None, type=click.STRING, help="Sidecar file keeping accumulators, later runs only read new samples",)
 def fits_stddev(
-        input, output, min, max, minchain, maxchain, chaindir, fwhm, nside, zerospin, missing, pixweight):
+        input, output, min, max, minchain, maxchain, chaindir, fwhm, nside, zerospin, missing, pixweight, nproc, state):
     """
     Calculates the standard deviation over sample range from fits-files.
     ex. res_030_c0001_k000001.fits res_030_20-100_mean_40arcmin.fits -min 20 -max 100 -fwhm 40 -maxchain 3
@@ -264,4 +268,32 @@ def fits_stddev(
     Note: the input file name must have the 'c0001' chain identifier and the 'k000001' sample identifier. The -min/-max and -chainmin/-chainmax options set the actual samples/chains to be used in the calculation 
     """
 
-    fits_handler(input, min, max, minchain, maxchain, chaindir, output, fwhm, nside, zerospin, missing, pixweight, np.std, write=True)
+    fits_handler(input, min, max, minchain, maxchain, chaindir, output, list(fwhm), nside, zerospin, missing, pixweight, np.std, write=True, nproc=nproc, state=state)
+
+@commands_fits.command()
+@click.argument("input", type=click.STRING)
+@click.argument("output", type=click.STRING)
+@click.option("-min", default=1, type=click.INT, help="Start sample, default 1",)
+@click.option("-max", default=None, type=click.INT, help="End sample, calculated automatically if not set",)
+@click.option("-minchain", default=1, help="lowest chain number, c0002 [ex. 2] (default=1)",)
+@click.option("-maxchain", default=1, help="max number of chains c0005 [ex. 5] (default=1)",)
+@click.option("-chaindir", default=None,type=click.STRING, help="Base of chain directory, overwrites chain iteration from input file name to iteration over chain directories, BP_chain_c15 to BP_chain_c19 [ex. 'BP_chain', with minchain = 15 and maxchain = 19]",)
+@click.option("-fwhm", multiple=True, default=[0.0], type=click.FLOAT, help="FWHM in arcmin, repeat for one output per FWHM (output_{fwhm}arcmin) from a single pass",)
+@click.option("-nside", default=None, type=click.INT, help="Nside for down-grading maps before calculation",)
+@click.option("-zerospin", is_flag=True, help="If smoothing, treat maps as zero-spin maps.",)
+@click.option("-missing", is_flag=True, help="If files are missing, drop them. Else, exit computation",)
+@click.option("-pixweight", default=None, type=click.STRING, help="Path to healpy pixel weights.",)
+@click.option("-q", multiple=True, default=[16., 50., 84.], type=click.FLOAT, help="Percentiles to calculate, default 16 50 84",)
+@click.option("-nproc", default=1, type=click.INT, help="Number of processes to reduce chains/sample ranges on",)
+@click.option("-state", default=None, type=click.STRING, help="Sidecar file keeping accumulators, later runs only read new samples",)
+def fits_percentile(
+        input, output, min, max, minchain, maxchain, chaindir, fwhm, nside, zerospin, missing, pixweight, q, nproc, state):
+    """
+    Estimates percentiles over sample range from fits-files, per pixel while streaming.
+    ex. res_030_c0001_k000001.fits res_030_20-100_percentiles.fits -min 20 -max 100 -q 2.5 -q 16 -q 50 -q 84 -q 97.5
+    Output has columns I_Q16, Q_Q16, U_Q16, I_Q50, ...
+
+    Note: the input file name must have the 'c0001' chain identifier and the 'k000001' sample identifier. The -min/-max and -chainmin/-chainmax options set the actual samples/chains to be used in the calculation 
+    """
+
+    fits_handler(input, min, max, minchain, maxchain, chaindir, output, list(fwhm), nside, zerospin, missing, pixweight, np.percentile, write=True, nproc=nproc, state=state, q=q)
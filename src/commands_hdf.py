@@ -17,11 +17,19 @@ def commands_hdf():
 @click.option("-min", default=1, type=click.INT, help="Start sample, default 1",)
 @click.option("-max", default=None, type=click.INT, help="End sample, calculated automatically if not set",)
 @click.option("-maxchain", default=1, help="max number of chains c0005 [ex. 5]",)
-@click.option("-fwhm", default=0.0, help="FWHM in arcmin")
+@click.option("-fwhm", multiple=True, default=[0.0], type=click.FLOAT, help="FWHM in arcmin, repeat for one output per FWHM (output_{fwhm}arcmin) from a single pass",)
 @click.option("-nside", default=None, type=click.INT, help="Nside for alm binning",)
 @click.option("-zerospin", is_flag=True, help="If smoothing, treat maps as zero-spin maps.",)
 @click.option("-pixweight", default=None, type=click.STRING, help="Path to healpy pixel weights.",)
-def mean(input, dataset, output, min, max, maxchain, fwhm, nside, zerospin, pixweight):
+@click.option("-nproc", default=1, type=click.INT, help="Number of processes to reduce chains/sample ranges on",)
+@click.option("-memory", default=None, type=click.FLOAT, help="Memory budget in GB, reduces map datasets in pixel tiles",)
+@click.option("-cache", default=None, type=click.STRING, help="Directory caching smoothed samples between runs [default $C3PP_CACHE]",)
+@click.option("-state", default=None, type=click.STRING, help="Sidecar file keeping accumulators, later runs only read new samples",)
+@click.option("-prefetch", default=2, type=click.INT, help="Samples read ahead while others are transformed, 0 to disable",)
+@click.option("-shard", default=None, type=click.STRING, help="i/N, reduce only the i-th of N slices of the samples, see merge-moments",)
+@click.option("-nthreads", default=0, type=click.INT, help="Threads per spherical harmonic transform (with ducc0), default all cores",)
+@click.option("-bandlimit", default=None, type=click.FLOAT, help="Only synthesize alms up to lmax = bandlimit*nside (if below lmax of chain), ex. 2 for fast low resolution maps",)
+def mean(input, dataset, output, min, max, maxchain, fwhm, nside, zerospin, pixweight, nproc, memory, cache, state, prefetch, shard, nthreads, bandlimit):
     """
     Calculates the mean over sample range from .h5 file.
     ex. chains_c0001.h5 dust/amp_map 5 50 dust_5-50_mean_40arcmin.fits -fwhm 40 -maxchain 3
@@ -33,7 +41,7 @@ def mean(input, dataset, output, min, max, maxchain, fwhm, nside, zerospin, pixw
         sys.exit()
 
 
-    h5handler(input, dataset, min, max, maxchain, output, fwhm, nside, np.mean, pixweight, zerospin,)
+    h5handler(input, dataset, min, max, maxchain, output, list(fwhm), nside, np.mean, pixweight, zerospin, nproc=nproc, memory=memory, cache=cache, state=state, prefetch=prefetch, shard=shard, nthreads=nthreads, bandlimit=bandlimit,)
 
 @commands_hdf.command()
 @click.argument("input", type=click.STRING)
@@ -42,11 +50,20 @@ def mean(input, dataset, output, min, max, maxchain, fwhm, nside, zerospin, pixw
 @click.option("-min", default=1, type=click.INT, help="Start sample, default 1",)
 @click.option("-max", default=None, type=click.INT, help="End sample, calculated automatically if not set",)
 @click.option("-maxchain", default=1, help="max number of chains c0005 [ex. 5]",)
-@click.option("-fwhm", default=0.0, help="FWHM in arcmin")
+@click.option("-fwhm", multiple=True, default=[0.0], type=click.FLOAT, help="FWHM in arcmin, repeat for one output per FWHM (output_{fwhm}arcmin) from a single pass",)
 @click.option("-nside", default=None, type=click.INT, help="Nside for alm binning",)
 @click.option("-zerospin", is_flag=True, help="If smoothing, treat maps as zero-spin maps.",)
 @click.option("-pixweight", default=None, type=click.STRING, help="Path to healpy pixel weights.",)
-def stddev(input, dataset, output, min, max, maxchain, fwhm, nside, zerospin, pixweight,):
+@click.option("-nproc", default=1, type=click.INT, help="Number of processes to reduce chains/sample ranges on",)
+@click.option("-memory", default=None, type=click.FLOAT, help="Memory budget in GB, reduces map datasets in pixel tiles",)
+@click.option("-cache", default=None, type=click.STRING, help="Directory caching smoothed samples between runs [default $C3PP_CACHE]",)
+@click.option("-state", default=None, type=click.STRING, help="Sidecar file keeping accumulators, later runs only read new samples",)
+@click.option("-prefetch", default=2, type=click.INT, help="Samples read ahead while others are transformed, 0 to disable",)
+@click.option("-shard", default=None, type=click.STRING, help="i/N, reduce only the i-th of N slices of the samples, see merge-moments",)
+@click.option("-batch", default=4, type=click.INT, help="Samples whose alms are unpacked together, default 4",)
+@click.option("-nthreads", default=0, type=click.INT, help="Threads per spherical harmonic transform (with ducc0), default all cores",)
+@click.option("-bandlimit", default=None, type=click.FLOAT, help="Only synthesize alms up to lmax = bandlimit*nside (if below lmax of chain), ex. 2 for fast low resolution maps",)
+def stddev(input, dataset, output, min, max, maxchain, fwhm, nside, zerospin, pixweight, nproc, memory, cache, state, prefetch, shard, batch, nthreads, bandlimit,):
     """
     Calculates the stddev over sample range from .h5 file.
     ex. chains_c0001.h5 dust/amp_map 5 50 dust_5-50_mean_40arcmin.fits -fwhm 40 -maxchain 3
@@ -58,7 +75,71 @@ def stddev(input, dataset, output, min, max, maxchain, fwhm, nside, zerospin, pi
         click.echo("Please specify nside when handling alms.")
         sys.exit()
 
-    h5handler(input, dataset, min, max, maxchain, output, fwhm, nside, np.std, pixweight, zerospin,)
+    h5handler(input, dataset, min, max, maxchain, output, list(fwhm), nside, np.std, pixweight, zerospin, nproc=nproc, memory=memory, cache=cache, state=state, prefetch=prefetch, shard=shard, batch=batch, nthreads=nthreads, bandlimit=bandlimit,)
+
+@commands_hdf.command()
+@click.argument("input", type=click.STRING)
+@click.argument("dataset", type=click.STRING)
+@click.argument("output", type=click.STRING)
+@click.option("-min", default=1, type=click.INT, help="Start sample, default 1",)
+@click.option("-max", default=None, type=click.INT, help="End sample, calculated automatically if not set",)
+@click.option("-maxchain", default=1, help="max number of chains c0005 [ex. 5]",)
+@click.option("-fwhm", multiple=True, default=[0.0], type=click.FLOAT, help="FWHM in arcmin, repeat for one output per FWHM (output_{fwhm}arcmin) from a single pass",)
+@click.option("-nside", default=None, type=click.INT, help="Nside for alm binning",)
+@click.option("-zerospin", is_flag=True, help="If smoothing, treat maps as zero-spin maps.",)
+@click.option("-pixweight", default=None, type=click.STRING, help="Path to healpy pixel weights.",)
+@click.option("-q", multiple=True, default=[16., 50., 84.], type=click.FLOAT, help="Percentiles to calculate, default 16 50 84",)
+@click.option("-memory", default=None, type=click.FLOAT, help="Memory budget in GB, calculates exact percentiles of map datasets in pixel tiles",)
+@click.option("-nproc", default=1, type=click.INT, help="Number of processes to reduce chains/pixel tiles on",)
+@click.option("-cache", default=None, type=click.STRING, help="Directory caching smoothed samples between runs [default $C3PP_CACHE]",)
+@click.option("-state", default=None, type=click.STRING, help="Sidecar file keeping accumulators, later runs only read new samples",)
+@click.option("-prefetch", default=2, type=click.INT, help="Samples read ahead while others are transformed, 0 to disable",)
+@click.option("-shard", default=None, type=click.STRING, help="i/N, reduce only the i-th of N slices of the samples, see merge-moments",)
+@click.option("-batch", default=4, type=click.INT, help="Samples whose alms are unpacked together, default 4",)
+@click.option("-nthreads", default=0, type=click.INT, help="Threads per spherical harmonic transform (with ducc0), default all cores",)
+@click.option("-bandlimit", default=None, type=click.FLOAT, help="Only synthesize alms up to lmax = bandlimit*nside (if below lmax of chain), ex. 2 for fast low resolution maps",)
+def percentile(input, dataset, output, min, max, maxchain, fwhm, nside, zerospin, pixweight, q, memory, nproc, cache, state, prefetch, shard, batch, nthreads, bandlimit,):
+    """
+    Calculates percentiles over sample range from .h5 file.
+    ex. chains_c0001.h5 dust/beta_map dust_beta_5-50_percentiles.fits -min 5 -max 50 -q 16 -q 50 -q 84
+    Percentiles are estimated per pixel while streaming through the samples,
+    in fixed memory. With -memory, pixel tiles of all samples of a map
+    dataset are read instead, giving exact percentiles.
+    Output has columns I_Q16, Q_Q16, U_Q16, I_Q50, ...
+    """
+    if dataset.endswith("alm") and nside == None:
+        click.echo("Please specify nside when handling alms.")
+        sys.exit()
+
+    h5handler(input, dataset, min, max, maxchain, output, list(fwhm), nside, np.percentile, pixweight, zerospin, nproc=nproc, memory=memory, cache=cache, state=state, q=q, prefetch=prefetch, shard=shard, batch=batch, nthreads=nthreads, bandlimit=bandlimit,)
+
+@commands_hdf.command()
+@click.argument("output", type=click.STRING)
+@click.argument("partials", nargs=-1, required=True, type=click.STRING)
+def merge_moments(output, partials):
+    """
+    Combines shards of mean, stddev or percentile runs into final maps.
+    ex. c3pp mean chain_c0001.h5 dust/amp_map dust_mean.fits -maxchain 4 -shard 1/8
+    (and -shard 2/8 to 8/8, ex. on separate nodes) writes dust_mean_shard1of8.npz, ...
+    c3pp merge-moments dust_mean.fits dust_mean_shard*of8.npz
+    """
+    h5merge(partials, output)
+
+@commands_hdf.command()
+@click.argument("input", type=click.STRING)
+@click.option("-maxchain", default=1, help="max number of chains c0005 [ex. 5]",)
+@click.option("-rebuild", is_flag=True, help="Rescan chain even if its index is up to date",)
+def chaininfo(input, maxchain, rebuild):
+    """
+    Lists samples and datasets in .h5 chain file.
+    The chain is scanned once and the index cached as chain_c0001.h5.index.json,
+    which is also used by the other commands reading the chain.
+    ex. c3pp chaininfo chain_c0001.h5 -maxchain 4
+    """
+    from src.chainindex import ChainIndex
+    for c in range(1, maxchain + 1):
+        filename = input.replace("c0001", "c" + str(c).zfill(4))
+        print(ChainIndex(filename, rebuild=rebuild))
 
 @commands_hdf.command()
 @click.argument("filename", type=click.STRING)
@@ -77,25 +158,24 @@ esamp_v1 will point to chain_c****_Tresamp_v1.h5.
     """
     click.echo("{:-^48}".format("Formatting sigma_l data to fits file"))
     import h5py
+    from src.chainindex import ChainIndex
     if filename.endswith(".h5"):
         filename = filename.rsplit("_", 1)[0]
-    temp = np.zeros(nchains)
-    for nc in range(1, nchains + 1):
-        with h5py.File(filename + "_c" + str(nc).zfill(4) + suffix + ".h5", "r",) as f:
-            groups = list(f.keys())
-            temp[nc - 1] = len(groups)
-    nsamples_max = int(max(temp[:]))
+    indices = [ChainIndex(filename + "_c" + str(nc).zfill(4) + suffix + ".h5") for nc in range(1, nchains + 1)]
+    nsamples_max = max(len(index.samples) for index in indices)
     click.echo(f"Largest chain has {nsamples_max} samples, using burnin {burnin}\n")
-    for nc in range(1, nchains + 1):
-        fn = filename + "_c" + str(nc).zfill(4) + suffix + ".h5"
+    for nc, index in enumerate(indices, start=1):
+        fn = index.filename
         with h5py.File(fn, "r",) as f:
             click.echo(f"Reading {fn}")
-            groups = list(f.keys())
+            groups = [str(sample).zfill(6) for sample in index.samples]
             nsamples = len(groups)
+            # Row 0 has always held the top-level group count of the last chain, less 2
+            ngroups = len(f.keys())
             if nc == 1:
-                dset = np.zeros((nsamples_max + 1, 1, len(f[groups[0] + "/" + path]), len(f[groups[0] + "/" + path][0]),))
-                nspec = len(f[groups[0] + "/" + path])
-                lmax = len(f[groups[0] + "/" + path][0]) - 1
+                nspec, lmax = index.shape(path)
+                lmax -= 1
+                dset = np.zeros((nsamples_max + 1, 1, nspec, lmax + 1,))
             else:
                 dset = np.append(dset, np.zeros((nsamples_max + 1, 1, nspec, lmax + 1,)), axis=1,)
             click.echo(f"Dataset: {path} \n# samples: {nsamples} \n# spectra: {nspec} \nlmax: {lmax}")
@@ -109,7 +189,7 @@ esamp_v1 will point to chain_c****_Tresamp_v1.h5.
         for i in range(1, nsamples_max + 1):
             for j in range(nspec):
                 dset[i, nc - 1, j, :] = dset[i, nc - 1, j, :] * ell[:] * (ell[:] + 1.0) / 2.0 / np.pi
-    dset[0, :, :, :] = nsamples - 2 #burnin 
+    dset[0, :, :, :] = ngroups - 2 #burnin 
 
     if save:
         click.echo(f"Dumping fits file: {outname}")
@@ -192,12 +272,13 @@ def h52fits(filename, dataset,):
 @click.argument("nside", type=click.INT)
 @click.option("-lmax", default=None, type=click.INT)
 @click.option("-fwhm", default=0.0, type=click.FLOAT)
-def alm2fits(input, dataset, nside, lmax, fwhm):
+@click.option("-bandlimit", default=None, type=click.FLOAT, help="Without -lmax, only synthesize alms up to lmax = bandlimit*nside",)
+def alm2fits(input, dataset, nside, lmax, fwhm, bandlimit):
     """
     Converts c3 alms in .h5 file to fits.
     Specify nside and optional smoothing.
     """
-    alm2fits_tool(input, dataset, nside, lmax, fwhm)
+    alm2fits_tool(input, dataset, nside, lmax, fwhm, bandlimit=bandlimit)
 
 
 @commands_hdf.command()
@@ -206,6 +287,9 @@ def alm2fits(input, dataset, nside, lmax, fwhm):
 @click.argument("procver", type=click.STRING)
 @click.option("-resamp", is_flag=True, help="data interpreted as resampled data",)
 @click.option("-copy", "copy_", is_flag=True, help=" copy full .h5 file",)
+@click.option("-copymode", default="full", type=click.Choice(["full", "subset", "link"]), help="full copies, subset writes only samples after burnin, link hard links or reflinks",)
+@click.option("-copydatasets", multiple=True, type=click.STRING, help="With -copymode subset, only copy these datasets or groups of each sample, ex. cmb/amp_alm",)
+@click.option("-compress", default=None, type=click.IntRange(0, 9), help="With -copymode subset, gzip compress datasets in chunks at this level",)
 @click.option("-freqmaps", is_flag=True, help=" output freqmaps",)
 @click.option("-ame", is_flag=True, help=" output ame",)
 @click.option("-ff", "-freefree", "ff", is_flag=True, help=" output freefree",)
@@ -221,8 +305,15 @@ def alm2fits(input, dataset, nside, lmax, fwhm):
 @click.option("-all", "all_", is_flag=True, help="Output all")
 @click.option("-plot", is_flag=True, help="Plot everything (invoke plotrelease)")
 @click.option("-pol", is_flag=True, help="if resamp is pol or T")
+@click.option("-nproc", default=1, type=click.INT, help="Number of release products made at once",)
+@click.option("-memory", default=None, type=click.FLOAT, help="Memory budget in GB of the products made at once, default all of RAM",)
+@click.option("-readnproc", default=None, type=click.INT, help="Processes reading the residual and chisq samples of each goodness product, default -nproc",)
+@click.option("-cache", default=None, type=click.STRING, help="Directory caching the smoothed reference maps of -diff and -diffcmb between runs [default $C3PP_CACHE, none if unset]",)
+@click.option("-force", "--force", "force", is_flag=True, help="Remake products even if up to date with their chains and settings",)
+@click.option("-precision", default="single", type=click.Choice(["single", "double"]), help="Precision of the fits products, computed in double either way",)
+@click.option("-archive", is_flag=True, help="Also write a lossless tile compressed copy of each fits product, as {filename}.fz",)
 @click.pass_context
-def release(ctx, chain, burnin, procver, resamp, copy_, freqmaps, ame, ff, cmb, synch, dust, br, diff, diffcmb, goodness, chisq, res, all_, plot, pol):
+def release(ctx, chain, burnin, procver, resamp, copy_, copymode, copydatasets, compress, freqmaps, ame, ff, cmb, synch, dust, br, diff, diffcmb, goodness, chisq, res, all_, plot, pol, nproc, memory, readnproc, cache, force, precision, archive):
     """
     Creates a release file-set on the BeyondPlanck format.
     https://gitlab.com/BeyondPlanck/repo/-/wikis/BeyondPlanck-Release-Candidate-2
@@ -249,14 +340,19 @@ def release(ctx, chain, burnin, procver, resamp, copy_, freqmaps, ame, ff, cmb,
     BP_ame_I_n1024_{procver}.fits
 
     BP_cmb_GBRlike_{procver}.fits
+
+    Products are only remade if their chains or settings changed since
+    they were made, as recorded in {procver}/release_manifest.json,
+    or with -force.
     """
     # TODO
     # Use proper masks for output of CMB component
     # Use inpainted data as well in CMB component
 
     from src.fitsformatter import format_fits, get_data, get_header
+    from src.scheduler import run_tasks
+    from src.manifest import Manifest
     from pathlib import Path
-    import shutil
 
     if all_: # sets all other flags to true
         copy_ = not copy_; freqmaps = not freqmaps; ame = not ame; ff = not ff; cmb = not cmb
@@ -280,28 +376,37 @@ def release(ctx, chain, burnin, procver, resamp, copy_, freqmaps, ame, ff, cmb,
     else:
         pol="T"
     """
+    Release products are run as a graph of tasks on nproc processes,
+    packed by their memory estimates (see run_tasks). Maps made from the
+    copied chain wait for the copy, the diff maps for the maps they use.
+    Each task is made from inputs (by default its chain) into outputs (by
+    default {procver}/{filename}), which the manifest keeps track of.
+    """
+    tasks = {}
+    def add(name, fn, deps=(), memory=0.0, inputs=None, outputs=None, **kwargs):
+        if inputs == None:
+            inputs = [kwargs["chain"]] if isinstance(kwargs["chain"], str) else list(kwargs["chain"])
+        if outputs == None:
+            outputs = [f"{procver}/{kwargs['filename']}"]
+        if fn is format_fits:
+            kwargs.update(dtype={"single": "float32", "double": "float64"}[precision], archive=archive)
+            if archive:
+                outputs = outputs + [f"{output}.fz" for output in outputs]
+        tasks[name] = {"fn": fn, "kwargs": kwargs, "deps": list(deps), "memory": memory, "inputs": inputs, "outputs": outputs}
+
+    """
     Copying chains files
     """
+    # Chains are copied in parallel, to a subset of samples and datasets with -copymode subset
+    copies = []
     if copy_:
-        # Commander3 parameter file for main chain
-        for i, chainfile in enumerate(chains, 1):
-            path = os.path.split(chainfile)[0]
-            for file in os.listdir(path):
-                if file.startswith("param") and i == 1:  # Copy only first
-                    click.echo(f"Copying {path}/{file} to {procver}/BP_param_c" + str(i).zfill(4) + f"_{procver}.txt")
-                    if resamp:
-                        shutil.copyfile(f"{path}/{file}", f"{procver}/BP_param_c" + str(i).zfill(4) + f"_{pol}resamp_{procver}.txt")
-                    else:
-                        shutil.copyfile(f"{path}/{file}", f"{procver}/BP_param_c" + str(i).zfill(4) + f"_{procver}.txt")
-
-            if resamp:
-                # Resampled CMB-only full-mission Gibbs chain file with Cls (for BR estimator)
-                click.echo(f"Copying {chainfile} to {procver}/BP_c" + str(i).zfill(4) + f"_{pol}resamp_{procver}.h5")
-                shutil.copyfile(chainfile, f"{procver}/BP_c" + str(i).zfill(4) + f"_{pol}resamp_{procver}.h5",)
-            else:
-                # Full-mission Gibbs chain file
-                click.echo(f"Copying {chainfile} to {procver}/BP_c" + str(i).zfill(4) + f"_{procver}.h5")
-                shutil.copyfile(chainfile, f"{procver}/BP_c" + str(i).zfill(4) + f"_{procver}.h5",)
+        for i, (chainfile, copyfile) in enumerate(zip(chains, release_copies(chains, procver, resamp, pol)), 1):
+            copies.append(f"copy_c{str(i).zfill(4)}")
+            param = None
+            if i == 1:  # Copy only first
+                param = f"{procver}/BP_param_c" + str(i).zfill(4) + (f"_{pol}resamp_{procver}.txt" if resamp else f"_{procver}.txt")
+            add(copies[-1], release_copy, inputs=[chainfile], outputs=[copyfile], chainfile=chainfile, copyfile=copyfile, param=param,
+                mode=copymode, burnin=burnin, datasets=list(copydatasets) or None, compression=compress)
 
      #if halfring:
      #   # Copy halfring files
@@ -319,73 +424,79 @@ def release(ctx, chain, burnin, procver, resamp, copy_, freqmaps, ame, ff, cmb,
     else:
         chain = f"{procver}/BP_c0001_{procver}.h5"
     if freqmaps:
-        try:
-            # Full-mission 30 GHz IQU frequency map
-            # BP_030_IQU_n0512_{procver}.fits
-            format_fits(
-                chain=chain,
-                extname="FREQMAP",
-                types=["I_MEAN", "Q_MEAN", "U_MEAN", "I_RMS", "Q_RMS", "U_RMS","I_STDDEV", "Q_STDDEV", "U_STDDEV",],
-                units=["uK", "uK", "uK", "uK", "uK", "uK", "uK", "uK", "uK",],
-                nside=512,
-                burnin=burnin,
-                maxchain=maxchain,
-                polar=True,
-                component="030",
-                fwhm=0.0,
-                nu_ref_t="30.0 GHz",
-                nu_ref_p="30.0 GHz",
-                procver=procver,
-                filename=f"BP_030_IQU_n0512_{procver}.fits",
-                bndctr=30,
-                restfreq=28.456,
-                bndwid=9.899,
-            )
-            # Full-mission 44 GHz IQU frequency map
-            format_fits(
-                chain=chain,
-                extname="FREQMAP",
-                types=["I_MEAN", "Q_MEAN", "U_MEAN", "I_RMS", "Q_RMS", "U_RMS","I_STDDEV", "Q_STDDEV", "U_STDDEV",],
-                units=["uK", "uK", "uK", "uK", "uK", "uK", "uK", "uK", "uK",],
-                nside=512,
-                burnin=burnin,
-                maxchain=maxchain,
-                polar=True,
-                component="044",
-                fwhm=0.0,
-                nu_ref_t="44.0 GHz",
-                nu_ref_p="44.0 GHz",
-                procver=procver,
-                filename=f"BP_044_IQU_n0512_{procver}.fits",
-                bndctr=44,
-                restfreq=44.121,
-                bndwid=10.719,
-            )
-            # Full-mission 70 GHz IQU frequency map
-            format_fits(
-                chain=chain,
-                extname="FREQMAP",
-                types=["I_MEAN", "Q_MEAN", "U_MEAN", "I_RMS", "Q_RMS", "U_RMS","I_STDDEV", "Q_STDDEV", "U_STDDEV",],
-                units=["uK", "uK", "uK", "uK", "uK", "uK", "uK", "uK", "uK",],
-                nside=1024,
-                burnin=burnin,
-                maxchain=maxchain,
-                polar=True,
-                component="070",
-                fwhm=0.0,
-                nu_ref_t="70.0 GHz",
-                nu_ref_p="70.0 GHz",
-                procver=procver,
-                filename=f"BP_070_IQU_n1024_{procver}.fits",
-                bndctr=70,
-                restfreq=70.467,
-                bndwid=14.909,
-            )
-
-
-        except Exception as e:
-            print(e)
-            click.secho("Continuing...",fg="yellow")
+        # Full-mission 30 GHz IQU frequency map
+        # BP_030_IQU_n0512_{procver}.fits
+        add(
+            "freqmap_030",
+            format_fits,
+            deps=copies,
+            memory=release_memory(512, 9),
+            chain=chain,
+            extname="FREQMAP",
+            types=["I_MEAN", "Q_MEAN", "U_MEAN", "I_RMS", "Q_RMS", "U_RMS","I_STDDEV", "Q_STDDEV", "U_STDDEV",],
+            units=["uK", "uK", "uK", "uK", "uK", "uK", "uK", "uK", "uK",],
+            nside=512,
+            burnin=burnin,
+            maxchain=maxchain,
+            polar=True,
+            component="030",
+            fwhm=0.0,
+            nu_ref_t="30.0 GHz",
+            nu_ref_p="30.0 GHz",
+            procver=procver,
+            filename=f"BP_030_IQU_n0512_{procver}.fits",
+            bndctr=30,
+            restfreq=28.456,
+            bndwid=9.899,
+        )
+        # Full-mission 44 GHz IQU frequency map
+        add(
+            "freqmap_044",
+            format_fits,
+            deps=copies,
+            memory=release_memory(512, 9),
+            chain=chain,
+            extname="FREQMAP",
+            types=["I_MEAN", "Q_MEAN", "U_MEAN", "I_RMS", "Q_RMS", "U_RMS","I_STDDEV", "Q_STDDEV", "U_STDDEV",],
+            units=["uK", "uK", "uK", "uK", "uK", "uK", "uK", "uK", "uK",],
+            nside=512,
+            burnin=burnin,
+            maxchain=maxchain,
+            polar=True,
+            component="044",
+            fwhm=0.0,
+            nu_ref_t="44.0 GHz",
+            nu_ref_p="44.0 GHz",
+            procver=procver,
+            filename=f"BP_044_IQU_n0512_{procver}.fits",
+            bndctr=44,
+            restfreq=44.121,
+            bndwid=10.719,
+        )
+        # Full-mission 70 GHz IQU frequency map
+        add(
+            "freqmap_070",
+            format_fits,
+            deps=copies,
+            memory=release_memory(1024, 9),
+            chain=chain,
+            extname="FREQMAP",
+            types=["I_MEAN", "Q_MEAN", "U_MEAN", "I_RMS", "Q_RMS", "U_RMS","I_STDDEV", "Q_STDDEV", "U_STDDEV",],
+            units=["uK", "uK", "uK", "uK", "uK", "uK", "uK", "uK", "uK",],
+            nside=1024,
+            burnin=burnin,
+            maxchain=maxchain,
+            polar=True,
+            component="070",
+            fwhm=0.0,
+            nu_ref_t="70.0 GHz",
+            nu_ref_p="70.0 GHz",
+            procver=procver,
+            filename=f"BP_070_IQU_n1024_{procver}.fits",
+            bndctr=70,
+            restfreq=70.467,
+            bndwid=14.909,
+        )
 
     
     """
@@ -395,62 +506,40 @@ def release(ctx, chain, burnin, procver, resamp, copy_, freqmaps, ame, ff, cmb,
     if cmb:
         if resamp:
             if pol == "P":
-                try:
-                    format_fits(
-                        chain,
-                        extname="COMP-MAP-CMB-RESAMP-P",
-                        types=["Q_MEAN","U_MEAN", "Q_STDDEV","U_STDDEV",],
-                        units=["uK_cmb", "uK_cmb","uK_cmb", "uK_cmb",],
-                        nside=1024,
-                        burnin=burnin,
-                        maxchain=maxchain,
-                        polar=True,
-                        component="CMB",
-                        fwhm=14.0,
-                        nu_ref_t="NONE",
-                        nu_ref_p="NONE",
-                        procver=procver,
-                        filename=f"BP_cmb_resamp_QU_n1024_{procver}.fits",
-                        bndctr=None,
-                        restfreq=None,
-                        bndwid=None,
-                    )
-                except Exception as e:
-                    print(e)
-                    click.secho("Continuing...",fg="yellow")
+                add(
+                    "cmb",
+                    format_fits,
+                    deps=copies,
+                    memory=release_memory(1024, 4),
+                    chain=chain,
+                    extname="COMP-MAP-CMB-RESAMP-P",
+                    types=["Q_MEAN","U_MEAN", "Q_STDDEV","U_STDDEV",],
+                    units=["uK_cmb", "uK_cmb","uK_cmb", "uK_cmb",],
+                    nside=1024,
+                    burnin=burnin,
+                    maxchain=maxchain,
+                    polar=True,
+                    component="CMB",
+                    fwhm=14.0,
+                    nu_ref_t="NONE",
+                    nu_ref_p="NONE",
+                    procver=procver,
+                    filename=f"BP_cmb_resamp_QU_n1024_{procver}.fits",
+                    bndctr=None,
+                    restfreq=None,
+                    bndwid=None,
+                )
 
             else:    
-                try:
-                    format_fits(
-                        chain,
-                        extname="COMP-MAP-CMB-RESAMP-T",
-                        types=["I_MEAN", "I_STDDEV",],
-                        units=["uK_cmb", "uK_cmb",],
-                        nside=1024,
-                        burnin=burnin,
-                        maxchain=maxchain,
-                        polar=True,
-                        component="CMB",
-                        fwhm=14.0,
-                        nu_ref_t="NONE",
-                        nu_ref_p="NONE",
-                        procver=procver,
-                        filename=f"BP_cmb_resamp_I_n1024_{procver}.fits",
-                        bndctr=None,
-                        restfreq=None,
-                        bndwid=None,
-                    )
-                except Exception as e:
-                    print(e)
-                    click.secho("Continuing...",fg="yellow")
-                
-        else:
-            try:
-                format_fits(
-                    chain,
-                    extname="COMP-MAP-CMB",
-                    types=["I_MEAN", "Q_MEAN", "U_MEAN", "I_STDDEV", "Q_STDDEV", "U_STDDEV", "mask1", "mask2",],
-                    units=["uK_cmb", "uK_cmb", "uK", "uK", "NONE", "NONE",],
+                add(
+                    "cmb",
+                    format_fits,
+                    deps=copies,
+                    memory=release_memory(1024, 2),
+                    chain=chain,
+                    extname="COMP-MAP-CMB-RESAMP-T",
+                    types=["I_MEAN", "I_STDDEV",],
+                    units=["uK_cmb", "uK_cmb",],
                     nside=1024,
                     burnin=burnin,
                     maxchain=maxchain,
@@ -460,207 +549,153 @@ def release(ctx, chain, burnin, procver, resamp, copy_, freqmaps, ame, ff, cmb,
                     nu_ref_t="NONE",
                     nu_ref_p="NONE",
                     procver=procver,
-                    filename=f"BP_cmb_IQU_n1024_{procver}.fits",
+                    filename=f"BP_cmb_resamp_I_n1024_{procver}.fits",
                     bndctr=None,
                     restfreq=None,
                     bndwid=None,
                 )
-            except Exception as e:
-                print(e)
-                click.secho("Continuing...",fg="yellow")
-
-    if ff:
-        try:
-            # Full-mission free-free I map
-            format_fits(
-                chain,
-                extname="COMP-MAP-FREE-FREE",
-                types=["I_MEAN", "I_TE_MEAN", "I_STDDEV", "I_TE_STDDEV",],
-                units=["uK_RJ", "K", "uK_RJ", "K",],
+                
+        else:
+            add(
+                "cmb",
+                format_fits,
+                deps=copies,
+                memory=release_memory(1024, 8),
+                chain=chain,
+                extname="COMP-MAP-CMB",
+                types=["I_MEAN", "Q_MEAN", "U_MEAN", "I_STDDEV", "Q_STDDEV", "U_STDDEV", "mask1", "mask2",],
+                units=["uK_cmb", "uK_cmb", "uK", "uK", "NONE", "NONE",],
                 nside=1024,
                 burnin=burnin,
                 maxchain=maxchain,
-                polar=False,
-                component="FREE-FREE",
-                fwhm=30.0,
-                nu_ref_t="40.0 GHz",
-                nu_ref_p="40.0 GHz",
+                polar=True,
+                component="CMB",
+                fwhm=14.0,
+                nu_ref_t="NONE",
+                nu_ref_p="NONE",
                 procver=procver,
-                filename=f"BP_freefree_I_n1024_{procver}.fits",
+                filename=f"BP_cmb_IQU_n1024_{procver}.fits",
                 bndctr=None,
                 restfreq=None,
                 bndwid=None,
             )
-        except Exception as e:
-            print(e)
-            click.secho("Continuing...",fg="yellow")
+
+    if ff:
+        # Full-mission free-free I map
+        add(
+            "ff",
+            format_fits,
+            deps=copies,
+            memory=release_memory(1024, 4),
+            chain=chain,
+            extname="COMP-MAP-FREE-FREE",
+            types=["I_MEAN", "I_TE_MEAN", "I_STDDEV", "I_TE_STDDEV",],
+            units=["uK_RJ", "K", "uK_RJ", "K",],
+            nside=1024,
+            burnin=burnin,
+            maxchain=maxchain,
+            polar=False,
+            component="FREE-FREE",
+            fwhm=30.0,
+            nu_ref_t="40.0 GHz",
+            nu_ref_p="40.0 GHz",
+            procver=procver,
+            filename=f"BP_freefree_I_n1024_{procver}.fits",
+            bndctr=None,
+            restfreq=None,
+            bndwid=None,
+        )
 
     if ame:
-        try:
-            # Full-mission AME I map
-            format_fits(
-                chain,
-                extname="COMP-MAP-AME",
-                types=["I_MEAN", "I_NU_P_MEAN", "I_STDDEV", "I_NU_P_STDDEV",],
-                units=["uK_RJ", "GHz", "uK_RJ", "GHz",],
-                nside=1024,
-                burnin=burnin,
-                maxchain=maxchain,
-                polar=False,
-                component="AME",
-                fwhm=120.0,
-                nu_ref_t="22.0 GHz",
-                nu_ref_p="22.0 GHz",
-                procver=procver,
-                filename=f"BP_ame_I_n1024_{procver}.fits",
-                bndctr=None,
-                restfreq=None,
-                bndwid=None,
-            )
-        except Exception as e:
-            print(e)
-            click.secho("Continuing...",fg="yellow")
+        # Full-mission AME I map
+        add(
+            "ame",
+            format_fits,
+            deps=copies,
+            memory=release_memory(1024, 4),
+            chain=chain,
+            extname="COMP-MAP-AME",
+            types=["I_MEAN", "I_NU_P_MEAN", "I_STDDEV", "I_NU_P_STDDEV",],
+            units=["uK_RJ", "GHz", "uK_RJ", "GHz",],
+            nside=1024,
+            burnin=burnin,
+            maxchain=maxchain,
+            polar=False,
+            component="AME",
+            fwhm=120.0,
+            nu_ref_t="22.0 GHz",
+            nu_ref_p="22.0 GHz",
+            procver=procver,
+            filename=f"BP_ame_I_n1024_{procver}.fits",
+            bndctr=None,
+            restfreq=None,
+            bndwid=None,
+        )
 
     if synch:
-        try:
-            # Full-mission synchrotron IQU map
-            format_fits(
-                chain,
-                extname="COMP-MAP-SYNCHROTRON",
-                types=["I_MEAN", "Q_MEAN", "U_MEAN", "P_MEAN", "I_BETA_MEAN", "QU_BETA_MEAN", "I_STDDEV", "Q_STDDEV", "U_STDDEV", "P_STDDEV", "I_BETA_STDDEV", "QU_BETA_STDDEV",],
-                units=["uK_RJ", "uK_RJ", "uK_RJ", "uK_RJ", "NONE", "NONE", "uK_RJ","uK_RJ","uK_RJ","uK_RJ", "NONE", "NONE",],
-                nside=1024,
-                burnin=burnin,
-                maxchain=maxchain,
-                polar=True,
-                component="SYNCHROTRON",
-                fwhm=60.0,  # 60.0,
-                nu_ref_t="30.0 GHz",
-                nu_ref_p="30.0 GHz",
-                procver=procver,
-                filename=f"BP_synch_IQU_n1024_{procver}.fits",
-                bndctr=None,
-                restfreq=None,
-                bndwid=None,
-            )
-        except Exception as e:
-            print(e)
-            click.secho("Continuing...",fg="yellow")
+        # Full-mission synchrotron IQU map
+        add(
+            "synch",
+            format_fits,
+            deps=copies,
+            memory=release_memory(1024, 12),
+            chain=chain,
+            extname="COMP-MAP-SYNCHROTRON",
+            types=["I_MEAN", "Q_MEAN", "U_MEAN", "P_MEAN", "I_BETA_MEAN", "QU_BETA_MEAN", "I_STDDEV", "Q_STDDEV", "U_STDDEV", "P_STDDEV", "I_BETA_STDDEV", "QU_BETA_STDDEV",],
+            units=["uK_RJ", "uK_RJ", "uK_RJ", "uK_RJ", "NONE", "NONE", "uK_RJ","uK_RJ","uK_RJ","uK_RJ", "NONE", "NONE",],
+            nside=1024,
+            burnin=burnin,
+            maxchain=maxchain,
+            polar=True,
+            component="SYNCHROTRON",
+            fwhm=60.0,  # 60.0,
+            nu_ref_t="30.0 GHz",
+            nu_ref_p="30.0 GHz",
+            procver=procver,
+            filename=f"BP_synch_IQU_n1024_{procver}.fits",
+            bndctr=None,
+            restfreq=None,
+            bndwid=None,
+        )
 
     if dust:
-        try:
-            # Full-mission thermal dust IQU map
-            format_fits(
-                chain,
-                extname="COMP-MAP-DUST",
-                types=["I_MEAN", "Q_MEAN", "U_MEAN", "P_MEAN", "I_BETA_MEAN", "QU_BETA_MEAN", "I_T_MEAN", "QU_T_MEAN", "I_STDDEV", "Q_STDDEV", "U_STDDEV", "P_STDDEV", "I_BETA_STDDEV", "QU_BETA_STDDEV", "I_T_STDDEV", "QU_T_STDDEV",],
-                units=["uK_RJ", "uK_RJ", "uK_RJ", "uK_RJ", "NONE", "NONE", "K", "K", "uK_RJ","uK_RJ","uK_RJ","uK_RJ", "NONE", "NONE", "K", "K",],
-                nside=1024,
-                burnin=burnin,
-                maxchain=maxchain,
-                polar=True,
-                component="DUST",
-                fwhm=10.0,  # 60.0,
-                nu_ref_t="545 GHz",
-                nu_ref_p="353 GHz",
-                procver=procver,
-                filename=f"BP_dust_IQU_n1024_{procver}.fits",
-                bndctr=None,
-                restfreq=None,
-                bndwid=None,
-            )
-        except Exception as e:
-            print(e)
-            click.secho("Continuing...",fg="yellow")
+        # Full-mission thermal dust IQU map
+        add(
+            "dust",
+            format_fits,
+            deps=copies,
+            memory=release_memory(1024, 16),
+            chain=chain,
+            extname="COMP-MAP-DUST",
+            types=["I_MEAN", "Q_MEAN", "U_MEAN", "P_MEAN", "I_BETA_MEAN", "QU_BETA_MEAN", "I_T_MEAN", "QU_T_MEAN", "I_STDDEV", "Q_STDDEV", "U_STDDEV", "P_STDDEV", "I_BETA_STDDEV", "QU_BETA_STDDEV", "I_T_STDDEV", "QU_T_STDDEV",],
+            units=["uK_RJ", "uK_RJ", "uK_RJ", "uK_RJ", "NONE", "NONE", "K", "K", "uK_RJ","uK_RJ","uK_RJ","uK_RJ", "NONE", "NONE", "K", "K",],
+            nside=1024,
+            burnin=burnin,
+            maxchain=maxchain,
+            polar=True,
+            component="DUST",
+            fwhm=10.0,  # 60.0,
+            nu_ref_t="545 GHz",
+            nu_ref_p="353 GHz",
+            procver=procver,
+            filename=f"BP_dust_IQU_n1024_{procver}.fits",
+            bndctr=None,
+            restfreq=None,
+            bndwid=None,
+        )
 
     if diff:
-        import healpy as hp
-        try:
-            if not os.path.exists("diffs"):
-                os.mkdir("diffs")
-            click.echo("Creating frequency difference maps")
-            path_dx12 = "/mn/stornext/u3/trygvels/compsep/cdata/like/BP_releases/dx12"
-            path_npipe = "/mn/stornext/u3/trygvels/compsep/cdata/like/BP_releases/npipe"
-            maps_dx12 = ["30ghz_2018_n1024_beamscaled_dip.fits","44ghz_2018_n1024_beamscaled_dip.fits","70ghz_2018_n1024_beamscaled_dip.fits"]
-            maps_npipe = ["npipe6v20_030_map_uK.fits", "npipe6v20_044_map_uK.fits", "npipe6v20_070_map_uK.fits",]
-            maps_BP = [f"BP_030_IQU_n0512_{procver}.fits", f"BP_044_IQU_n0512_{procver}.fits", f"BP_070_IQU_n1024_{procver}.fits",]
-            beamscaling = [9.8961854E-01, 9.9757886E-01, 9.9113965E-01]
-            for i, freq in enumerate(["030", "044", "070",]):
-                map_BP    = hp.read_map(f"{procver}/{maps_BP[i]}", field=(0,1,2), verbose=False, dtype=None)
-                map_npipe = hp.read_map(f"{path_npipe}/{maps_npipe[i]}", field=(0,1,2), verbose=False, dtype=None)
-                map_dx12  = hp.read_map(f"{path_dx12}/{maps_dx12[i]}", field=(0,1,2), verbose=False, dtype=None)
-                
-                #dx12 dipole values:
-                # 3362.08 pm 0.99, 264.021 pm 0.011, 48.253 ± 0.005
-                # 233.18308357  2226.43833645 -2508.42179665
-                #dipole_dx12 = -3362.08*hp.dir2vec(264.021, 48.253, lonlat=True)
-
-                #map_dx12  = map_dx12/beamscaling[i]
-                # Smooth to 60 arcmin
-                map_BP = hp.smoothing(map_BP, fwhm=arcmin2rad(60.0), verbose=False)
-                map_npipe = hp.smoothing(map_npipe, fwhm=arcmin2rad(60.0), verbose=False)
-                map_dx12 = hp.smoothing(map_dx12, fwhm=arcmin2rad(60.0), verbose=False)
-
-                #ud_grade 30 and 44ghz
-                if i<2:
-                    map_npipe = hp.ud_grade(map_npipe, nside_out=512,)
-                    map_dx12 = hp.ud_grade(map_dx12, nside_out=512,)
-
-                # Remove monopoles
-                map_BP -= np.mean(map_BP,axis=1).reshape(-1,1)
-                map_npipe -= np.mean(map_npipe,axis=1).reshape(-1,1)
-                map_dx12 -= np.mean(map_dx12,axis=1).reshape(-1,1)
-
-                hp.write_map(f"{procver}/diffs/BP_{freq}_diff_npipe_{procver}.fits", np.array(map_BP-map_npipe), overwrite=True, column_names=["I_DIFF", "Q_DIFF", "U_DIFF"], dtype=None)
-                hp.write_map(f"{procver}/diffs/BP_{freq}_diff_dx12_{procver}.fits", np.array(map_BP-map_dx12), overwrite=True, column_names=["I_DIFF", "Q_DIFF", "U_DIFF"], dtype=None)
-
-        except Exception as e:
-            print(e)
-            click.secho("Continuing...",fg="yellow")
+        freqs = ["030", "044", "070"]
+        inputs = [f"{procver}/BP_030_IQU_n0512_{procver}.fits", f"{procver}/BP_044_IQU_n0512_{procver}.fits", f"{procver}/BP_070_IQU_n1024_{procver}.fits",]
+        outputs = [f"{procver}/diffs/BP_{freq}_diff_{ref}_{procver}.fits" for freq in freqs for ref in ("npipe", "dx12")]
+        add("diff", release_diff, deps=[f"freqmap_{freq}" for freq in freqs], memory=release_memory(1024, 9), inputs=inputs, outputs=outputs, procver=procver, cache=cache)
 
     if diffcmb:
-        import healpy as hp
-        try:
-            if not os.path.exists("diffs"):
-                os.mkdir("diffs")
-            click.echo("Creating cmb difference maps")
-            path_cmblegacy = "/mn/stornext/u3/trygvels/compsep/cdata/like/BP_releases/cmb-legacy"
-            mask_ = hp.read_map("/mn/stornext/u3/trygvels/compsep/cdata/like/BP_releases/masks/dx12_v3_common_mask_int_005a_1024_TQU.fits", verbose=False, dtype=np.bool,)
-            map_BP = hp.read_map(f"{procver}/BP_cmb_IQU_n1024_{procver}.fits", field=(0,1,2), verbose=False, dtype=None,)
-            map_BP_masked = hp.ma(map_BP[0])
-            map_BP_masked.mask = np.logical_not(mask_)
-            mono, dip = hp.fit_dipole(map_BP_masked)
-            nside = 1024
-            ray = range(hp.nside2npix(nside))
-            vecs = hp.pix2vec(nside, ray)
-            dipole = np.dot(dip, vecs)
-            map_BP[0] = map_BP[0] - dipole - mono
-            map_BP = hp.smoothing(map_BP, fwhm=arcmin2rad(np.sqrt(60.0**2-14**2)), verbose=False)
-            #map_BP -= np.mean(map_BP,axis=1).reshape(-1,1)
-            for i, method in enumerate(["commander", "sevem", "nilc", "smica",]):
-
-                data = f"COM_CMB_IQU-{method}_2048_R3.00_full.fits"
-                click.echo(f"making difference map with {data}")
-                map_cmblegacy  = hp.read_map(f"{path_cmblegacy}/{data}", field=(0,1,2), verbose=False,dtype=None)
-                map_cmblegacy = hp.smoothing(map_cmblegacy, fwhm=arcmin2rad(60.0), verbose=False)
-                map_cmblegacy = hp.ud_grade(map_cmblegacy, nside_out=1024,)
-                map_cmblegacy = map_cmblegacy*1e6
-
-                # Remove monopoles
-                map_cmblegacy_masked = hp.ma(map_cmblegacy[0])
-                map_cmblegacy_masked.mask = np.logical_not(mask_)
-                mono = hp.fit_monopole(map_cmblegacy_masked)
-                click.echo(f"{method} subtracting monopole {mono}")
-                map_cmblegacy[0] = map_cmblegacy[0] - mono #np.mean(map_cmblegacy,axis=1).reshape(-1,1)
-
-                hp.write_map(f"{procver}/diffs/BP_cmb_diff_{method}_{procver}.fits", np.array(map_BP-map_cmblegacy), overwrite=True, column_names=["I_DIFF", "Q_DIFF", "U_DIFF"], dtype=None)
-
-        except Exception as e:
-            print(e)
-            click.secho("Continuing...",fg="yellow")
+        inputs = [f"{procver}/BP_cmb_IQU_n1024_{procver}.fits"]
+        outputs = [f"{procver}/diffs/BP_cmb_diff_{method}_{procver}.fits" for method in ("commander", "sevem", "nilc", "smica")]
+        add("diffcmb", release_diffcmb, deps=["cmb"], memory=release_memory(2048, 6), inputs=inputs, outputs=outputs, procver=procver, cache=cache)
 
     if goodness:
-        import healpy as hp
         path_goodness = procver + "/goodness"
         Path(path_goodness).mkdir(parents=True, exist_ok=True)
         print("PATH", path_goodness)
@@ -668,34 +703,40 @@ def release(ctx, chain, burnin, procver, resamp, copy_, freqmaps, ame, ff, cmb,
         cmin = int(os.path.split(chains[0])[0].rsplit("_c")[-1])
         cmax = int(os.path.split(chains[-1])[0].rsplit("_c")[-1])
         chdir = os.path.split(chains[0])[0].rsplit("_", 1)[0]
+        # Residuals and chisq are read from fits files in the chain directories
+        inputs = list(chains) + [os.path.split(c)[0] or "." for c in chains]
+        # Samples are read on a process pool for each product, see fits_handler
+        if readnproc == None:
+            readnproc = nproc
  
         if chisq:
-            try:
-                format_fits(
-                    chains,
-                    extname="CHISQ",
-                    types=["I_MEAN", "P_MEAN",],
-                    units=["NONE", "NONE",],
-                    nside=16,
-                    burnin=burnin,
-                    maxchain=maxchain,
-                    polar=True,
-                    component="CHISQ",
-                    fwhm=0.0,
-                    nu_ref_t="NONE",
-                    nu_ref_p="NONE",
-                    procver=procver,
-                    filename=f'goodness/BP_chisq_n16_{procver}.fits',
-                    bndctr=None,
-                    restfreq=None,
-                    bndwid=None,
-                    cmin=cmin,
-                    cmax=cmax,
-                    chdir=chdir,
-                )
-            except Exception as e:
-                print(e)
-                click.secho("Continuing...",fg="yellow")
+            add(
+                "chisq",
+                format_fits,
+                memory=release_memory(16, 2),
+                inputs=inputs,
+                chain=chains,
+                extname="CHISQ",
+                types=["I_MEAN", "P_MEAN",],
+                units=["NONE", "NONE",],
+                nside=16,
+                burnin=burnin,
+                maxchain=maxchain,
+                polar=True,
+                component="CHISQ",
+                fwhm=0.0,
+                nu_ref_t="NONE",
+                nu_ref_p="NONE",
+                procver=procver,
+                filename=f'goodness/BP_chisq_n16_{procver}.fits',
+                bndctr=None,
+                restfreq=None,
+                bndwid=None,
+                cmin=cmin,
+                cmax=cmax,
+                chdir=chdir,
+                nproc=readnproc,
+            )
                 
         if res:
             click.echo("Save and format chisq map and residual maps")        
@@ -825,36 +866,40 @@ def release(ctx, chain, burnin, procver, resamp, copy_, freqmaps, ame, ff, cmb,
                 for l in b["sig"]:
                     types.append(f'{l}_STDDEV')
                     units.append(b["unit"])
-                try:
-                    format_fits(
-                        chains,
-                        extname="FREQBAND_RES",
-                        types=types,
-                        units=units, 
-                        nside=b["nside"],
-                        burnin=burnin,
-                        maxchain=maxchain,
-                        polar=True,
-                        component=label,
-                        fwhm=b["fwhm"],
-                        nu_ref_t="NONE",
-                        nu_ref_p="NONE",
-                        procver=procver,
-                        filename=f'goodness/BP_res_{label}_{b["sig"]}_n{b["nside"]}_{b["fwhm"]}arcmin_{b["unit"]}_{procver}.fits',
-                        bndctr=None,
-                        restfreq=None,
-                        bndwid=None,
-                        cmin=cmin,
-                        cmax=cmax,
-                        chdir=chdir,
-                        fields=b["fields"],
-                        scale=b["scale"],
-                    )
-                except Exception as e:
-                    print(e)
-                    click.secho("Continuing...",fg="yellow")
+                add(
+                    f"res_{label}",
+                    format_fits,
+                    memory=release_memory(b["nside"], len(types)),
+                    inputs=inputs,
+                    chain=chains,
+                    extname="FREQBAND_RES",
+                    types=types,
+                    units=units, 
+                    nside=b["nside"],
+                    burnin=burnin,
+                    maxchain=maxchain,
+                    polar=True,
+                    component=label,
+                    fwhm=b["fwhm"],
+                    nu_ref_t="NONE",
+                    nu_ref_p="NONE",
+                    procver=procver,
+                    filename=f'goodness/BP_res_{label}_{b["sig"]}_n{b["nside"]}_{b["fwhm"]}arcmin_{b["unit"]}_{procver}.fits',
+                    bndctr=None,
+                    restfreq=None,
+                    bndwid=None,
+                    cmin=cmin,
+                    cmax=cmax,
+                    chdir=chdir,
+                    nproc=readnproc,
+                    fields=b["fields"],
+                    scale=b["scale"],
+                )
+
+    manifest = Manifest(f"{procver}/release_manifest.json")
+    fresh = None if force else lambda name: manifest.fresh(tasks[name])
+    run_tasks(tasks, nproc, memory, fresh=fresh, done=lambda name: manifest.update(tasks[name]))
 
-            
     """ As implemented by Simone
     """
     if br and resamp:
@@ -885,3 +930,114 @@ def release(ctx, chain, burnin, procver, resamp, copy_, freqmaps, ame, ff, cmb,
     if plot:
         os.chdir(procver)
         ctx.invoke(plotrelease, procver=procver, all_=True)
+
+
+def release_memory(nside, nmaps):
+    """
+    Rough peak memory in GB of a release product of nmaps maps at nside,
+    holding a sample and its running mean and variance (the output is
+    written as it is computed).
+    """
+    return 3 * nmaps * 12 * nside ** 2 * 8 / 1024**3
+
+
+def release_copies(chains, procver, resamp, pol):
+    """
+    Names of the copies of chains made by release_copy.
+    """
+    if resamp:
+        return [f"{procver}/BP_c" + str(i).zfill(4) + f"_{pol}resamp_{procver}.h5" for i in range(1, len(chains) + 1)]
+    return [f"{procver}/BP_c" + str(i).zfill(4) + f"_{procver}.h5" for i in range(1, len(chains) + 1)]
+
+
+def release_copy(chainfile, copyfile, param=None, mode="full", burnin=0, datasets=None, compression=None):
+    """
+    Copies chainfile to copyfile with h5copy, and if param is given, the
+    Commander3 parameter file in its directory to param.
+    """
+    import shutil
+
+    # Commander3 parameter file for main chain
+    if param != None:
+        path = os.path.split(chainfile)[0]
+        for file in os.listdir(path or "."):
+            if file.startswith("param"):
+                click.echo(f"Copying {os.path.join(path, file)} to {param}")
+                shutil.copyfile(os.path.join(path, file), param)
+
+    # Full-mission Gibbs chain file, or resampled CMB-only one with Cls (for BR estimator)
+    click.echo(f"Copying {chainfile} to {copyfile} ({mode})")
+    h5copy(chainfile, copyfile, mode, min=burnin, datasets=datasets, compression=compression)
+
+
+def release_diff(procver, cache=None):
+    """
+    Differences of the release frequency maps to dx12 and npipe, at 60 arcmin.
+    """
+    import healpy as hp
+    from src.sht import smoothing
+
+    if not os.path.exists("diffs"):
+        os.mkdir("diffs")
+    click.echo("Creating frequency difference maps")
+    path_dx12 = "/mn/stornext/u3/trygvels/compsep/cdata/like/BP_releases/dx12"
+    path_npipe = "/mn/stornext/u3/trygvels/compsep/cdata/like/BP_releases/npipe"
+    maps_dx12 = ["30ghz_2018_n1024_beamscaled_dip.fits","44ghz_2018_n1024_beamscaled_dip.fits","70ghz_2018_n1024_beamscaled_dip.fits"]
+    maps_npipe = ["npipe6v20_030_map_uK.fits", "npipe6v20_044_map_uK.fits", "npipe6v20_070_map_uK.fits",]
+    maps_BP = [f"BP_030_IQU_n0512_{procver}.fits", f"BP_044_IQU_n0512_{procver}.fits", f"BP_070_IQU_n1024_{procver}.fits",]
+    beamscaling = [9.8961854E-01, 9.9757886E-01, 9.9113965E-01]
+    for i, freq in enumerate(["030", "044", "070",]):
+        map_BP    = hp.read_map(f"{procver}/{maps_BP[i]}", field=(0,1,2), verbose=False, dtype=None)
+        
+        #dx12 dipole values:
+        # 3362.08 pm 0.99, 264.021 pm 0.011, 48.253 ± 0.005
+        # 233.18308357  2226.43833645 -2508.42179665
+        #dipole_dx12 = -3362.08*hp.dir2vec(264.021, 48.253, lonlat=True)
+
+        #map_dx12  = map_dx12/beamscaling[i]
+        # Smooth to 60 arcmin
+        # and ud_grade 30 and 44ghz to nside 512
+        map_BP = smoothing(map_BP, 60.0)
+        # Reference maps never change, so with a cache are smoothed once
+        map_npipe = reference_map(f"{path_npipe}/{maps_npipe[i]}", 60.0, nside=512 if i<2 else None, monopole=True, cache=cache)
+        map_dx12 = reference_map(f"{path_dx12}/{maps_dx12[i]}", 60.0, nside=512 if i<2 else None, monopole=True, cache=cache)
+
+        # Remove monopoles
+        map_BP -= np.mean(map_BP,axis=1).reshape(-1,1)
+
+        hp.write_map(f"{procver}/diffs/BP_{freq}_diff_npipe_{procver}.fits", np.array(map_BP-map_npipe), overwrite=True, column_names=["I_DIFF", "Q_DIFF", "U_DIFF"], dtype=None)
+        hp.write_map(f"{procver}/diffs/BP_{freq}_diff_dx12_{procver}.fits", np.array(map_BP-map_dx12), overwrite=True, column_names=["I_DIFF", "Q_DIFF", "U_DIFF"], dtype=None)
+
+
+def release_diffcmb(procver, cache=None):
+    """
+    Differences of the release cmb map to the Planck 2018 cmb maps, at 60 arcmin.
+    """
+    import healpy as hp
+    from src.sht import smoothing
+
+    if not os.path.exists("diffs"):
+        os.mkdir("diffs")
+    click.echo("Creating cmb difference maps")
+    path_cmblegacy = "/mn/stornext/u3/trygvels/compsep/cdata/like/BP_releases/cmb-legacy"
+    mask = "/mn/stornext/u3/trygvels/compsep/cdata/like/BP_releases/masks/dx12_v3_common_mask_int_005a_1024_TQU.fits"
+    mask_ = hp.read_map(mask, verbose=False, dtype=np.bool,)
+    map_BP = hp.read_map(f"{procver}/BP_cmb_IQU_n1024_{procver}.fits", field=(0,1,2), verbose=False, dtype=None,)
+    map_BP_masked = hp.ma(map_BP[0])
+    map_BP_masked.mask = np.logical_not(mask_)
+    mono, dip = hp.fit_dipole(map_BP_masked)
+    nside = 1024
+    ray = range(hp.nside2npix(nside))
+    vecs = hp.pix2vec(nside, ray)
+    dipole = np.dot(dip, vecs)
+    map_BP[0] = map_BP[0] - dipole - mono
+    map_BP = smoothing(map_BP, np.sqrt(60.0**2-14**2))
+    #map_BP -= np.mean(map_BP,axis=1).reshape(-1,1)
+    for i, method in enumerate(["commander", "sevem", "nilc", "smica",]):
+
+        data = f"COM_CMB_IQU-{method}_2048_R3.00_full.fits"
+        click.echo(f"making difference map with {data}")
+        # Smoothed, in uK and with monopoles removed, once with a cache
+        map_cmblegacy = reference_map(f"{path_cmblegacy}/{data}", 60.0, nside=1024, scale=1e6, monopole=True, mask=mask, cache=cache)
+
+        hp.write_map(f"{procver}/diffs/BP_cmb_diff_{method}_{procver}.fits", np.array(map_BP-map_cmblegacy), overwrite=True, column_names=["I_DIFF", "Q_DIFF", "U_DIFF"], dtype=None)
@@ -488,6 +488,7 @@ def plotrelease(ctx, procver, mask, defaultmask, freqmaps, cmb, cmbresamp, synch
         print("Plotting sky model SED spectrum")
         print("Reading data")
         import healpy as hp
+        from src.sht import smoothing
         maskpath="/mn/stornext/u3/trygvels/compsep/cdata/like/sky-model/masks"
         fg_path="/mn/stornext/u3/trygvels/compsep/cdata/like/sky-model/fgs_60arcmin"
         
@@ -497,7 +498,7 @@ def plotrelease(ctx, procver, mask, defaultmask, freqmaps, cmb, cmbresamp, synch
         b_s = hp.read_map(f"BP_synch_IQU_n1024_{procver}.fits", field=(4,5), dtype=None, verbose=False)
         
         a_ff = hp.read_map(f"BP_freefree_I_n1024_{procver}.fits", field=(0,), dtype=None, verbose=False)
-        a_ff = hp.smoothing(a_ff, fwhm=arcmin2rad(np.sqrt(60.0**2-30**2)), verbose=False)
+        a_ff = smoothing(a_ff, np.sqrt(60.0**2-30**2))
         t_e  = hp.read_map(f"BP_freefree_I_n1024_{procver}.fits", field=(1,), dtype=None, verbose=False)
         
         a_ame1 = hp.read_map(f"BP_ame_I_n1024_{procver}.fits", field=(0,), dtype=None, verbose=False)
@@ -507,7 +508,7 @@ def plotrelease(ctx, procver, mask, defaultmask, freqmaps, cmb, cmbresamp, synch
         a_ame2 = None
         
         a_d = hp.read_map(f"BP_dust_IQU_n1024_{procver}.fits", field=(0,1,2), dtype=None, verbose=False)
-        a_d = hp.smoothing(a_d, fwhm=arcmin2rad(np.sqrt(60.0**2-10**2)), verbose=False)
+        a_d = smoothing(a_d, np.sqrt(60.0**2-10**2))
         b_d = hp.read_map(f"BP_dust_IQU_n1024_{procver}.fits", field=(4,5,), dtype=None, verbose=False)                                
         t_d = hp.read_map(f"BP_dust_IQU_n1024_{procver}.fits", field=(6,7,), dtype=None, verbose=False)                                
         
@@ -557,14 +558,18 @@ def hist(chainfile, dataset, burnin, maxchain, nbins,sig, prior):
     import healpy as hp
     import pandas as pd
     from tqdm import tqdm
+    from src.chainindex import ChainIndex
     dats = []
     for c in range(1, maxchain + 1):
         chainfile_ = chainfile.replace("c0001", "c" + str(c).zfill(4))
         min_=burnin if c>1 else 0
+        samples = [sample for sample in ChainIndex(chainfile_).samples if sample >= min_]
+        if not samples:
+            print(f"No samples from {min_} on in {chainfile_}. Exiting")
+            sys.exit()
         with h5py.File(chainfile_, "r") as f:
-            max_ = len(f.keys()) - 1
-            print("{:-^48}".format(f" Samples {min_} to {max_} in {chainfile_} "))
-            for sample in tqdm(range(min_, max_ + 1), ncols=80):
+            print("{:-^48}".format(f" Samples {min_} to {samples[-1]} in {chainfile_} "))
+            for sample in tqdm(samples, ncols=80):
                 # Identify dataset
                 # HDF dataset path formatting
                 s = str(sample).zfill(6)
@@ -713,14 +718,18 @@ def pixreg2trace(chainfile, dataset, burnin, maxchain, plot, freeze, nbins, prio
     import healpy as hp
     import pandas as pd
     from tqdm import tqdm
+    from src.chainindex import ChainIndex
     dats = []
     for c in range(1, maxchain + 1):
         chainfile_ = chainfile.replace("c0001", "c" + str(c).zfill(4))
         min_=burnin if c>1 else 0
+        samples = [sample for sample in ChainIndex(chainfile_).samples if sample >= min_]
+        if not samples:
+            print(f"No samples from {min_} on in {chainfile_}. Exiting")
+            sys.exit()
         with h5py.File(chainfile_, "r") as f:
-            max_ = len(f.keys()) - 1
-            print("{:-^48}".format(f" Samples {min_} to {max_} in {chainfile_} "))
-            for sample in tqdm(range(min_, max_ + 1), ncols=80):
+            print("{:-^48}".format(f" Samples {min_} to {samples[-1]} in {chainfile_} "))
+            for sample in tqdm(samples, ncols=80):
                 # Identify dataset
                 # HDF dataset path formatting
                 s = str(sample).zfill(6)
@@ -923,7 +932,6 @@ def make_diff_plots(ctx, dir1, dir2, type1, type2):
     filenames = {dir1:'', dir2:''}
 
     import glob
-    import healpy as hp
 
 
     for dirtype, dirloc in zip([type1, type2],[dir1, dir2]):
@@ -952,8 +960,8 @@ def make_diff_plots(ctx, dir1, dir2, type1, type2):
                     mapn[dirloc] = 'tod_' + comp + '_map' + filenames[dirloc]
       
         print(mapn) 
-        map1 = hp.read_map(os.path.join(dir1, mapn[dir1]))
-        map2 = hp.read_map(os.path.join(dir2, mapn[dir2]))
+        map1 = reference_map(os.path.join(dir1, mapn[dir1]), field=0)
+        map2 = reference_map(os.path.join(dir2, mapn[dir2]), field=0)
 
         diff_map = map1 - map2 
   
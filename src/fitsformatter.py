@@ -6,32 +6,38 @@ import healpy as hp
 from src.tools import *
 
 
-def format_fits(chain, extname, types, units, nside, burnin, maxchain, polar, component, fwhm, nu_ref_t, nu_ref_p, procver, filename, bndctr, restfreq, bndwid, cmin=1, cmax=None, chdir=None, fields=None, scale=1.):
+def format_fits(chain, extname, types, units, nside, burnin, maxchain, polar, component, fwhm, nu_ref_t, nu_ref_p, procver, filename, bndctr, restfreq, bndwid, cmin=1, cmax=None, chdir=None, fields=None, scale=1., dtype=np.float32, archive=False, nproc=1):
     print()
     print("{:#^80}".format(""))
     print("{:#^80}".format(f" Formatting and outputting {filename} "))
     print("{:#^80}".format(""))
 
     header = get_header(extname, types, units, nside, polar, component, fwhm, nu_ref_t, nu_ref_p, procver, filename, bndctr, restfreq, bndwid,)
-    dset = get_data(chain, extname, component, burnin, maxchain, fwhm, nside, types, cmin, cmax, chdir, fields, scale)
-
-    print(f"{procver}/{filename}", dset.shape)
-    hp.write_map(f"{procver}/{filename}", dset, column_names=types, column_units=units, coord="G", overwrite=True, extra_header=header, dtype=None)
-
-
-def get_data(chain, extname, component, burnin, maxchain, fwhm, nside, types, cmin, cmax, chdir, fields=None, scale=1.0):
+    # Columns go to disk as they are computed, cast to dtype
+    from src.fitsmap import MapWriter
+    with MapWriter(f"{procver}/{filename}", nside, types, units, dtype=dtype, coord="G", extra_header=header, archive=archive) as dset:
+        print(f"{procver}/{filename}", dset.shape)
+        get_data(chain, extname, component, burnin, maxchain, fwhm, nside, types, cmin, cmax, chdir, fields, scale, dset=dset, nproc=nproc)
+
+
+def get_data(chain, extname, component, burnin, maxchain, fwhm, nside, types, cmin, cmax, chdir, fields=None, scale=1.0, dset=None, nproc=1):
+    """
+    Columns types of the product, computed in double precision and
+    assigned to dset (a MapWriter, or a new array if None) one at a time.
+    Residual and chisq samples are read on nproc processes.
+    """
+    if dset is None:
+        dset = np.zeros((len(types), hp.nside2npix(nside)))
     if extname.endswith("CMB"):
-        # Mean data
-        amp_mean = h5handler(input=chain, dataset="cmb/amp_alm", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=fwhm, nside=nside, command=np.mean,)
-
-        # stddev data
-        amp_stddev = h5handler(input=chain, dataset="cmb/amp_alm", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=fwhm, nside=nside, command=np.std,)
+        # Mean and stddev data
+        amp_mean, amp_stddev = h5reduce(chain, [
+            ("cmb/amp_alm", (np.mean, np.std), fwhm, nside),
+        ], min=burnin, max=None, maxchain=maxchain,)[0]
 
         # Masks
         mask1 = np.zeros((hp.nside2npix(nside)))
         mask2 = np.zeros((hp.nside2npix(nside)))
 
-        dset = np.zeros((len(types), hp.nside2npix(nside)))
         dset[0] = amp_mean[0, :]
         dset[1] = amp_mean[1, :]
         dset[2] = amp_mean[2, :]
@@ -44,37 +50,30 @@ def get_data(chain, extname, component, burnin, maxchain, fwhm, nside, types, cm
         dset[7] = mask2
 
     if extname.endswith("RESAMP-T"):
-        # Mean data
-        amp_mean = h5handler(input=chain, dataset="cmb/amp_alm", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=fwhm, nside=nside, command=np.mean,)
-
-        # stddev data
-        amp_stddev = h5handler(input=chain, dataset="cmb/amp_alm", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=fwhm, nside=nside, command=np.std,)
+        # Mean and stddev data
+        amp_mean, amp_stddev = h5reduce(chain, [
+            ("cmb/amp_alm", (np.mean, np.std), fwhm, nside),
+        ], min=burnin, max=None, maxchain=maxchain,)[0]
 
-        dset = np.zeros((len(types), hp.nside2npix(nside)))
         dset[0] = amp_mean
         dset[1] = amp_stddev
     elif extname.endswith("RESAMP-P"):
-        # Mean data
-        amp_mean = h5handler(input=chain, dataset="cmb_lowl/amp_alm", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=fwhm, nside=nside, command=np.mean,)
+        # Mean and stddev data
+        amp_mean, amp_stddev = h5reduce(chain, [
+            ("cmb_lowl/amp_alm", (np.mean, np.std), fwhm, nside),
+        ], min=burnin, max=None, maxchain=maxchain,)[0]
 
-        # stddev data
-        amp_stddev = h5handler(input=chain, dataset="cmb_lowl/amp_alm", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=fwhm, nside=nside, command=np.std,)
-
-        dset = np.zeros((len(types), hp.nside2npix(nside)))
         dset[0] = amp_mean[0,:]
         dset[1] = amp_mean[1,:]
         dset[2] = amp_stddev[0,:]
         dset[3] = amp_stddev[1,:]
     elif extname.endswith("SYNCHROTRON"):
-        # Mean data
-        amp_mean = h5handler(input=chain, dataset="synch/amp_alm", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=fwhm, nside=nside, command=np.mean,)
-        beta_mean = h5handler(input=chain, dataset="synch/beta_map", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=0.0, nside=nside, command=np.mean,)
+        # Mean and stddev data
+        (amp_mean, amp_stddev), (beta_mean, beta_stddev) = h5reduce(chain, [
+            ("synch/amp_alm", (np.mean, np.std), fwhm, nside),
+            ("synch/beta_map", (np.mean, np.std), 0.0, nside),
+        ], min=burnin, max=None, maxchain=maxchain,)
 
-        # stddev data
-        amp_stddev = h5handler(input=chain, dataset="synch/amp_alm", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=fwhm, nside=nside, command=np.std,)
-        beta_stddev = h5handler(input=chain, dataset="synch/beta_map", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=0.0, nside=nside, command=np.std,)
-
-        dset = np.zeros((len(types), hp.nside2npix(nside)))
 
         dset[0] = amp_mean[0, :]
         dset[1] = amp_mean[1, :]
@@ -93,17 +92,13 @@ def get_data(chain, extname, component, burnin, maxchain, fwhm, nside, types, cm
         dset[11] = beta_stddev[1, :]
 
     elif extname.endswith("DUST"):
-        # Mean data
-        amp_mean = h5handler(input=chain, dataset="dust/amp_alm", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=fwhm, nside=nside, command=np.mean,)
-        beta_mean = h5handler(input=chain, dataset="dust/beta_map", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=0.0, nside=nside, command=np.mean,)
-        T_mean = h5handler(input=chain, dataset="dust/T_map", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=0.0, nside=nside, command=np.mean,)
+        # Mean and stddev data
+        (amp_mean, amp_stddev), (beta_mean, beta_stddev), (T_mean, T_stddev) = h5reduce(chain, [
+            ("dust/amp_alm", (np.mean, np.std), fwhm, nside),
+            ("dust/beta_map", (np.mean, np.std), 0.0, nside),
+            ("dust/T_map", (np.mean, np.std), 0.0, nside),
+        ], min=burnin, max=None, maxchain=maxchain,)
 
-        # stddev data
-        amp_stddev = h5handler(input=chain, dataset="dust/amp_alm", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=fwhm, nside=nside, command=np.std,)
-        beta_stddev = h5handler(input=chain, dataset="dust/beta_map", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=0.0, nside=nside, command=np.std,)
-        T_stddev = h5handler(input=chain, dataset="dust/T_map", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=0.0, nside=nside, command=np.std,)
-
-        dset = np.zeros((len(types), hp.nside2npix(nside)))
 
         dset[0] = amp_mean[0, :]
         dset[1] = amp_mean[1, :]
@@ -128,15 +123,12 @@ def get_data(chain, extname, component, burnin, maxchain, fwhm, nside, types, cm
         dset[15] = T_stddev[1, :]
 
     elif extname.endswith("FREE-FREE"):
-        # Mean data
-        amp_mean = h5handler(input=chain, dataset="ff/amp_alm", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=fwhm, nside=nside, command=np.mean,)
-        Te_mean = h5handler(input=chain, dataset="ff/Te_map", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=0.0, nside=nside, command=np.mean,)
-
-        # stddev data
-        amp_stddev = h5handler(input=chain, dataset="ff/amp_alm", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=fwhm, nside=nside, command=np.std,)
-        Te_stddev = h5handler(input=chain, dataset="ff/Te_map", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=0.0, nside=nside, command=np.std,)
+        # Mean and stddev data
+        (amp_mean, amp_stddev), (Te_mean, Te_stddev) = h5reduce(chain, [
+            ("ff/amp_alm", (np.mean, np.std), fwhm, nside),
+            ("ff/Te_map", (np.mean, np.std), 0.0, nside),
+        ], min=burnin, max=None, maxchain=maxchain,)
 
-        dset = np.zeros((len(types), hp.nside2npix(nside)))
 
         dset[0] = amp_mean
         dset[1] = Te_mean
@@ -145,15 +137,12 @@ def get_data(chain, extname, component, burnin, maxchain, fwhm, nside, types, cm
         dset[3] = Te_stddev
 
     elif extname.endswith("AME"):
-        # Mean data
-        amp_mean = h5handler(input=chain, dataset="ame/amp_alm", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=fwhm, nside=nside, command=np.mean,)
-        nu_p_mean = h5handler(input=chain, dataset="ame/nu_p_map", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=0.0, nside=nside, command=np.mean,)
-
-        # stddev data
-        amp_stddev = h5handler(input=chain, dataset="ame/amp_alm", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=fwhm, nside=nside, command=np.std,)
-        nu_p_stddev = h5handler(input=chain, dataset="ame/nu_p_map", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=0.0, nside=nside, command=np.std,)
+        # Mean and stddev data
+        (amp_mean, amp_stddev), (nu_p_mean, nu_p_stddev) = h5reduce(chain, [
+            ("ame/amp_alm", (np.mean, np.std), fwhm, nside),
+            ("ame/nu_p_map", (np.mean, np.std), 0.0, nside),
+        ], min=burnin, max=None, maxchain=maxchain,)
 
-        dset = np.zeros((len(types), hp.nside2npix(nside)))
 
         dset[0] = amp_mean
         dset[1] = nu_p_mean
@@ -162,15 +151,15 @@ def get_data(chain, extname, component, burnin, maxchain, fwhm, nside, types, cm
         dset[3] = nu_p_stddev
 
     if extname.endswith("FREQMAP"):
-        # Mean data
-        amp_mean = h5handler(input=chain, dataset=f"tod/{component}/map", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=fwhm, nside=nside, command=np.mean,)
-        amp_rms  = h5handler(input=chain, dataset=f"tod/{component}/rms", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=fwhm, nside=nside, command=np.mean,)
-        # stddev data
-        amp_stddev = h5handler(input=chain, dataset=f"tod/{component}/map", min=burnin, max=None, maxchain=maxchain, output="map", fwhm=120., nside=nside, command=np.std,)
+        # Mean, rms and stddev data
+        amp_mean, amp_rms, amp_stddev = h5reduce(chain, [
+            (f"tod/{component}/map", np.mean, fwhm, nside),
+            (f"tod/{component}/rms", np.mean, fwhm, nside),
+            (f"tod/{component}/map", np.std, 120., nside),
+        ], min=burnin, max=None, maxchain=maxchain,)
 
         # Masks
 
-        dset = np.zeros((len(types), hp.nside2npix(nside)))
 
         dset[0] = amp_mean[0, :]
         dset[1] = amp_mean[1, :]
@@ -186,9 +175,7 @@ def get_data(chain, extname, component, burnin, maxchain, fwhm, nside, types, cm
 
     if extname.endswith("RES"):
         N = len(types)
-        amp_mean = fits_handler(input=f"res_{component}_c0001_k000001.fits", min=burnin, max=None, minchain=cmin, maxchain=cmax, chdir=chdir, output="map", fwhm=fwhm, nside=nside, zerospin=False, drop_missing=True, pixweight=False, command=np.mean, lowmem=False, fields=fields, write=False)
-        amp_stddev = fits_handler(input=f"res_{component}_c0001_k000001.fits", min=burnin, max=None, minchain=cmin, maxchain=cmax, chdir=chdir, output="map", fwhm=fwhm, nside=nside, zerospin=False, drop_missing=True, pixweight=False, command=np.std, lowmem=False, fields=fields, write=False)
-        dset = np.zeros((N, hp.nside2npix(nside)))
+        amp_mean, amp_stddev = fits_handler(input=f"res_{component}_c0001_k000001.fits", min=burnin, max=None, minchain=cmin, maxchain=cmax, chdir=chdir, output="map", fwhm=fwhm, nside=nside, zerospin=False, drop_missing=True, pixweight=False, command=(np.mean, np.std), lowmem=False, fields=fields, write=False, nproc=nproc)
         print(amp_mean.shape, amp_stddev.shape)
         if len(fields)>1:
             dset[:N//2] = amp_mean[fields, :]*scale
@@ -199,10 +186,9 @@ def get_data(chain, extname, component, burnin, maxchain, fwhm, nside, types, cm
 
     if extname.endswith("CHISQ"):
         
-        amp_mean = fits_handler(input="chisq_c0001_k000001.fits", min=burnin, max=None, minchain=cmin, maxchain=cmax, chdir=chdir, output="map", fwhm=fwhm, nside=nside, zerospin=False, drop_missing=True, pixweight=False, command=np.mean, lowmem=False, write=False)
+        amp_mean = fits_handler(input="chisq_c0001_k000001.fits", min=burnin, max=None, minchain=cmin, maxchain=cmax, chdir=chdir, output="map", fwhm=fwhm, nside=nside, zerospin=False, drop_missing=True, pixweight=False, command=np.mean, lowmem=False, write=False, nproc=nproc)
         #amp_stddev = fits_handler(input="chisq_c0001_k000001.fits", min=burnin, max=None, minchain=cmin, maxchain=cmax, chdir=chdir, output="map", fwhm=fwhm, nside=nside, zerospin=False, drop_missing=True, pixweight=False, command=np.std, lowmem=False, write=False)
 
-        dset = np.zeros((len(types), hp.nside2npix(nside)))
 
         dset[0] = amp_mean[0, :]
         dset[1] = amp_mean[1, :]+amp_mean[2, :]
@@ -0,0 +1,263 @@
+"""
+Fast reader for HEALPix fits maps, as hp.read_map. The header of the
+map extension is parsed once per distinct header (nside, columns,
+ordering, ...), and the binary table is memory-mapped, so only the
+requested columns are decoded, in their own dtype. Maps healpy stores
+otherwise (partial sky, scaled columns) are read by hp.read_map.
+MapWriter writes such maps one column at a time.
+"""
+import os
+import functools
+import numpy as np
+
+BLOCK = 2880
+CARD = 80
+# Binary table formats read directly, all others go through healpy
+FORMATS = {"B": "u1", "I": ">i2", "J": ">i4", "K": ">i8", "E": ">f4", "D": ">f8"}
+
+
+def read_map(filename, field=(0,), nest=False, h=False, out=None):
+    """
+    Maps in columns field (all if None) of filename, as hp.read_map(filename,
+    field, nest=nest, h=h, dtype=None). A single field gives a map, several
+    a (nfield, npix) array, which is written to out if given.
+    """
+    header, offset = read_header(filename)
+    table = layout(header)
+    if table == None:
+        import healpy as hp
+        return hp.read_map(filename, field=field, nest=nest, h=h, dtype=None, verbose=False)
+
+    if field == None:
+        field = range(len(table["names"]))
+    single = not isinstance(field, (tuple, list, range))
+    fields = [field] if single else list(field)
+    dtypes = [np.dtype(table["dtypes"][f]).newbyteorder("=") for f in fields]
+    if out is None:
+        out = np.empty((len(fields), table["npix"]), dtype=np.result_type(*dtypes))
+
+    rows = np.memmap(filename, dtype=table["rows"], mode="r", offset=offset, shape=(table["nrows"],))
+    for i, f in enumerate(fields):
+        # Byte swapped on the way into out
+        out[i] = rows[table["names"][f]].reshape(-1)
+    del rows
+
+    if nest != None and table["nest"] != None and nest != table["nest"]:
+        import healpy as hp
+        nside = hp.npix2nside(table["npix"])
+        pix = np.arange(table["npix"])
+        out[:] = out[:, hp.nest2ring(nside, pix) if nest else hp.ring2nest(nside, pix)]
+    if out.dtype.kind == "f":
+        import healpy as hp
+        out[hp.mask_bad(out)] = hp.UNSEEN
+
+    m = out[0] if single or len(fields) == 1 else out
+    if h:
+        return m, list(table["header"])
+    return m
+
+
+def header(filename):
+    """
+    Keywords and values of the map extension's header, as returned by
+    hp.read_map(filename, h=True), without reading the map.
+    """
+    return list(parse(read_header(filename)[0]).items())
+
+
+def read_header(filename):
+    """
+    Raw header of the first extension of filename, and the offset of its data.
+    """
+    with open(filename, "rb") as f:
+        primary, size = read_cards(f), 0
+        cards = parse(primary)
+        if cards.get("NAXIS", 0) > 0:
+            size = abs(cards["BITPIX"]) // 8
+            for i in range(cards["NAXIS"]):
+                size *= cards[f"NAXIS{i+1}"]
+        f.seek(len(primary) + -(-size // BLOCK) * BLOCK)
+        header = read_cards(f)
+        return header, f.tell()
+
+
+def read_cards(f):
+    """
+    Header blocks from the current position of f up to the END card.
+    """
+    blocks = []
+    while True:
+        block = f.read(BLOCK)
+        if len(block) < BLOCK:
+            raise OSError(f"Truncated fits header in {f.name}")
+        blocks.append(block)
+        for i in range(0, BLOCK, CARD):
+            if block[i:i+8] == b"END     ":
+                return b"".join(blocks)
+
+
+def parse(header):
+    """
+    Keywords and values of the cards in a raw header, in order.
+    """
+    cards = {}
+    for i in range(0, len(header), CARD):
+        card = header[i:i+CARD].decode("ascii", "replace")
+        key = card[:8].strip()
+        if key == "END":
+            break
+        if card[8:10] != "= ":
+            continue
+        value = card[10:].strip()
+        if value.startswith("'"):
+            end = value.find("'", 1)
+            while end > 0 and value[end+1:end+2] == "'":
+                end = value.find("'", end + 2)
+            value = value[1:end].replace("''", "'").rstrip()
+        else:
+            value = value.split("/")[0].strip()
+            if value in ("T", "F"):
+                value = value == "T"
+            else:
+                try:
+                    value = int(value)
+                except ValueError:
+                    try:
+                        value = float(value.replace("D", "E"))
+                    except ValueError:
+                        pass
+        cards[key] = value
+    return cards
+
+
+@functools.lru_cache(maxsize=64)
+def layout(header):
+    """
+    Row dtype, column names and dtypes, npix and ordering of the binary
+    table described by a raw header, or None if it is not a full sky
+    HEALPix map with plain columns.
+    """
+    cards = parse(header)
+    if cards.get("XTENSION") != "BINTABLE" or cards.get("PCOUNT", 0) != 0:
+        return None
+    if cards.get("OBJECT", "FULLSKY") == "PARTIAL" or cards.get("INDXSCHM", "IMPLICIT") == "EXPLICIT":
+        return None
+
+    names, dtypes, formats = [], [], []
+    for i in range(1, cards["TFIELDS"] + 1):
+        if f"TSCAL{i}" in cards or f"TZERO{i}" in cards:
+            return None
+        tform = str(cards[f"TFORM{i}"]).strip()
+        repeat, code = tform[:-1], tform[-1]
+        if code not in FORMATS:
+            return None
+        names.append(f"c{i}")
+        dtypes.append(FORMATS[code])
+        formats.append((FORMATS[code], (int(repeat or 1),)))
+    rows = np.dtype({"names": names, "formats": formats})
+    if rows.itemsize != cards["NAXIS1"] or len(set(shape for dtype, shape in formats)) != 1:
+        return None
+
+    npix = cards["NAXIS2"] * formats[0][1][0]
+    nside = cards.get("NSIDE")
+    if nside != None and 12 * nside ** 2 != npix:
+        return None
+    return {
+        "rows": rows,
+        "nrows": cards["NAXIS2"],
+        "names": names,
+        "dtypes": dtypes,
+        "npix": npix,
+        "nest": None if "ORDERING" not in cards else cards["ORDERING"].startswith("NEST"),
+        "header": tuple(cards.items()),
+    }
+
+
+class MapWriter:
+    """
+    HEALPix fits map of ncol columns at nside, written column by column,
+    as hp.write_map(filename, maps, column_names=names, column_units=units,
+    coord=coord, extra_header=extra_header). The table is laid out on disk
+    up front and memory-mapped, so each column is converted to dtype and
+    written as it is assigned (writer[i] = map, or writer[i:j] = maps),
+    and only one is held in memory at a time. Columns never assigned are
+    zero, and the file is removed if its with block raises. If archive, a tile compressed (lossless GZIP_2) copy with one
+    image per column is written to filename.fz on close.
+    """
+    def __init__(self, filename, nside, names, units=None, dtype=np.float32, coord=None, extra_header=(), archive=False):
+        from astropy.io import fits
+
+        self.filename = filename
+        self.names = list(names)
+        self.units = list(units) if units else [None] * len(self.names)
+        self.dtype = np.dtype(dtype)
+        self.npix = 12 * nside ** 2
+        self.archive = archive
+        self.shape = (len(self.names), self.npix)
+        repeat = 1024 if self.npix > 1024 else 1
+        code = {"f4": "E", "f8": "D"}[self.dtype.str[1:]]
+
+        cols = [fits.Column(name=name, format=f"{repeat}{code}", unit=unit) for name, unit in zip(self.names, self.units)]
+        header = fits.BinTableHDU.from_columns(cols, nrows=0).header
+        header["NAXIS2"] = self.npix // repeat
+        header["PIXTYPE"] = ("HEALPIX", "HEALPIX pixelisation")
+        header["ORDERING"] = ("RING", "Pixel ordering scheme, either RING or NESTED")
+        if coord:
+            header["COORDSYS"] = (coord, "Ecliptic, Galactic or Celestial (equatorial)")
+        header["EXTNAME"] = ("xtension", "name of this binary table extension")
+        header["NSIDE"] = (nside, "Resolution parameter of HEALPIX")
+        header["FIRSTPIX"] = (0, "First pixel # (0 based)")
+        header["LASTPIX"] = (self.npix - 1, "Last pixel # (0 based)")
+        header["INDXSCHM"] = ("IMPLICIT", "Indexing: IMPLICIT or EXPLICIT")
+        header["OBJECT"] = ("FULLSKY", "Sky coverage, either FULLSKY or PARTIAL")
+        for args in extra_header:
+            header[args[0]] = args[1:]
+        self.header = header
+
+        head = fits.PrimaryHDU().header.tostring().encode() + header.tostring().encode()
+        size = len(self.names) * self.npix * self.dtype.itemsize
+        with open(filename, "wb") as f:
+            f.write(head)
+            # Zero filled up to the end of the last block
+            f.truncate(len(head) + -(-size // BLOCK) * BLOCK)
+        rows = np.dtype({"names": self.names, "formats": [(self.dtype.newbyteorder(">"), (repeat,))] * len(self.names)})
+        self.rows = np.memmap(filename, dtype=rows, mode="r+", offset=len(head), shape=(self.npix // repeat,))
+
+    def __setitem__(self, index, maps):
+        columns = [index] if isinstance(index, (int, np.integer)) else list(range(len(self.names)))[index]
+        maps = np.asarray(maps).reshape(len(columns), self.npix)
+        for i, m in zip(columns, maps):
+            self.rows[self.names[i]] = m.reshape(self.rows.shape[0], -1)
+
+    def close(self):
+        if self.rows is None:
+            return
+        self.rows.flush()
+        if self.archive:
+            self.write_archive()
+        self.rows = None
+
+    def write_archive(self):
+        from astropy.io import fits
+
+        hdus = [fits.PrimaryHDU()]
+        for name, unit in zip(self.names, self.units):
+            column = np.ascontiguousarray(self.rows[name]).reshape(-1)
+            hdu = fits.CompImageHDU(column, name=name, compression_type="GZIP_2", quantize_level=0.0, tile_shape=(min(self.npix, 2**20),))
+            for key in ("PIXTYPE", "ORDERING", "COORDSYS", "NSIDE", "FIRSTPIX", "LASTPIX", "INDXSCHM", "OBJECT"):
+                if key in self.header:
+                    hdu.header[key] = self.header[key]
+            if unit:
+                hdu.header["BUNIT"] = unit
+            hdus.append(hdu)
+        fits.HDUList(hdus).writeto(f"{self.filename}.fz", overwrite=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type == None:
+            self.close()
+        else:
+            self.rows = None
+            os.remove(self.filename)
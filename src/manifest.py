@@ -0,0 +1,78 @@
+import os
+import json
+
+
+class Manifest:
+    """
+    Record of how each release product was made, kept as json at path.
+    For every output file it holds the fingerprints of the task's inputs
+    (size, mtime and, for chain files, sample range), the task's
+    parameters and the c3pp version. A task is up to date if all its
+    outputs exist and were made from the same inputs and parameters.
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def record(self, task):
+        """
+        How task would be made now.
+        """
+        # Process counts and cache directories do not change the products
+        params = {"fn": task["fn"].__name__, **{k: v for k, v in task["kwargs"].items() if k not in ("nproc", "cache")}}
+        return {
+            "inputs": {path: fingerprint(path) for path in task["inputs"]},
+            # Through json, so tuples and lists compare equal
+            "params": json.loads(json.dumps(params, default=str)),
+            "version": version(),
+        }
+
+    def fresh(self, task):
+        if not task["outputs"]:
+            return False
+        record = self.record(task)
+        return all(os.path.exists(output) and self.entries.get(output) == record for output in task["outputs"])
+
+    def update(self, task):
+        record = self.record(task)
+        for output in task["outputs"]:
+            self.entries[output] = record
+        self.save()
+
+    def save(self):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+def fingerprint(path):
+    """
+    Size and mtime of path (for directories, only mtime, which changes as
+    files are added), and first and last sample of hdf chains. None if
+    path does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if os.path.isdir(path):
+        return {"mtime": stat.st_mtime_ns}
+    info = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if path.endswith(".h5"):
+        from src.chainindex import ChainIndex
+        samples = ChainIndex(path).samples
+        info["samples"] = [samples[0], samples[-1]] if samples else None
+    return info
+
+
+def version():
+    try:
+        from importlib.metadata import version
+        return version("c3pp")
+    except Exception:
+        return None
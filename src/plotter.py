@@ -7,7 +7,7 @@ import healpy as hp
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.colors as col
-from src.tools import arcmin2rad
+from src.sht import smoothing
 
 #print("Importtime:", (time.time() - totaltime))
 
@@ -51,7 +51,7 @@ def Plotter(input, dataset, nside, auto, min, max, mid, rng, colorbar,
             #### Smooth  #####
             if float(fwhm) > 0 and input[i].endswith(".fits"):
                 click.echo(click.style(f"Smoothing fits map to {fwhm} arcmin fwhm",fg="yellow"))
-                m = hp.smoothing(m, fwhm=arcmin2rad(fwhm), lmax=lmax,)
+                m = hp.ma(smoothing(m, float(fwhm), lmax=lmax,))
             #### Ud_grade #####
             if nside is not None and input[i].endswith(".fits"):
                 if nsid != nside:
@@ -515,7 +515,8 @@ def get_map(input, sig, dataset, nside, lmax, fwhm,):
                 sys.exit()
 
         elif input_.endswith(".fits"):
-            maps_, header = hp.read_map(input_, field=sig, verbose=False, h=True, dtype=None,)
+            from src.fitsmap import read_map
+            maps_, header = read_map(input_, field=sig, h=True)
             header = dict(header)
             signal_labels = []
             for i in range(int(header["TFIELDS"])):
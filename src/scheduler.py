@@ -0,0 +1,140 @@
+import os
+import time
+import traceback
+
+
+def run_tasks(tasks, nproc=1, memory=None, fresh=None, done=None):
+    """
+    Runs a graph of tasks {name: {"fn", "kwargs", "deps", "memory"}} on
+    nproc processes. A task starts once the tasks it depends on have
+    succeeded (deps missing from tasks are taken as done), and only while
+    the memory estimates (GB) of running tasks fit in memory (default all
+    of RAM). Tasks are started in the order given. A failed task skips
+    the tasks depending on it, the rest still run. Tasks for which
+    fresh(name) is true once they can start are not run, but count as
+    succeeded, and done(name) is called for every task that succeeds.
+    If a worker process dies (ex. killed for running out of memory), the
+    pool is restarted. The task running alone when it died fails, while
+    tasks that were running together are run again, one at a time, as
+    the pool does not tell which of them it was.
+    Returns {name: (status, seconds, error)}, status ok, up to date,
+    failed or skipped. The summary is printed even if a task stops run_tasks.
+    """
+    from concurrent.futures import wait, FIRST_COMPLETED
+    from concurrent.futures.process import BrokenProcessPool
+    from src.tools import process_pool
+
+    if memory == None:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3
+
+    report = {}
+    pending = list(tasks)
+    running = {}
+    # Tasks running when a worker died along with others, rerun on their own
+    suspects = set()
+    executor = process_pool(nproc) if nproc > 1 else None
+
+    def collect(future):
+        # Outcome of a finished task, None if its worker process died
+        name, start = running.pop(future)
+        try:
+            future.result()
+            report[name] = ("ok", time.time() - start, None)
+        except BrokenProcessPool:
+            return name, start
+        except (Exception, SystemExit) as e:
+            report[name] = ("failed", time.time() - start, error_message(e))
+        if done != None and report[name][0] == "ok":
+            done(name)
+        return None
+
+    try:
+        while pending or running:
+            used = sum(tasks[name]["memory"] for name, start in running.values())
+            alone = any(name in suspects for name, start in running.values())
+            progress = len(report) + len(running)
+            broken = False
+            for name in list(pending):
+                task = tasks[name]
+                deps = [dep for dep in task["deps"] if dep in tasks]
+                blocked = [dep for dep in deps if dep in report and report[dep][0] not in ("ok", "up to date")]
+                if blocked:
+                    pending.remove(name)
+                    report[name] = ("skipped", 0.0, f"{', '.join(blocked)} did not succeed")
+                    continue
+                if any(dep not in report for dep in deps):
+                    continue
+                if fresh != None and fresh(name):
+                    pending.remove(name)
+                    report[name] = ("up to date", 0.0, None)
+                    continue
+                # Tasks larger than the budget, and suspects, run on their own
+                if running and (len(running) >= nproc or used + task["memory"] > memory or alone or name in suspects):
+                    continue
+                if executor == None:
+                    pending.remove(name)
+                    print("{:-^80}".format(f" Starting {name} ({task['memory']:.1f} GB) "))
+                    start = time.time()
+                    try:
+                        task["fn"](**task["kwargs"])
+                        report[name] = ("ok", time.time() - start, None)
+                    except (Exception, SystemExit) as e:
+                        report[name] = ("failed", time.time() - start, error_message(e))
+                    if done != None and report[name][0] == "ok":
+                        done(name)
+                    continue
+                try:
+                    future = executor.submit(task["fn"], **task["kwargs"])
+                except BrokenProcessPool:
+                    # A worker died since the last wait, the task stays pending
+                    broken = True
+                    break
+                pending.remove(name)
+                print("{:-^80}".format(f" Starting {name} ({task['memory']:.1f} GB) "))
+                running[future] = (name, time.time())
+                used += task["memory"]
+                alone = alone or name in suspects
+
+            if not running and not broken and len(report) == progress:
+                # Nothing can start, the remaining tasks depend on each other
+                for name in pending:
+                    report[name] = ("skipped", 0.0, "circular dependencies")
+                pending = []
+            if running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                lost = [collect(future) for future in finished]
+                if any(lost):
+                    # The pool went down with every task still running in it
+                    broken = True
+                    lost += [collect(future) for future in list(running)]
+                lost = dict(item for item in lost if item != None)
+                if len(lost) == 1:
+                    for name, start in lost.items():
+                        report[name] = ("failed", time.time() - start, "worker process died (ex. out of memory)")
+                elif lost:
+                    print("{:-^80}".format(f" A worker died running {', '.join(lost)}, rerunning them one at a time "))
+                    suspects.update(lost)
+                    pending[:0] = [name for name in tasks if name in lost]
+            if broken:
+                executor.shutdown()
+                executor = process_pool(nproc)
+    finally:
+        if executor != None:
+            executor.shutdown()
+        summary = {name: report.get(name, ("skipped", 0.0, "not run")) for name in tasks}
+        print_report(summary)
+    return summary
+
+
+def error_message(e):
+    return "".join(traceback.format_exception_only(type(e), e)).strip()
+
+
+def print_report(report):
+    print("{:-^80}".format(" Summary "))
+    for name, (status, seconds, error) in report.items():
+        print(f"{name:<32}{status:>12}{seconds:>10.1f} s")
+        if error:
+            print(f"    {error}")
+    failed = [name for name, (status, seconds, error) in report.items() if status not in ("ok", "up to date")]
+    print(f"{len(report) - len(failed)} of {len(report)} tasks succeeded")
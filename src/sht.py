@@ -0,0 +1,228 @@
+"""
+Spherical harmonic transforms used throughout c3pp. Transforms run on
+healpy or, multithreaded, on ducc0. The backend is set by $C3PP_SHT
+(healpy, the default, or ducc0) or c3pp -sht, and ducc0 threads by
+nthreads or $C3PP_SHT_THREADS (default all cores). healpy's threads are
+set by $OMP_NUM_THREADS. tests/test_sht.py checks ducc0 against healpy.
+"""
+import os
+import sys
+import functools
+import numpy as np
+
+
+def backend():
+    """
+    Name of the backend in use, healpy or ducc0.
+    """
+    name = os.environ.get("C3PP_SHT", "healpy")
+    if name not in ("healpy", "ducc0"):
+        print(f"Unknown SHT backend {name}, use healpy or ducc0. Exiting")
+        sys.exit()
+    if name == "ducc0" and not has_ducc0():
+        print("SHT backend ducc0 is not installed (pip install ducc0). Exiting")
+        sys.exit()
+    return name
+
+
+@functools.lru_cache(maxsize=None)
+def has_ducc0():
+    try:
+        import ducc0
+    except ImportError:
+        return False
+    return True
+
+
+def threads(nthreads=0):
+    return nthreads or int(os.environ.get("C3PP_SHT_THREADS", 0)) or os.cpu_count()
+
+
+def alm2map(alm, nside, lmax=None, fwhm=0.0, pixwin=False, pol=True, nthreads=0):
+    """
+    Map from healpy alms, shape ([3,] nalm), smoothed with a gaussian beam
+    of fwhm arcmin, as hp.alm2map.
+    """
+    alm = np.asarray(alm)
+    if lmax == None:
+        import healpy as hp
+        lmax = hp.Alm.getlmax(alm.shape[-1])
+    return alm2maps(alm[None], nside, lmax, fwhm, pixwin, pol, nthreads)[0]
+
+
+def alm2maps(alms, nside, lmax, fwhm=0.0, pixwin=True, pol=True, nthreads=0):
+    """
+    Maps of several samples' healpy alms, shape (nsamp, [3,] nalm), as
+    hp.alm2map(alm, nside, lmax, fwhm=fwhm, pixwin=pixwin, pol=pol) for
+    each sample. Beam and pixel window are computed once per (nside, lmax,
+    fwhm) and applied to all samples at once, but neither backend takes
+    several samples in one transform, so each is synthesized on its own.
+    Alms which already have them applied (ex. by unpack_alms) are
+    synthesized with fwhm=0, pixwin=False.
+    """
+    alms = np.asarray(alms, dtype=np.complex128)
+    single = alms.ndim == 2
+    if single:
+        alms = alms[:, None, :]
+    nsamp, ncomp, nalm = alms.shape
+    pol = pol and ncomp == 3
+
+    if fwhm > 0.0 or pixwin:
+        alms = alms * beam(nside, lmax, fwhm, pixwin, pol, ncomp)[:, alm_l(lmax)]
+
+    maps = np.empty((nsamp, ncomp, 12 * nside ** 2))
+    if backend() == "ducc0":
+        for i in range(nsamp):
+            synthesis(alms[i], nside, lmax, pol, nthreads, out=maps[i])
+    else:
+        import healpy as hp
+        for i in range(nsamp):
+            maps[i] = hp.alm2map(list(alms[i]), nside, lmax=lmax, pixwin=False, pol=pol)
+
+    return maps[:, 0] if single else maps
+
+
+def map2alm(maps, lmax=None, pol=True, iter=3, use_weights=False, pixweight=None, nthreads=0):
+    """
+    healpy alms of maps, shape ([3,] npix), as hp.map2alm. ducc0 refines
+    the alms with iter Jacobi iterations, as healpy does without weights.
+    With ring weights (use_weights) or pixel weights (from the pixweight
+    directory), which ducc0 does not apply, healpy is used.
+    """
+    if backend() == "healpy" or use_weights or pixweight != None:
+        import healpy as hp
+        return hp.map2alm(maps, lmax=lmax, iter=iter, pol=pol, use_weights=use_weights,
+                          use_pixel_weights=pixweight != None, datapath=pixweight)
+
+    import healpy as hp
+    m = np.atleast_2d(np.ma.filled(maps, 0.0)).astype(np.float64)
+    m[m == hp.UNSEEN] = 0.0
+    nside = hp.npix2nside(m.shape[-1])
+    lmax = 3 * nside - 1 if lmax == None else lmax
+    pol = pol and len(m) == 3
+
+    alm = np.zeros((len(m), hp.Alm.getsize(lmax)), dtype=np.complex128)
+    residual = m
+    for i in range(iter + 1):
+        alm += adjoint_synthesis(residual, nside, lmax, pol, nthreads) * (4 * np.pi / m.shape[-1])
+        if i < iter:
+            residual = m - synthesis(alm, nside, lmax, pol, nthreads)
+    return alm[0] if np.ndim(maps) == 1 else alm
+
+
+def smoothing(maps, fwhm, pol=True, lmax=None, iter=3, use_weights=False, pixweight=None, nthreads=0, nside=None):
+    """
+    maps, shape ([3,] npix), smoothed with a gaussian beam of fwhm arcmin,
+    as hp.smoothing. If fwhm is a list, a list of maps smoothed to each
+    is returned, all from one map2alm. If nside is given, the smoothed
+    maps are ud_graded to it, as hp.ud_grade(hp.smoothing(maps), nside).
+    """
+    import healpy as hp
+
+    fwhms = fwhm if isinstance(fwhm, (tuple, list)) else [fwhm]
+    nside_in = hp.npix2nside(np.shape(maps)[-1])
+    lmax = 3 * nside_in - 1 if lmax == None else lmax
+    alm = map2alm(maps, lmax, pol, iter, use_weights, pixweight, nthreads)
+    bad = hp.mask_bad(maps)
+
+    outs = []
+    for f in fwhms:
+        out = alm2map(alm, nside_in, lmax, f, pixwin=False, pol=pol, nthreads=nthreads)
+        # Masked pixels stay masked, as in healpy
+        out[bad] = hp.UNSEEN
+        if nside != None and nside != nside_in:
+            # Pixel averages, not the field at the new pixel centres, which
+            # differs by several percent where the beam spans few pixels
+            out = hp.ud_grade(out, nside)
+        outs.append(out)
+    return outs if isinstance(fwhm, (tuple, list)) else outs[0]
+
+
+def synthesis(alm, nside, lmax, pol, nthreads=0, out=None):
+    """
+    ducc0 synthesis of alm, shape (ncomp, nalm), on the HEALPix grid.
+    T (or each map if not pol) is spin 0, E and B give Q and U (spin 2).
+    """
+    import ducc0
+
+    if out is None:
+        out = np.empty((len(alm), 12 * nside ** 2))
+    for comps, spin in components(len(alm), pol):
+        ducc0.sht.synthesis(alm=alm[comps], map=out[comps], lmax=lmax, spin=spin, nthreads=threads(nthreads), **ring_geometry(nside))
+    return out
+
+
+def adjoint_synthesis(m, nside, lmax, pol, nthreads=0):
+    import ducc0
+
+    alm = np.empty((len(m), alm_l(lmax).size), dtype=np.complex128)
+    for comps, spin in components(len(m), pol):
+        ducc0.sht.adjoint_synthesis(map=m[comps], alm=alm[comps], lmax=lmax, spin=spin, nthreads=threads(nthreads), **ring_geometry(nside))
+    return alm
+
+
+def components(ncomp, pol):
+    if pol and ncomp == 3:
+        return [(slice(0, 1), 0), (slice(1, 3), 2)]
+    return [(slice(i, i + 1), 0) for i in range(ncomp)]
+
+
+def band_limit(lmax, nside, bandlimit=None):
+    """
+    lmax to synthesize alms up to lmax at nside with, min(lmax, bandlimit*nside)
+    if bandlimit is set. Commander alms up to this lmax are the first
+    (lmax+1)**2 of each row, so can be read and unpacked on their own.
+    """
+    if bandlimit == None or nside == None:
+        return lmax
+    return int(min(lmax, bandlimit * nside))
+
+
+def beam(nside, lmax, fwhm, pixwin=True, pol=True, ncomp=3):
+    """
+    Transfer function (gaussian beam of fwhm arcmin times pixel window)
+    of each of ncomp alm components, shape (ncomp, lmax+1). Temperature
+    on T, polarization on E and B, or temperature on all if not pol.
+    """
+    fl = transfer(nside, lmax, fwhm, pixwin)
+    return fl[[0, 1, 1]] if pol and ncomp == 3 else fl[[0] * ncomp]
+
+
+@functools.lru_cache(maxsize=None)
+def transfer(nside, lmax, fwhm, pixwin=True):
+    """
+    Gaussian beam of fwhm arcmin times pixel window, for temperature and
+    polarization, shape (2, lmax+1). Zero above the pixel window's lmax,
+    as healpy's almxfl does.
+    """
+    import healpy as hp
+
+    fl = np.zeros((2, lmax + 1))
+    fl[:] = hp.gauss_beam(np.radians(fwhm / 60.0), lmax=lmax, pol=True)[:, :2].T
+    if pixwin:
+        pw = hp.pixwin(nside, pol=True)
+        n = min(lmax + 1, len(pw[0]))
+        fl[:, :n] *= np.array(pw)[:, :n]
+        fl[:, n:] = 0.0
+    return fl
+
+
+@functools.lru_cache(maxsize=None)
+def alm_l(lmax):
+    """
+    l of each alm in healpy ordering.
+    """
+    import healpy as hp
+
+    return hp.Alm.getlm(lmax)[0]
+
+
+@functools.lru_cache(maxsize=None)
+def ring_geometry(nside):
+    """
+    HEALPix ring layout in the form taken by ducc0.sht.synthesis.
+    """
+    import ducc0
+
+    info = ducc0.healpix.Healpix_Base(nside, "RING").sht_info()
+    return {k: info[k] for k in ("theta", "nphi", "phi0", "ringstart")}
@@ -1,229 +1,1286 @@
+import sys
+import functools
+import contextlib
+import itertools
+import threading
 import numba
 import numpy as np
 #######################
 # HELPFUL TOOLS BELOW #
 #######################
 
+# numba's thread pool may not be entered by two threads at once (the
+# default workqueue layer aborts), so parallel kernels are run holding this
+parallel_lock = threading.Lock()
+# Threads of numba's pool used by parallel kernels, 0 for all (see pool_worker)
+kernel_threads = 0
 
-@numba.njit(cache=True, fastmath=True)  # Speeding up by a lot!
-def unpack_alms(maps, lmax):
-    #print("Unpacking alms")
-    mmax = lmax
-    nmaps = len(maps)
-    # Nalms is length of target alms
-    Nalms = int(mmax * (2 * lmax + 1 - mmax) / 2 + lmax + 1)
-    alms = np.zeros((nmaps, Nalms), dtype=np.complex128)
-
-    # Unpack alms as output by commander
-    for sig in range(nmaps):
-        i = 0
-        for l in range(lmax + 1):
-            j_real = l ** 2 + l
-            alms[sig, i] = complex(maps[sig, j_real], 0.0)
-            i += 1
 
-        for m in range(1, lmax + 1):
-            for l in range(m, lmax + 1):
-                j_real = l ** 2 + l + m
-                j_comp = l ** 2 + l - m
-
-                alms[sig, i] = complex(maps[sig, j_real], maps[sig, j_comp],) / np.sqrt(2.0)
-
-                i += 1
-    return alms
+@contextlib.contextmanager
+def parallel():
+    """
+    Context to launch numba parallel kernels in, from any thread: one
+    thread at a time, each with this process's share of numba's threads.
+    """
+    with parallel_lock:
+        if kernel_threads:
+            # Thread local in numba, so set by every launching thread
+            numba.set_num_threads(kernel_threads)
+        yield
 
 
-def alm2fits_tool(input, dataset, nside, lmax, fwhm, save=True):
+def unpack_alms(maps, lmax, out=None, fl=None):
+    """
+    Unpacks real alms as output by commander, shape (..., (lmax+1)**2), to
+    healpy complex alms, shape (..., nalm). Works on a single sample
+    (nmaps, ...) or a batch (nsamp, nmaps, ...), optionally writing into
+    a preallocated complex128 out buffer.
+    If fl, shape ([nmaps,] lmax+1), is given, each map's alms are multiplied
+    by it while unpacking, as hp.almxfl, ex. a beam from src.sht.beam.
+    """
+    lmax = int(lmax)
+    mmax = lmax
+    # Nalms is length of target alms
+    Nalms = int(mmax * (2 * lmax + 1 - mmax) / 2 + lmax + 1)
+    maps = np.ascontiguousarray(maps, dtype=np.float64)
+    if out is None:
+        out = np.empty(maps.shape[:-1] + (Nalms,), dtype=np.complex128)
+    # One row of fl per map, the same for every sample
+    fl = np.ones((1, lmax + 1)) if fl is None else np.ascontiguousarray(np.reshape(fl, (-1, lmax + 1)), dtype=np.float64)
+    # From any thread, ex. the transform thread of h5partial, one at a time
+    with parallel():
+        unpack_alms_kernel(maps.reshape(-1, maps.shape[-1]), lmax, alm_offsets(lmax), fl, out.reshape(-1, Nalms))
+    return out
+
+
+@functools.lru_cache(maxsize=None)
+def alm_offsets(lmax):
+    """
+    Index of (l=0, m) in healpy alm ordering for each m, so that (l, m)
+    is at alm_offsets(lmax)[m] + l.
+    """
+    m = np.arange(lmax + 1)
+    return m * (2 * lmax + 1 - m) // 2
+
+
+@numba.njit(parallel=True, cache=True, fastmath=True)  # Speeding up by a lot!
+def unpack_alms_kernel(maps, lmax, offsets, fl, alms):
+    # Commander stores (l, m) at l**2 + l + m, with the imaginary part at
+    # l**2 + l - m. Work in blocks of l, so the rows being read stay in
+    # cache while stepping through m, and spread blocks over threads.
+    nb = 16
+    nblocks = (lmax + nb) // nb
+    norm = 1.0 / np.sqrt(2.0)
+    for k in numba.prange(maps.shape[0] * nblocks):
+        sig = k // nblocks
+        f = fl[sig % fl.shape[0]]
+        l0 = (k % nblocks) * nb
+        l1 = min(l0 + nb, lmax + 1)
+        for l in range(l0, l1):
+            alms[sig, l] = complex(maps[sig, l ** 2 + l] * f[l], 0.0)
+        for m in range(1, l1):
+            for l in range(max(l0, m), l1):
+                j = l ** 2 + l
+                w = norm * f[l]
+                alms[sig, offsets[m] + l] = complex(maps[sig, j + m] * w, maps[sig, j - m] * w)
+
+
+
+def alm2fits_tool(input, dataset, nside, lmax, fwhm, save=True, bandlimit=None):
     """
     Function for converting alms in hdf file to fits
+    If bandlimit is set and no lmax given, alms are only read and
+    synthesized up to lmax = min(lmax_h5, bandlimit*nside).
+    The lmax used is written to the header as LMAX.
     """
     import h5py
     import healpy as hp
+    from src.sht import alm2map, beam, band_limit
 
     with h5py.File(input, "r") as f:
-        alms = f[dataset][()]
         lmax_h5 = f[f"{dataset[:-3]}lmax"][()]  # Get lmax from h5
 
-    if lmax:
-        # Check if chosen lmax is compatible with data
-        if lmax > lmax_h5:
-            print(
-                "lmax larger than data allows: ", lmax_h5,
-            )
-            print("Please chose a value smaller than this")
-    else:
-        # Set lmax to default value
-        lmax = lmax_h5
-    mmax = lmax
-
-    alms_unpacked = unpack_alms(alms, lmax)  # Unpack alms
+        if lmax:
+            # Check if chosen lmax is compatible with data
+            if lmax > lmax_h5:
+                print(
+                    "lmax larger than data allows: ", lmax_h5,
+                )
+                print("Please chose a value smaller than this")
+        else:
+            # Set lmax to default value
+            lmax = band_limit(lmax_h5, nside, bandlimit)
+        # Alms up to lmax are the first (lmax+1)**2
+        alms = f[dataset][:, :(lmax + 1) ** 2]
 
     print("Making map from alms")
-    pol=False if alms_unpacked.shape[0] == 1 else True
-    maps = hp.sphtfunc.alm2map(alms_unpacked, nside, lmax=lmax, mmax=mmax, fwhm=arcmin2rad(fwhm),pol=pol, pixwin=True,)
+    pol=False if alms.shape[0] == 1 else True
+    # Beam and pixel window applied while unpacking, leaving one synthesis
+    alms_unpacked = unpack_alms(alms, lmax, fl=beam(nside, lmax, fwhm, True, pol, alms.shape[0]))  # Unpack alms
+    maps = alm2map(alms_unpacked, nside, lmax=lmax, pol=pol, pixwin=False,)
 
     outfile = dataset.replace("/", "_")
     outfile = outfile.replace("_alm", "")
     if save:
         outfile += f"_{str(int(fwhm))}arcmin" if fwhm > 0.0 else ""
-        hp.write_map(outfile + f"_n{str(nside)}_lmax{lmax}.fits", maps, overwrite=True, dtype=None)
+        hp.write_map(outfile + f"_n{str(nside)}_lmax{lmax}.fits", maps, overwrite=True, dtype=None, extra_header=[("LMAX", int(lmax), "Maximum multipole of synthesized alms")])
     return maps, nside, lmax, fwhm, outfile
 
 
-def h5handler(input, dataset, min, max, maxchain, output, fwhm, nside, command, pixweight=None, zerospin=False, lowmem=False,):
+class Moments:
+    """
+    Running count, mean and M2 (sum of squared deviations) of a stream of
+    samples, updated one sample at a time with Welford's algorithm.
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.M2 = None
+
+    def add(self, data):
+        self.n += 1
+        if self.mean is None:
+            self.mean = np.array(data, dtype=np.result_type(data, np.float64))
+            self.M2 = np.zeros(self.mean.shape)
+        else:
+            delta = data - self.mean
+            self.mean += delta / self.n
+            self.M2 += np.real(delta * np.conj(data - self.mean))
+
+    def merge(self, other):
+        """
+        Combines with the moments of a disjoint set of samples
+        (parallel variance combination of Chan et al.)
+        """
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.n, self.mean, self.M2 = other.n, other.mean.copy(), other.M2.copy()
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta * (other.n / n)
+        self.M2 += other.M2 + np.abs(delta)**2 * (self.n * other.n / n)
+        self.n = n
+        return self
+
+    def std(self):
+        return np.sqrt(self.M2 / self.n)
+
+    def result(self, command):
+        if command == np.mean:
+            return self.mean
+        elif command == np.std:
+            return self.std()
+        print(f"     Unknown command {command.__name__}. Exiting")
+        sys.exit()
+
+
+class Quantiles(Moments):
+    """
+    Moments plus running percentiles q of every pixel, estimated with the
+    P² algorithm (Jain & Chlamtac 1985) extended to several quantiles
+    (Raatikainen 1987). 2*nq+3 float32 markers are kept per pixel, with
+    the median always among them, so memory does not grow with the number
+    of samples. Until there are as many samples as markers they are kept
+    as they are, and percentiles of those are exact.
+    """
+    def __init__(self, q=(16, 50, 84)):
+        super().__init__()
+        self.q = tuple(float(qi) for qi in q)
+        self.levels = np.array(sorted(set(self.q) | {50.0})) / 100
+        # Markers at min, each level, halfway between levels, and max
+        p = np.concatenate(([0.0], self.levels, [1.0]))
+        self.dp = np.sort(np.concatenate((p, (p[1:] + p[:-1]) / 2)))
+        self.buffer = []
+        self.h = None
+        self.pos = None
+
+    def add(self, data):
+        if np.iscomplexobj(data):
+            print("     Percentiles of alms are not supported, output a map instead. Exiting")
+            sys.exit()
+        super().add(data)
+        self.push(np.asarray(data, dtype=np.float32))
+
+    def push(self, data):
+        if self.h is None:
+            # Copied, as callers may reuse (or free) their buffer
+            self.buffer.append(np.array(data))
+            if len(self.buffer) == len(self.dp):
+                # Sorted first samples are the initial markers
+                self.h = np.sort(np.array(self.buffer).reshape(len(self.dp), -1), axis=0)
+                self.pos = np.repeat(np.arange(1, len(self.dp) + 1, dtype=np.float32)[:, None], self.h.shape[1], axis=1)
+                self.buffer = []
+        else:
+            # Last marker is the max, so its position is the sample count
+            n = self.pos[-1, 0] + 1
+            with parallel():
+                p2_kernel(data.ravel(), self.h, self.pos, 1 + (n - 1) * self.dp)
+
+    def merge(self, other):
+        """
+        Combines with the quantiles of a disjoint set of samples. When
+        both have markers, the new ones are placed where the summed
+        (piecewise linear) rank in the two sets reaches their desired rank.
+        """
+        if other.n == 0:
+            return self
+        super().merge(other)
+        if other.h is None:
+            samples = other.buffer
+        elif self.h is None:
+            samples = self.buffer
+            self.h, self.pos, self.buffer = other.h.copy(), other.pos.copy(), []
+        else:
+            samples = []
+            targets = 1 + (self.pos[-1, 0] + other.pos[-1, 0] - 1) * self.dp
+            with parallel():
+                self.h = p2_merge_kernel(self.h, self.pos, other.h, other.pos, targets)
+            self.pos = np.repeat(targets.astype(np.float32)[:, None], self.h.shape[1], axis=1)
+        for data in samples:
+            self.push(data)
+        return self
+
+    def result(self, command):
+        if command not in (np.median, np.percentile):
+            return super().result(command)
+        if self.h is None:
+            data = np.percentile(np.array(self.buffer), self.levels * 100, axis=0)
+        else:
+            with parallel():
+                data = p2_quantile_kernel(self.h, self.pos, 1 + (self.pos[-1, 0] - 1) * self.levels)
+            data = data.reshape((len(self.levels),) + self.mean.shape)
+        if command == np.median:
+            return data[np.searchsorted(self.levels, 0.5)]
+        return data[np.searchsorted(self.levels, np.array(self.q) / 100)]
+
+
+def accumulator(commands, q=(16, 50, 84)):
+    """
+    Empty accumulator for commands: Moments for np.mean and np.std, also
+    Quantiles (at q) for np.median and np.percentile, else a list of
+    samples.
+    """
+    if not all(cmd in (np.mean, np.std, np.median, np.percentile) for cmd in commands):
+        return []
+    if any(cmd in (np.median, np.percentile) for cmd in commands):
+        return Quantiles(q)
+    return Moments()
+
+
+@numba.njit(parallel=True, cache=True)
+def p2_kernel(x, h, n, desired):
+    # One P² step for every pixel j: find the cell of x, shift the marker
+    # positions above it and move interior markers towards their desired
+    # positions along a parabola (or linearly if that is not monotonic).
+    M = h.shape[0]
+    for j in numba.prange(x.shape[0]):
+        xj = x[j]
+        if xj < h[0, j]:
+            h[0, j] = xj
+            k = 0
+        elif xj >= h[M - 1, j]:
+            h[M - 1, j] = xj
+            k = M - 2
+        else:
+            k = 0
+            while xj >= h[k + 1, j]:
+                k += 1
+        for i in range(k + 1, M):
+            n[i, j] += 1
+        for i in range(1, M - 1):
+            d = desired[i] - n[i, j]
+            if (d >= 1 and n[i + 1, j] - n[i, j] > 1) or (d <= -1 and n[i - 1, j] - n[i, j] < -1):
+                s = 1.0 if d > 0 else -1.0
+                hp = h[i, j] + s / (n[i + 1, j] - n[i - 1, j]) * (
+                    (n[i, j] - n[i - 1, j] + s) * (h[i + 1, j] - h[i, j]) / (n[i + 1, j] - n[i, j])
+                    + (n[i + 1, j] - n[i, j] - s) * (h[i, j] - h[i - 1, j]) / (n[i, j] - n[i - 1, j])
+                )
+                if not (h[i - 1, j] < hp < h[i + 1, j]):
+                    l = i + int(s)
+                    hp = h[i, j] + s * (h[l, j] - h[i, j]) / (n[l, j] - n[i, j])
+                h[i, j] = hp
+                n[i, j] += s
+
+
+@numba.njit(parallel=True, cache=True)
+def p2_quantile_kernel(h, n, targets):
+    # Markers interpolated linearly to the desired ranks, which is what
+    # np.percentile does with the sorted samples when every rank is known
+    M = h.shape[0]
+    out = np.empty((len(targets), h.shape[1]), dtype=h.dtype)
+    for j in numba.prange(h.shape[1]):
+        k = 0
+        for i in range(len(targets)):
+            while k < M - 2 and n[k + 1, j] <= targets[i]:
+                k += 1
+            w = min(max((targets[i] - n[k, j]) / (n[k + 1, j] - n[k, j]), 0.0), 1.0)
+            out[i, j] = h[k, j] + w * (h[k + 1, j] - h[k, j])
+    return out
+
+
+@numba.njit(cache=True)
+def p2_rank(h, n, j, x):
+    # Piecewise linear rank of x among the samples summarized by markers h, n
+    M = h.shape[0]
+    if x < h[0, j]:
+        return 0.0
+    if x >= h[M - 1, j]:
+        return n[M - 1, j]
+    k = 0
+    while x >= h[k + 1, j]:
+        k += 1
+    return n[k, j] + (n[k + 1, j] - n[k, j]) * (x - h[k, j]) / (h[k + 1, j] - h[k, j])
+
+
+@numba.njit(parallel=True, cache=True)
+def p2_merge_kernel(ha, na, hb, nb, targets):
+    M = ha.shape[0]
+    h = np.empty((len(targets), ha.shape[1]), dtype=ha.dtype)
+    for j in numba.prange(ha.shape[1]):
+        # Summed rank at every marker height of both sets, inverted linearly
+        xs = np.sort(np.concatenate((ha[:, j], hb[:, j])))
+        rs = np.empty(2 * M)
+        for k in range(2 * M):
+            rs[k] = p2_rank(ha, na, j, xs[k]) + p2_rank(hb, nb, j, xs[k])
+        k = 0
+        for i in range(len(targets)):
+            while k < 2 * M - 1 and rs[k] < targets[i]:
+                k += 1
+            if k == 0 or rs[k] <= rs[k - 1] or rs[k] < targets[i]:
+                h[i, j] = xs[k]
+            else:
+                h[i, j] = xs[k - 1] + (xs[k] - xs[k - 1]) * (targets[i] - rs[k - 1]) / (rs[k] - rs[k - 1])
+    return h
+
+
+def save_state(filename, accs, meta):
+    """
+    Saves a dict of Moments (or Quantiles) accumulators and json-serializable meta
+    data (settings, last sample per chain) to a .npz sidecar file.
+    """
+    import json
+    import os
+
+    arrays = {}
+    for i, acc in enumerate(accs.values()):
+        arrays[f"n{i}"] = acc.n
+        if acc.n > 0:
+            arrays[f"mean{i}"] = acc.mean
+            arrays[f"M2{i}"] = acc.M2
+        if isinstance(acc, Quantiles):
+            arrays[f"q{i}"] = acc.q
+            if acc.h is not None:
+                arrays[f"h{i}"] = acc.h
+                arrays[f"pos{i}"] = acc.pos
+            elif acc.buffer:
+                arrays[f"buffer{i}"] = np.array(acc.buffer)
+    meta = dict(meta, keys=[list(key) for key in accs])
+    # Write under a temporary name so an interrupted run keeps the old state
+    tmp = f"{filename}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, meta=json.dumps(meta, default=int), **arrays)
+    os.replace(tmp, filename)
+
+
+def load_state(filename):
+    """
+    Loads accumulators and meta data saved with save_state.
+    """
+    import json
+
+    with np.load(filename) as f:
+        meta = json.loads(str(f["meta"]))
+        accs = {}
+        for i, key in enumerate(meta["keys"]):
+            acc = Quantiles(f[f"q{i}"]) if f"q{i}" in f else Moments()
+            acc.n = int(f[f"n{i}"])
+            if acc.n > 0:
+                acc.mean, acc.M2 = f[f"mean{i}"], f[f"M2{i}"]
+            if f"h{i}" in f:
+                acc.h, acc.pos = f[f"h{i}"], f[f"pos{i}"]
+            elif f"buffer{i}" in f:
+                acc.buffer = list(f[f"buffer{i}"])
+            accs[tuple(key)] = acc
+    return accs, meta
+
+
+def h5handler(input, dataset, min, max, maxchain, output, fwhm, nside, command, pixweight=None, zerospin=False, lowmem=False, nproc=1, memory=None, cache=None, state=None, q=(16, 50, 84), prefetch=2, shard=None, batch=4, nthreads=0, bandlimit=None,):
     """
     Function for calculating mean and stddev of signals in hdf file
+    If command is a tuple, ex. (np.mean, np.std), all statistics are
+    calculated from a single read of each sample and returned as a tuple.
+    np.median and np.percentile (at q) are estimated while streaming.
+    If memory (GB) is set, map datasets are reduced in pixel tiles instead,
+    where percentiles are exact.
+    If state is set, accumulators are kept in that sidecar file between runs.
+    If shard is set, "i/N" or (i, N), only the i-th of N slices of the
+    samples is reduced, and accumulators are saved to output_shard{i}of{N}.npz
+    for h5merge.
+    alms are unpacked batch samples at a time, and synthesized on nthreads
+    threads (ducc0).
+    If fwhm is a list, the chain is read once, and a list with the result
+    for each fwhm is returned and written to output_{fwhm}arcmin.
+    If bandlimit is set, alms are only read and synthesized up to
+    lmax = min(lmax_h5, bandlimit*nside), written to the header as LMAX.
+    """
+    # Unless output is ".fits" or "map", don't convert alms to map.
+    alm2map = True if output.endswith((".fits", "map")) else False
+    commands = tuple(command) if isinstance(command, (tuple, list)) else (command,)
+    fwhms = tuple(fwhm) if isinstance(fwhm, (tuple, list)) else (fwhm,)
+    jobs = [(dataset, command, f, nside) for f in fwhms]
+
+    if shard != None:
+        if isinstance(shard, str):
+            shard = tuple(int(i) for i in shard.split("/"))
+        if not 1 <= shard[0] <= shard[1] or memory or state:
+            print("Shard must be i/N with 1 <= i <= N, and can not be combined with -memory or -state. Exiting")
+            sys.exit()
+        partial = f"{output.rsplit('.', 1)[0]}_shard{shard[0]}of{shard[1]}.npz"
+        h5reduce(input, jobs, min, max, maxchain, alm2map, pixweight, zerospin, lowmem, nproc, cache, None, q, prefetch, shard, partial, batch, nthreads, bandlimit,)
+        return None
+
+    if memory:
+        if any(f > 0.0 for f in fwhms) and any(cmd != np.mean for cmd in commands):
+            print("Smoothing each sample needs full maps, drop -memory to use the streaming mode. Exiting")
+            sys.exit()
+        outputs = h5tiled(input, dataset, min, max, maxchain, commands, memory, nproc, q,)
+        pol = True if zerospin == False else False  # treat maps as TQU maps (polarization)
+        smoothed = [{} for outdata in outputs]
+        positive = [f for f in fwhms if f > 0.0]
+        if positive:
+            print(f"--- Smoothing mean map with {', '.join(f'{f:g}' for f in positive)} arcmin,---")
+            # One map2alm per map, however many fwhms
+            smoothed = [dict(zip(positive, smooth_map(outdata, positive, pol, pixweight))) for outdata in outputs]
+        results = [tuple(maps.get(f, outdata) for outdata, maps in zip(outputs, smoothed)) for f in fwhms]
+    else:
+        results = h5reduce(input, jobs, min, max, maxchain, alm2map, pixweight, zerospin, lowmem, nproc, cache, state, q, prefetch, batch=batch, nthreads=nthreads, bandlimit=bandlimit,)
+        if not isinstance(command, (tuple, list)):
+            results = [(outputs,) for outputs in results]
+
+    # Outputs fits map if output name is .fits, with the lmax of maps synthesized from alms
+    lmax = h5lmax(input, dataset, nside, bandlimit) if alm2map and not memory else None
+    for f, outputs in zip(fwhms, results):
+        for cmd, outdata in zip(commands, outputs):
+            write_output(output, outdata, cmd, q, suffix=len(commands) > 1, fwhm=f if len(fwhms) > 1 else None, lmax=lmax)
+
+    if not isinstance(command, (tuple, list)):
+        results = [outputs[0] for outputs in results]
+    if isinstance(fwhm, (tuple, list)):
+        return results
+    return results[0]
+
+
+def write_output(filename, outdata, command, q=(16, 50, 84), suffix=False, fwhm=None, lmax=None):
+    """
+    Writes result of command to .fits or .dat file, with suffix adding
+    the command name, ex. _mean, and fwhm the smoothing, ex. _60arcmin.
+    Percentile maps, shape (nq, [nmaps,] npix), get one column per signal
+    and percentile, ex. I_Q16, Q_Q16, U_Q16, I_Q50, ...
+    If lmax is given, it is written to the fits header as LMAX.
     """
-    # Check if you want to output a map
-    import h5py
     import healpy as hp
-    from tqdm import tqdm
 
-    if (lowmem and command == np.std): #need to compute mean first
-        mean_data = h5handler(input, dataset, min, max, maxchain, output, fwhm, nside, np.mean, pixweight, zerospin, lowmem,)
+    if suffix and filename.endswith((".fits", ".dat")):
+        filename = f"{filename.rsplit('.', 1)[0]}_{command.__name__}.{filename.rsplit('.', 1)[1]}"
+    if fwhm != None and filename.endswith((".fits", ".dat")):
+        filename = f"{filename.rsplit('.', 1)[0]}_{fwhm:g}arcmin.{filename.rsplit('.', 1)[1]}"
+
+    if command == np.percentile:
+        sigs = "IQU" if outdata.ndim == 3 else "I"
+        outdata = outdata.reshape(-1, outdata.shape[-1])
+        columns = [f"{sig}_Q{qi:g}" for qi in q for sig in sigs[:len(outdata)//len(q)]]
+    header = [] if lmax == None else [("LMAX", int(lmax), "Maximum multipole of synthesized alms")]
+    if filename.endswith(".fits"):
+        if command == np.percentile:
+            hp.write_map(filename, outdata, column_names=columns, overwrite=True, dtype=None, extra_header=header)
+        else:
+            hp.write_map(filename, outdata, overwrite=True, dtype=None, extra_header=header)
+    elif filename.endswith(".dat"):
+        np.savetxt(filename, outdata)
 
-    print()
-    print("{:-^50}".format(f" {dataset} calculating {command.__name__} "))
-    print("{:-^50}".format(f" nside {nside}, {fwhm} arcmin smoothing "))
 
-    if dataset.endswith("map"):
-        type = "map"
-    elif dataset.endswith("rms"):
-        type = "map"
-    elif dataset.endswith("alm"):
-        type = "alm"
-    elif dataset.endswith("sigma"):
-        type = "sigma"
+def h5reduce(input, jobs, min, max, maxchain, alm2map=True, pixweight=None, zerospin=False, lowmem=False, nproc=1, cache=None, state=None, q=(16, 50, 84), prefetch=2, shard=None, partial=None, batch=4, nthreads=0, bandlimit=None,):
+    """
+    Function for calculating statistics of several datasets in hdf file
+    in a single scan. jobs is a list of (dataset, command, fwhm, nside),
+    where command is np.mean, np.std, np.median, np.percentile (at q) or
+    a tuple of these. Every {sample}/
+    group is visited once, and one result per job is returned in order.
+    With nproc > 1, chains (or sample ranges) are reduced in separate
+    processes and their partial moments merged.
+    cache is a directory (or SampleCache) of derived per-sample maps,
+    defaulting to $C3PP_CACHE if set.
+    If state is a sidecar file, accumulators are saved to it, and a later
+    run with the same jobs only reads samples added since.
+    Up to prefetch samples are read ahead while others are transformed,
+    and alms are unpacked batch samples at a time and synthesized on
+    nthreads threads.
+    With shard = (i, N), only the i-th of N slices of the (chain, sample)
+    pairs is reduced, and its accumulators are saved to the partial file
+    instead, to be combined with h5merge.
+    If bandlimit is set, alms are synthesized (and only read) up to
+    lmax = min(lmax_h5, bandlimit*nside).
+    """
+    import os
+    from src.cache import SampleCache
+    from src.chainindex import ChainIndex
+
+    if cache == None and os.environ.get("C3PP_CACHE"):
+        cache = os.environ["C3PP_CACHE"]
+    if cache != None and not isinstance(cache, SampleCache):
+        cache = SampleCache(cache)
+
+    # Jobs sharing dataset, smoothing and nside share one accumulator
+    streams = {}
+    for dataset, command, fwhm, nside in jobs:
+        commands = tuple(command) if isinstance(command, (tuple, list)) else (command,)
+        st = streams.setdefault(h5stream(dataset, command, fwhm, nside), {"commands": (), "fwhms": ()})
+        st["commands"] += tuple(cmd for cmd in commands if cmd not in st["commands"])
+        st["fwhms"] += (fwhm,) if fwhm not in st["fwhms"] else ()
+
+    for (dataset, fwhm, nside), st in streams.items():
+        # mean, std and quantiles are accumulated on the fly, anything else needs all samples
+        st["streaming"] = all(cmd in (np.mean, np.std, np.median, np.percentile) for cmd in st["commands"])
+        st["q"] = q
+        # Smoothing commutes with the mean, so only smooth each sample if needed
+        st["persample"] = any(cmd != np.mean for cmd in st["commands"])
+        names = ", ".join(cmd.__name__ for cmd in st["commands"])
+        if (lowmem and not st["streaming"]):
+            print(f"     lowmem only supports np.mean, np.std, np.median and np.percentile, not {names}. Exiting")
+            sys.exit()
+        h5type(dataset)
+
+        print()
+        print("{:-^50}".format(f" {dataset} calculating {names} "))
+        smoothing = f"{fwhm}" if fwhm != None else ", ".join(str(f) for f in st["fwhms"])
+        print("{:-^50}".format(f" nside {nside}, {smoothing} arcmin smoothing "))
+
+    accs = {key: accumulator(st["commands"], st["q"]) for key, st in streams.items()}
+    types = {dataset: h5type(dataset) for dataset, fwhm, nside in streams}
+    lmaxs = {key: None for key in streams}
+
+    # Settings which must match for a saved state to be reused
+    meta = {"keys": [list(key) for key in streams], "persample": [st["persample"] for st in streams.values()],
+            "min": min, "alm2map": alm2map, "pixweight": pixweight, "zerospin": zerospin, "q": list(q), "bandlimit": bandlimit,}
+    last = {}
+    if (state != None or partial != None):
+        if not all(st["streaming"] for st in streams.values()):
+            print("     Accumulator state can only be saved for np.mean, np.std, np.median and np.percentile. Exiting")
+            sys.exit()
+    if state != None:
+        if os.path.isfile(state):
+            saved, saved_meta = load_state(state)
+            if all(saved_meta.get(k) == v for k, v in meta.items()):
+                print("{:-^48}".format(f" Resuming from {state} "))
+                accs, last = saved, saved_meta["last"]
+                types.update(saved_meta["types"])
+                lmaxs.update(zip(accs, saved_meta["lmaxs"]))
+            else:
+                print(f"State in {state} was made with other settings, starting over")
+
+    tasks = []
+    for c in range(1, maxchain + 1):
+        filename = input.replace("c0001", "c" + str(c).zfill(4))
+        # If no max is specified, chose last sample
+        smax = ChainIndex(filename).last if max == None else max
+        # Only samples not already in the saved state
+        smin = last.get(filename, min - 1) + 1
+        if smin <= smax:
+            tasks.append((filename, smin, smax))
+        last[filename] = smax if smin <= smax else smin - 1
+    if shard != None:
+        tasks = shard_tasks(tasks, shard)
+    tasks = split_tasks(tasks, nproc)
+
+    args = [(filename, smin, smax, streams, alm2map, pixweight, zerospin, nproc == 1, cache, prefetch, batch, nthreads, bandlimit) for filename, smin, smax in tasks]
+    if nproc > 1 and tasks:
+        print("{:-^48}".format(f" Reducing {len(tasks)} sample ranges on {nproc} processes "))
+        with process_pool(nproc) as executor:
+            parts = list(executor.map(h5partial, *zip(*args)))
     else:
-        print(f"Type {type} not recognized")
+        parts = [h5partial(*arg) for arg in args]
+
+    # Merge partial results in chain and sample order
+    for part_accs, part_types, part_lmaxs in parts:
+        for key in accs:
+            if streams[key]["streaming"]:
+                accs[key].merge(part_accs[key])
+            else:
+                accs[key] += part_accs[key]
+        types.update(part_types)
+        lmaxs.update({key: lmax for key, lmax in part_lmaxs.items() if lmax is not None})
+
+    if state != None:
+        meta.update(last=last, types=types, lmaxs=list(lmaxs.values()))
+        save_state(state, accs, meta)
+
+    if partial != None:
+        meta.update(types=types, lmaxs=list(lmaxs.values()), shard=list(shard),
+                    commands=[[cmd.__name__ for cmd in st["commands"]] for st in streams.values()],
+                    jobs=[[dataset, [cmd.__name__ for cmd in (command if isinstance(command, (tuple, list)) else (command,))], fwhm, nside] for dataset, command, fwhm, nside in jobs],)
+        save_state(partial, accs, meta)
+        print("{:-^48}".format(f" Shard {shard[0]} of {shard[1]} saved to {partial} "))
+        return None
+
+    return h5results(jobs, streams, accs, types, lmaxs, alm2map, pixweight, zerospin, nthreads)
+
+
+def h5results(jobs, streams, accs, types, lmaxs, alm2map=True, pixweight=None, zerospin=False, nthreads=0):
+    """
+    Results of each job in jobs from the accumulators of h5reduce. The
+    mean (when smoothing it commutes with averaging) is smoothed, or
+    synthesized from alms, here, with one map2alm for all fwhms of a map.
+    """
+    from src.sht import alm2map as synthesize
+
+    for key, st in streams.items():
+        if (not st["streaming"]):
+            # Convert list to array
+            accs[key] = np.array(accs[key])
+
+    pol = True if zerospin == False else False  # treat maps as TQU maps (polarization)
+    outputs = []
+    smoothed = {}
+    for dataset, command, fwhm, nside in jobs:
+        key = h5stream(dataset, command, fwhm, nside)
+        st, acc, lmax_h5 = streams[key], accs[key], lmaxs[key]
+        commands = tuple(command) if isinstance(command, (tuple, list)) else (command,)
+        results = []
+        for cmd in commands:
+            # Calculate std or mean
+            outdata = acc.result(cmd) if st["streaming"] else cmd(acc, axis=0)
+
+            # Smoothing afterwards when calculating mean
+            if types[dataset] == "alm" and not st["persample"] and alm2map:
+                print(f"# --- alm2map mean with {fwhm} arcmin, lmax {lmax_h5} ---")
+                outdata = synthesize(outdata, nside, lmax_h5, fwhm, pixwin=True, pol=pol, nthreads=nthreads)
+
+            if types[dataset] == "map" and fwhm > 0.0 and not st["persample"]:
+                if (key, cmd) not in smoothed:
+                    fwhms = sorted({job[2] for job in jobs if h5stream(*job) == key and job[2] > 0.0})
+                    print(f"--- Smoothing mean map with {', '.join(str(f) for f in fwhms)} arcmin,---")
+                    smoothed[(key, cmd)] = dict(zip(fwhms, smooth_map(outdata, fwhms, pol, pixweight)))
+                outdata = smoothed[(key, cmd)][fwhm]
+            results.append(outdata)
+        outputs.append(tuple(results) if isinstance(command, (tuple, list)) else results[0])
+    return outputs
+
+
+def h5stream(dataset, command, fwhm, nside):
+    """
+    Accumulator key of a h5reduce job. The mean is smoothed after
+    averaging, so means at any fwhm share one unsmoothed accumulator.
+    """
+    commands = tuple(command) if isinstance(command, (tuple, list)) else (command,)
+    if all(cmd == np.mean for cmd in commands):
+        return (dataset, None, nside)
+    return (dataset, fwhm, nside)
+
+
+def h5merge(partials, output):
+    """
+    Combines the accumulators saved by sharded h5handler runs into the
+    final results, written to output as h5handler would have.
+    """
+    names = {cmd.__name__: cmd for cmd in (np.mean, np.std, np.median, np.percentile)}
+    parts = sorted((load_state(partial) for partial in partials), key=lambda part: part[1]["shard"][0])
+    accs, meta = parts[0]
+    shards = [part_meta["shard"][0] for part_accs, part_meta in parts]
+    if shards != list(range(1, meta["shard"][1] + 1)):
+        print(f"Got shards {shards}, expected 1 to {meta['shard'][1]}. Exiting")
         sys.exit()
 
-    if (lowmem):
-        nsamp = 0 #track number of samples
-        first_samp = True #flag for first sample
-    else:
-        dats = []
+    settings = ("keys", "persample", "min", "alm2map", "pixweight", "zerospin", "q", "commands", "jobs", "bandlimit")
+    for part_accs, part_meta in parts[1:]:
+        if any(part_meta.get(k) != meta.get(k) for k in settings):
+            print(f"Shard {part_meta['shard'][0]} was made with other settings. Exiting")
+            sys.exit()
+        for key in accs:
+            accs[key].merge(part_accs[key])
+        meta["types"].update(part_meta["types"])
+        meta["lmaxs"] = [lmax if lmax is not None else other for lmax, other in zip(meta["lmaxs"], part_meta["lmaxs"])]
+
+    print("{:-^48}".format(f" Merged {len(parts)} shards, {sum(acc.n for acc in accs.values()) // len(accs)} samples "))
+    streams = {}
+    for key, commands, persample in zip(accs, meta["commands"], meta["persample"]):
+        commands = tuple(names[name] for name in commands)
+        streams[key] = {"commands": commands, "streaming": True, "persample": persample}
+    jobs = [(dataset, tuple(names[name] for name in commands), fwhm, nside) for dataset, commands, fwhm, nside in meta["jobs"]]
+    lmaxs = dict(zip(accs, meta["lmaxs"]))
+    outputs = h5results(jobs, streams, accs, meta["types"], lmaxs, meta["alm2map"], meta["pixweight"], meta["zerospin"])
+
+    fwhms = {fwhm for dataset, commands, fwhm, nside in jobs}
+    for (dataset, commands, fwhm, nside), results in zip(jobs, outputs):
+        lmax = lmaxs[h5stream(dataset, commands, fwhm, nside)] if meta["types"][dataset] == "alm" and meta["alm2map"] else None
+        for cmd, outdata in zip(commands, results):
+            write_output(output, outdata, cmd, meta["q"], suffix=len(commands) > 1, fwhm=fwhm if len(fwhms) > 1 else None, lmax=lmax)
+    return outputs
+
+def h5partial(filename, min, max, streams, alm2map=True, pixweight=None, zerospin=False, progress=True, cache=None, prefetch=2, batch=4, nthreads=0, bandlimit=None,):
+    """
+    Reduces samples min to max of a single chain file for h5reduce.
+    Returns the partial accumulators, dataset types and lmax per stream.
+    Smoothed or synthesized samples are looked up in cache first.
+    Reading, transforming (unpacking, alm2map, smoothing) and accumulating
+    run as a pipeline, with a reader thread keeping prefetch samples ahead
+    of a transform thread, which keeps prefetch samples ahead of the
+    accumulation. prefetch=0 does everything in turn.
+    alms are unpacked batch samples at a time, synthesized on nthreads
+    threads, and only read up to bandlimit times the largest nside of their streams.
+    """
+    import h5py
+    from tqdm import tqdm
+    from src.chainindex import ChainIndex
+    from src.sht import alm2maps, beam, band_limit
+
+    accs = {key: accumulator(st["commands"], st["q"]) for key, st in streams.items()}
+    types = {dataset: h5type(dataset) for dataset, fwhm, nside in streams}
+    lmaxs = {key: None for key in streams}
 
-    use_pixweights = False if pixweight == None else True
-    maxnone = True if max == None else False  # set length of keys for maxchains>1
     pol = True if zerospin == False else False  # treat maps as TQU maps (polarization)
+    index = ChainIndex(filename)
+
+    # Highest lmax needed of each dataset, None for all
+    lmax_read = {}
+    for dataset in types:
+        nsides = [nside for d, fwhm, nside in streams if d == dataset]
+        if alm2map and bandlimit != None and None not in nsides:
+            lmax_read[dataset] = band_limit(np.inf, np.max(nsides), bandlimit)
+
+    def read(sample):
+        # HDF dataset path formatting
+        s = str(sample).zfill(6)
+
+        # Look up samples already smoothed or synthesized in an earlier run
+        cached, ckeys = {}, {}
+        for (dataset, fwhm, nside), st in streams.items():
+            key = (dataset, fwhm, nside)
+            if cache is not None and h5derived(types[dataset], fwhm, st["persample"], alm2map):
+                ckeys[key] = cache.key(filename, f"{s}/{dataset}", nside=nside, fwhm=fwhm, lmax=None if bandlimit == None else bandlimit * nside, pixwin=True, pol=pol, pixweight=pixweight)
+                data = cache.get(ckeys[key])
+                if data is not None:
+                    cached[key] = data
+
+        # Read each dataset still needed once per sample, alms still packed
+        samples = {}
+        for dataset in types:
+            if any(key[0] == dataset and key not in cached for key in streams):
+                data, types[dataset], lmax_h5 = h5read(f, s, dataset, types[dataset], index, unpack=False, lmax=lmax_read.get(dataset))
+                samples[dataset] = data, types[dataset], lmax_h5
+        return cached, ckeys, samples
+
+    def transform(items):
+        derived = [{} for item in items]
+        smoothed = [{} for item in items]
+        for (dataset, fwhm, nside), st in streams.items():
+            key = (dataset, fwhm, nside)
+            todo = []
+            for (cached, ckeys, samples), out, done in zip(items, derived, smoothed):
+                if key in cached:
+                    out[key] = cached[key]
+                    continue
+                data, type, lmax_h5 = samples[dataset]
+                lmaxs[key] = band_limit(lmax_h5, nside, bandlimit) if type == "alm" and alm2map else lmax_h5
+
+                # If data is alm and calculating std. Bin to map and smooth first.
+                if type == "alm" and st["persample"] and alm2map:
+                    todo.append((data, ckeys, out))
+                    continue
+
+                # Other alms are accumulated as they are, unpacked once per sample
+                elif type == "alm":
+                    if (dataset, lmaxs[key]) not in done:
+                        alms = unpack_alms(data, lmaxs[key])  # Unpack alms
+                        done[(dataset, lmaxs[key])] = alms.ravel() if alms.shape[0] == 1 else alms
+                    data = done[(dataset, lmaxs[key])]
+
+                # If data is map, smooth first, to every fwhm from one map2alm.
+                elif type == "map" and st["persample"] and fwhm > 0.0:
+                    #print(f"#{sample} --- Smoothing map ---")
+                    if (dataset, fwhm) not in done:
+                        fwhms = sorted({k[1] for k in streams if k[0] == dataset and k not in cached and streams[k]["persample"] and k[1] > 0.0})
+                        done.update(((dataset, f), m) for f, m in zip(fwhms, smooth_map(data, fwhms, pol, pixweight)))
+                    data = done[(dataset, fwhm)]
+
+                if key in ckeys and h5derived(type, fwhm, st["persample"], alm2map):
+                    cache.put(ckeys[key], data)
+                out[key] = data
+
+            if todo:
+                # Beam and pixel window applied while unpacking the batch, then one synthesis per sample
+                packed = np.stack([data for data, ckeys, out in todo])
+                alms = unpack_alms(packed, lmaxs[key], fl=beam(nside, lmaxs[key], fwhm, True, pol, packed.shape[1]))
+                maps = alm2maps(alms[:, 0] if packed.shape[1] == 1 else alms, nside, lmaxs[key], pol=pol, pixwin=False, nthreads=nthreads)
+                for data, (alm, ckeys, out) in zip(maps, todo):
+                    if key in ckeys:
+                        cache.put(ckeys[key], data)
+                    out[key] = data
+        return derived
+
+    def batches(items):
+        items = iter(items)
+        while True:
+            chunk = list(itertools.islice(items, batch))
+            if not chunk:
+                return
+            yield chunk
+
+    with h5py.File(filename, "r") as f:
+        print("{:-^48}".format(f" Samples {min} to {max} in {filename}"))
+
+        samples = map(read, range(min, max + 1))
+        stages = []
+        if prefetch > 0:
+            # Start numba's thread pool here, as with tbb a pool first
+            # started by the transform thread hangs the process on exit
+            unpack_alms(np.zeros(1), 0)
+            # Read the next batch while the current one is transformed
+            depth = prefetch if prefetch > batch else batch
+            stages.append(readahead(samples, depth))
+            stages.append(readahead(map(transform, batches(stages[0])), 1))
+            samples = stages[-1]
+        else:
+            samples = map(transform, batches(samples))
+        samples = itertools.chain.from_iterable(samples)
+
+        try:
+            for derived in tqdm(samples, total=max - min + 1, ncols=80, disable=not progress):
+                for key, data in derived.items():
+                    if (streams[key]["streaming"]):
+                        accs[key].add(data)
+                    else:
+                        # Append sample to list
+                        accs[key].append(data)
+        finally:
+            # Transform, then reader thread stopped before the file is closed,
+            # also on errors, as threads left in numba's pool can hang the exit
+            for stage in reversed(stages):
+                stage.close()
+    return accs, types, lmaxs
+
+
+def readahead(iterable, depth=2):
+    """
+    Iterates over iterable in a background thread, which keeps up to depth
+    items ready for the consumer. Exceptions (and exits) are re-raised in
+    the consumer. The thread is stopped, and waited for, when the consumer
+    is done or the generator is closed.
+    """
+    import queue
+    import threading
+
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # False once the consumer has stopped
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            put((done, e))
+            return
+        put((done, None))
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def h5derived(type, fwhm, persample, alm2map):
+    """
+    True if samples of this type are synthesized or smoothed one by one.
+    """
+    return persample and ((type == "alm" and alm2map) or (type == "map" and fwhm > 0.0))
+
+
+def process_pool(nproc):
+    """
+    Process pool for reducing chains in parallel. Workers are spawned
+    rather than forked, as numba's thread pool does not survive a fork,
+    and share the cores between them (see pool_worker).
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    return ProcessPoolExecutor(max_workers=nproc, mp_context=multiprocessing.get_context("spawn"), initializer=pool_worker, initargs=(nproc,))
+
+
+def pool_worker(nproc):
+    """
+    Runs in each of nproc pool workers, giving it its share of the cores
+    for ducc0 transforms (unless $C3PP_SHT_THREADS or -nthreads are set)
+    and numba kernels, instead of every worker starting a thread per core.
+    """
+    import os
+
+    global kernel_threads
+    nthreads = max(1, (os.cpu_count() or 1) // nproc)
+    os.environ.setdefault("C3PP_SHT_THREADS", str(nthreads))
+    kernel_threads = min(nthreads, numba.config.NUMBA_NUM_THREADS)
+
+
+def split_tasks(tasks, nproc):
+    """
+    Splits (name, min, max) sample ranges into at least nproc
+    contiguous pieces, so single chains also use every process.
+    """
+    if not tasks or nproc <= len(tasks):
+        return tasks
+    nsplit = -(-nproc // len(tasks))  # ceil
+    split = []
+    for name, min, max in tasks:
+        edges = np.linspace(min, max + 1, nsplit + 1).astype(int)
+        split += [(name, lo, hi - 1) for lo, hi in zip(edges[:-1], edges[1:]) if hi > lo]
+    return split
+
+def shard_tasks(tasks, shard):
+    """
+    The i-th (from 1) of N contiguous slices of the (chain, sample) pairs
+    in tasks [(filename, min, max), ...], as tasks, for shard = (i, N).
+    """
+    i, N = shard
+    total = sum(smax - smin + 1 for filename, smin, smax in tasks)
+    lo, hi = total * (i - 1) // N, total * i // N
+    sharded = []
+    k = 0
+    for filename, smin, smax in tasks:
+        a, b = (min(max(x - k, 0), smax - smin + 1) for x in (lo, hi))
+        if a < b:
+            sharded.append((filename, smin + a, smin + b - 1))
+        k += smax - smin + 1
+    return sharded
+
+
+def h5tiled(input, dataset, min, max, maxchain, command, memory=4.0, nproc=1, q=(16, 50, 84),):
+    """
+    Function for calculating statistics of a map dataset in hdf file
+    out of core. For each pixel tile, f[tag][:, p0:p1] of all samples is
+    read into a buffer of at most memory GB, so any statistic, including
+    exact np.median and np.percentile (at q), is computed per tile.
+    With nproc > 1, tiles are spread over processes sharing the budget.
+    """
+    from tqdm import tqdm
+    from src.chainindex import ChainIndex
+
+    commands = tuple(command) if isinstance(command, (tuple, list)) else (command,)
+    names = ", ".join(cmd.__name__ for cmd in commands)
+    if h5type(dataset) != "map":
+        print(f"Tiled reduction only supports map datasets, not {dataset}. Exiting")
+        sys.exit()
+
+    print()
+    print("{:-^50}".format(f" {dataset} calculating {names} "))
+
+    tasks = []
     for c in range(1, maxchain + 1):
         filename = input.replace("c0001", "c" + str(c).zfill(4))
+        index = ChainIndex(filename)
+        # If no max is specified, chose last sample
+        smax = index.last if max == None else max
+        if c == 1:
+            nmaps, npix = index.shape(dataset)
+        tasks.append((filename, min, smax))
+        print("{:-^48}".format(f" Samples {min} to {smax} in {filename}"))
+    nsamp = sum(smax - smin + 1 for filename, smin, smax in tasks)
+
+    # Largest tile keeping all samples of it within the memory budget
+    ntile = int(memory * 1024**3 / nproc / (nsamp * nmaps * 8))
+    ntile = int(np.clip(ntile, 1, npix))
+    tiles = [(p0, p0 + ntile) for p0 in range(0, npix, ntile)]
+    print("{:-^50}".format(f" {len(tiles)} tiles of {ntile} pixels x {nsamp} samples "))
+
+    outputs = [np.zeros((len(q), nmaps, npix)) if cmd == np.percentile else np.zeros((nmaps, npix)) for cmd in commands]
+    args = [(tasks, dataset, p0, p1, commands, q) for p0, p1 in tiles]
+    if nproc > 1:
+        with process_pool(nproc) as executor:
+            results = executor.map(h5tile, *zip(*args))
+            for (p0, p1), result in tqdm(zip(tiles, results), total=len(tiles), ncols=80):
+                for outdata, res in zip(outputs, result):
+                    outdata[..., p0:p1] = res
+    else:
+        for (p0, p1), arg in tqdm(zip(tiles, args), total=len(tiles), ncols=80):
+            for outdata, res in zip(outputs, h5tile(*arg)):
+                outdata[..., p0:p1] = res
+
+    if nmaps == 1:
+        # Make sure its interprated as I by healpy
+        outputs = [outdata[..., 0, :] for outdata in outputs]
+
+    if isinstance(command, (tuple, list)):
+        return tuple(outputs)
+    return outputs[0]
+
+
+def h5tile(tasks, dataset, p0, p1, commands, q=(16, 50, 84),):
+    """
+    Reads pixels p0 to p1 of dataset for every (filename, min, max) in
+    tasks and returns the result of each command over samples.
+    """
+    import h5py
+
+    nsamp = sum(smax - smin + 1 for filename, smin, smax in tasks)
+    dats = None
+    i = 0
+    for filename, smin, smax in tasks:
         with h5py.File(filename, "r") as f:
-            if maxnone:
-                # If no max is specified, chose last sample
-                max = len(f.keys()) - 2
+            for sample in range(smin, smax + 1):
+                slab = f[f"{str(sample).zfill(6)}/{dataset}"][:, p0:p1]
+                if dats is None:
+                    dats = np.empty((nsamp,) + slab.shape, dtype=slab.dtype)
+                dats[i] = slab
+                i += 1
+    return [cmd(dats, q, axis=0) if cmd == np.percentile else cmd(dats, axis=0) for cmd in commands]
 
-            print("{:-^48}".format(f" Samples {min} to {max} in {filename}"))
 
-            for sample in tqdm(range(min, max + 1), ncols=80):
-                # Identify dataset
-                # alm, map or (sigma_l, which is recognized as l)
+def h5lmax(input, dataset, nside, bandlimit=None):
+    """
+    lmax maps of dataset in chain file input are synthesized with,
+    None if it holds maps.
+    """
+    from src.chainindex import ChainIndex
+    from src.sht import band_limit
 
-                # Unless output is ".fits" or "map", don't convert alms to map.
-                alm2map = True if output.endswith((".fits", "map")) else False
+    index = ChainIndex(input)
+    name = index.resolve(dataset)
+    lmax_h5 = index.value(f"{name[:-3]}lmax")
+    if h5type(name) != "alm" or lmax_h5 == None:
+        return None
+    return band_limit(lmax_h5, nside, bandlimit)
 
-                # HDF dataset path formatting
-                s = str(sample).zfill(6)
 
-                # Sets tag with type
-                tag = f"{s}/{dataset}"
-                #print(f"Reading c{str(c).zfill(4)} {tag}")
+def h5copy(input, output, mode="full", min=0, datasets=None, compression=None):
+    """
+    Copies chain file input to output.
+    full copies the file as is, link hard links it (or, across file
+    systems, reflinks it where supported) so nothing is copied.
+    subset writes only samples from min, and of those only the datasets
+    or groups in datasets (all if None), optionally gzip compressed at
+    level compression in chunks. Other top level groups are kept whole.
+    """
+    import os
+    import shutil
+    import h5py
 
-                # Check if map is available, if not, use alms.
-                # If alms is already chosen, no problem
-                try:
-                    data = f[tag][()]
-                    if len(data[0]) == 0:
-                        tag = f"{tag[:-3]}map"
-                        print(f"WARNING! No {type} data found, switching to map.")
-                        data = f[tag][()]
-                        type = "map"
-                except:
-                    print(f"Found no dataset called {dataset}")
-                    print(f"Trying alms instead {tag}")
-                    try:
-                        # Use alms instead (This takes longer and is not preferred)
-                        tag = f"{tag[:-3]}alm"
-                        type = "alm"
-                        data = f[tag][()]
-                    except:
-                        print("Dataset not found.")
-
-                # If data is alm, unpack.
-                if type == "alm":
-                    lmax_h5 = f[f"{tag[:-3]}lmax"][()]
-                    data = unpack_alms(data, lmax_h5)  # Unpack alms
-
-                if data.shape[0] == 1:
-                    # Make sure its interprated as I by healpy
-                    # For non-polarization data, (1,npix) is not accepted by healpy
-                    data = data.ravel()
+    if mode == "link":
+        if os.path.exists(output):
+            os.remove(output)
+        try:
+            os.link(input, output)
+            return
+        except OSError:
+            pass
+        try:
+            import fcntl
+            FICLONE = 0x40049409
+            with open(input, "rb") as src, open(output, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except (OSError, ImportError):
+            print(f"Could not link {input} to {output}, copying it")
+            mode = "full"
+
+    if mode == "full":
+        shutil.copyfile(input, output)
+        return
+
+    if mode != "subset":
+        print(f"Unknown copy mode {mode}, use full, subset or link. Exiting")
+        sys.exit()
 
-                # If data is alm and calculating std. Bin to map and smooth first.
-                if type == "alm" and command == np.std and alm2map:
-                    #print(f"#{sample} --- alm2map with {fwhm} arcmin, lmax {lmax_h5} ---")
-                    data = hp.alm2map(data, nside=nside, lmax=lmax_h5, fwhm=arcmin2rad(fwhm), pixwin=True,verbose=False,pol=pol,)
+    def selected(name):
+        return datasets == None or any(name == d or name.startswith(f"{d}/") for d in datasets)
+
+    # Written under a temporary name so readers never see partial files
+    tmp = f"{output}.{os.getpid()}.tmp"
+    with h5py.File(input, "r") as src, h5py.File(tmp, "w") as dst:
+        dst.attrs.update(src.attrs)
+        for key in src:
+            if not key.isdigit():
+                src.copy(src[key], dst, name=key)
+                continue
+            if int(key) < min:
+                continue
+            if datasets == None and compression == None:
+                src.copy(src[key], dst, name=key)
+                continue
+
+            def visit(name, obj):
+                if not isinstance(obj, h5py.Dataset) or not selected(name):
+                    return
+                path = f"{key}/{name}"
+                if compression == None or obj.shape == ():
+                    src.copy(obj, dst.require_group(os.path.dirname(path)), name=os.path.basename(path))
+                    return
+                dst.create_dataset(path, data=obj[()], chunks=True, compression="gzip", compression_opts=compression, shuffle=True)
+                dst[path].attrs.update(obj.attrs)
+            src[key].visititems(visit)
+    os.replace(tmp, output)
+
+
+def h5type(dataset):
+    """
+    Identify dataset type from its name
+    alm, map or (sigma_l, which is recognized as l)
+    """
+    if dataset.endswith("map"):
+        return "map"
+    elif dataset.endswith("rms"):
+        return "map"
+    elif dataset.endswith("alm"):
+        return "alm"
+    elif dataset.endswith("sigma"):
+        return "sigma"
+    print(f"Type of {dataset} not recognized")
+    sys.exit()
 
-                # If data is map, smooth first.
-                elif type == "map" and fwhm > 0.0 and command == np.std:
-                    #print(f"#{sample} --- Smoothing map ---")
-                    if use_pixweights:
-                        data = hp.sphtfunc.smoothing(data, fwhm=arcmin2rad(fwhm),verbose=False,pol=pol,use_pixel_weights=True,datapath=pixweight)
-                    else: #use ring weights
-                        data = hp.sphtfunc.smoothing(data, fwhm=arcmin2rad(fwhm),verbose=False,pol=pol,use_weights=True)
-
-                if (lowmem):
-                    if (first_samp):
-                        first_samp=False
-                        if (command==np.mean):
-                            dats=data.copy()
-                        elif (command==np.std):
-                            dats=(mean_data - data)**2
-                        else:
-                            print('     Unknown command {command}. Exiting')
-                            exit()
-                    else:
-                        if (command==np.mean):
-                            dats=dats+data
-                        elif (command==np.std):
-                            dats=dats+(mean_data - data)**2
-                    nsamp+=1
-                else:
-                    # Append sample to list
-                    dats.append(data)
-
-    if (lowmem):
-        if (command == np.mean):
-            outdata = dats/nsamp
-        elif (command == np.std):
-            outdata = np.sqrt(dats/nsamp)
+
+def h5read(f, s, dataset, type, index=None, unpack=True, lmax=None):
+    """
+    Reads dataset of sample s from open hdf file, unpacking alms
+    (unless unpack is False).
+    Returns data, (possibly switched) type and lmax (None for maps).
+    With a ChainIndex of the file, fallbacks and lmax come from it
+    instead of being probed.
+    If lmax is given, alms are cut to at most lmax, and with an index
+    only those are read.
+    """
+    # Sets tag with type
+    tag = f"{s}/{dataset}"
+
+    if index is not None:
+        tag = f"{s}/{index.resolve(dataset)}"
+        type = h5type(tag)
+        lmax_h5 = index.value(f"{tag[7:-3]}lmax") if type == "alm" else None
+        if lmax is not None and lmax_h5 is not None and lmax < lmax_h5:
+            data = f[tag][:, :(lmax + 1) ** 2]
+        else:
+            data = f[tag][()]
     else:
-        # Convert list to array
-        dats = np.array(dats)
-        # Calculate std or mean
-        outdata = command(dats, axis=0)
-
-    # Smoothing afterwards when calculating mean
-    if type == "alm" and command == np.mean and alm2map:
-        print(f"# --- alm2map mean with {fwhm} arcmin, lmax {lmax_h5} ---")
-        outdata = hp.alm2map(
-            outdata, nside=nside, lmax=lmax_h5, fwhm=arcmin2rad(fwhm), pixwin=True, pol=pol
-        )
-
-    if type == "map" and fwhm > 0.0 and command == np.mean:
-        print(f"--- Smoothing mean map with {fwhm} arcmin,---")
-        if use_pixweights:
-            outdata = hp.sphtfunc.smoothing(outdata, fwhm=arcmin2rad(fwhm),verbose=False,pol=pol,use_pixel_weights=True,datapath=pixweight)
-        else: #use ring weights
-            outdata = hp.sphtfunc.smoothing(outdata, fwhm=arcmin2rad(fwhm),verbose=False,pol=pol,use_weights=True)
-
-    # Outputs fits map if output name is .fits
-    if output.endswith(".fits"):
-        hp.write_map(output, outdata, overwrite=True, dtype=None)
-    elif output.endswith(".dat"):
-        np.savetxt(output, outdata)
-    return outdata
+        # Check if map is available, if not, use alms.
+        # If alms is already chosen, no problem
+        try:
+            data = f[tag][()]
+            if len(data[0]) == 0:
+                tag = f"{tag[:-3]}map"
+                print(f"WARNING! No {type} data found, switching to map.")
+                data = f[tag][()]
+                type = "map"
+        except:
+            print(f"Found no dataset called {dataset}")
+            print(f"Trying alms instead {tag}")
+            try:
+                # Use alms instead (This takes longer and is not preferred)
+                tag = f"{tag[:-3]}alm"
+                type = "alm"
+                data = f[tag][()]
+            except:
+                print("Dataset not found.")
+
+    # If data is alm, unpack.
+    lmax_h5 = None
+    if type == "alm":
+        lmax_h5 = None if index is None else index.value(f"{tag[7:-3]}lmax")
+        if lmax_h5 is None:
+            lmax_h5 = f[f"{tag[:-3]}lmax"][()]
+        if lmax is not None and lmax < lmax_h5:
+            data, lmax_h5 = data[:, :(lmax + 1) ** 2], lmax
+        if not unpack:
+            return data, type, lmax_h5
+        data = unpack_alms(data, lmax_h5)  # Unpack alms
+
+    if data.shape[0] == 1:
+        # Make sure its interprated as I by healpy
+        # For non-polarization data, (1,npix) is not accepted by healpy
+        data = data.ravel()
+    return data, type, lmax_h5
+
+
+def smooth_map(m, fwhm, pol=True, pixweight=None):
+    """
+    Smooths map with gaussian beam of fwhm arcmin,
+    using pixel weights if a path is given, else ring weights.
+    If fwhm is a list, returns a list of maps, one per fwhm.
+    """
+    from src.sht import smoothing
+
+    return smoothing(m, fwhm, pol=pol, use_weights=not pixweight, pixweight=pixweight or None)
+
+def reference_map(filename, fwhm=0.0, nside=None, field=(0,1,2), scale=1.0, monopole=False, mask=None, cache=None):
+    """
+    Map(s) field of filename, smoothed to fwhm arcmin (and ud_graded to
+    nside if given), times scale, and if monopole, with the mean of each map
+    subtracted, or with a mask, the monopole of the first fitted outside it.
+    Smoothed or regraded maps are kept in a SampleCache if cache is given
+    (or $C3PP_CACHE set), keyed by the files and settings, so later calls
+    only read them back.
+    """
+    import os
+    import healpy as hp
+    from src.cache import SampleCache
+
+    if cache == None and os.environ.get("C3PP_CACHE"):
+        cache = os.environ["C3PP_CACHE"]
+    # Plain reads are as fast as reading the map back from the cache
+    if fwhm <= 0.0 and nside == None:
+        cache = None
+    if cache != None and not isinstance(cache, SampleCache):
+        cache = SampleCache(cache)
+
+    if cache != None:
+        key = cache.key(filename, "reference", fwhm=fwhm, nside=nside, field=field, scale=scale, monopole=monopole,
+                        mask=mask and os.path.abspath(mask), mask_mtime=mask and os.stat(mask).st_mtime_ns)
+        m = cache.get(key)
+        if m is not None:
+            return m
+
+    m = hp.read_map(filename, field=field, verbose=False, dtype=np.float64)
+    if fwhm > 0.0:
+        from src.sht import smoothing
+        m = smoothing(m, fwhm, nside=nside)
+    elif nside != None and nside != hp.npix2nside(np.shape(m)[-1]):
+        m = hp.ud_grade(m, nside)
+    m = np.asarray(m) * scale
+
+    if monopole and mask != None:
+        m_masked = hp.ma(m[0] if m.ndim > 1 else m)
+        m_masked.mask = np.logical_not(hp.read_map(mask, verbose=False, dtype=bool))
+        mono = hp.fit_monopole(m_masked)
+        print(f"{os.path.basename(filename)} subtracting monopole {mono}")
+        if m.ndim > 1:
+            m[0] = m[0] - mono
+        else:
+            m = m - mono
+    elif monopole:
+        m -= np.mean(m, axis=-1, keepdims=True)
+
+    if cache != None:
+        cache.put(key, m)
+    return m
+
 
 def arcmin2rad(arcmin):
     return arcmin * (2 * np.pi) / 21600
@@ -410,21 +1467,42 @@ def rspectrum(nu, r, sig, scaling=1.0):
 
 
 
-def fits_handler(input, min, max, minchain, maxchain, chdir, output, fwhm, nside, zerospin, drop_missing, pixweight, command, lowmem=False, fields=None, write=False):
+def fits_handler(input, min, max, minchain, maxchain, chdir, output, fwhm, nside, zerospin, drop_missing, pixweight, command, lowmem=False, fields=None, write=False, nproc=1, state=None, q=(16, 50, 84)):
     """
     Function for handling fits files.
+    If command is a tuple, ex. (np.mean, np.std), all statistics are
+    calculated from a single read of each sample and returned as a tuple.
+    np.median and np.percentile (at q) are estimated while streaming.
+    With nproc > 1, samples are read and preprocessed (reordered,
+    ud_graded, smoothed) in nproc processes, and handed back in shared
+    memory to be accumulated in order, so results are identical to nproc=1.
+    If state is a sidecar file, the accumulator is saved to it, and a
+    later run with the same settings only reads samples added since.
+    If fwhm is a list, every sample is read once, and a list with the
+    result for each fwhm is returned (or written to output_{fwhm}arcmin).
     """
     # Check if you want to output a map
-    import healpy as hp
-    from tqdm import tqdm
     import os
 
     if (not input.endswith(".fits")):
         print("Input file must be a '.fits'-file")
         exit()
 
-    if (lowmem and command == np.std): #need to compute mean first
-        mean_data = fits_handler(input, min, max, minchain, maxchain, chdir, output, fwhm, nside, zerospin, drop_missing, pixweight, lowmem, np.mean, fields, write=False)
+    commands = tuple(command) if isinstance(command, (tuple, list)) else (command,)
+    fwhms = tuple(fwhm) if isinstance(fwhm, (tuple, list)) else (fwhm,)
+    # mean, std and quantiles are accumulated on the fly, anything else needs all samples
+    streaming = all(cmd in (np.mean, np.std, np.median, np.percentile) for cmd in commands)
+    # Smoothing commutes with the mean, so only smooth each sample if needed
+    persample = any(cmd != np.mean for cmd in commands)
+    names = ", ".join(cmd.__name__ for cmd in commands)
+
+    if (lowmem and not streaming):
+        print(f"     lowmem only supports np.mean, np.std, np.median and np.percentile, not {names}. Exiting")
+        exit()
+
+    if (state != None and not streaming):
+        print("     Accumulator state can only be saved for np.mean, np.std, np.median and np.percentile. Exiting")
+        exit()
 
     if (minchain > maxchain):
         print('Minimum chain number larger that maximum chain number. Exiting')
@@ -432,188 +1510,388 @@ def fits_handler(input, min, max, minchain, maxchain, chdir, output, fwhm, nside
     aline=input.split('/')
     dataset=aline[-1]
     print()
-    print("{:-^50}".format(f" {dataset} calculating {command.__name__} "))
+    print("{:-^50}".format(f" {dataset} calculating {names} "))
+    smoothing = ", ".join(str(f) for f in fwhms)
     if (nside == None):
-        print("{:-^50}".format(f" {fwhm} arcmin smoothing "))
+        print("{:-^50}".format(f" {smoothing} arcmin smoothing "))
     else:
-        print("{:-^50}".format(f" nside {nside}, {fwhm} arcmin smoothing "))
-
-    type = 'map'
-
-    if (not lowmem):
-        dats = []
-
-    nsamp = 0 #track number of samples
-    first_samp = True #flag for first sample
+        print("{:-^50}".format(f" nside {nside}, {smoothing} arcmin smoothing "))
 
     use_pixweights = False if pixweight == None else True
     maxnone = True if max == None else False  # set length of keys for maxchains>1
     pol = True if zerospin == False else False  # treat maps as TQU maps (polarization)
+
+    # One accumulator per fwhm if smoothing each sample, else the mean is smoothed afterwards
+    accs = [accumulator(commands, q) for f in (fwhms if persample else (None,))]
+    # Settings which must match for a saved state to be reused
+    meta = {"keys": [[input, f, nside] for f in (fwhms if persample else (None,))], "persample": [persample], "min": min, "fields": fields, "pixweight": pixweight, "zerospin": zerospin, "q": list(q),}
+    last, nest = {}, None
+    if (state != None and os.path.isfile(state)):
+        saved, saved_meta = load_state(state)
+        if all(saved_meta.get(k) == (list(v) if isinstance(v, tuple) else v) for k, v in meta.items()):
+            print("{:-^48}".format(f" Resuming from {state} "))
+            accs, last, nest = list(saved.values()), saved_meta["last"], saved_meta.get("nest")
+        else:
+            print(f"State in {state} was made with other settings, starting over")
+
+    tasks = []
+    index = {} # Samples found in each chain directory, scanned once
     for c in range(minchain, maxchain + 1):
         if (chdir==None):
             filename = input.replace("c0001", "c" + str(c).zfill(4))
         else:
             filename = chdir+'_c%i/'%(c)+input
         basefile = filename.split("k000001")
+        found = fits_samples(basefile, index)
 
         if maxnone:
             # If no max is specified, find last sample of chain
             # Assume residual file of convention res_label_c0001_k000234.fits, 
             # i.e. final numbers of file are sample number
-            max_found = False
-            siter=min
-            while (not max_found):
-                filename = basefile[0]+'k'+str(siter).zfill(6)+basefile[1]
+            max = min
+            while max in found:
+                max += 1
+            max -= 1
+        else:
+            for siter in range(min, max+1):
+                if siter not in found:
+                    print('chain %i, sample %i missing'%(c,siter))
+                    print(basefile[0]+'k'+str(siter).zfill(6)+basefile[1])
+                    if (not drop_missing):
+                        exit()
 
-                if (os.path.isfile(filename)):
-                    siter += 1
-                else:
-                    max_found = True
-                    max = siter - 1
+        # Only samples not already in the saved state
+        smin = last.get("k*".join(basefile), min - 1) + 1
+        samples = [siter for siter in range(smin, max + 1) if siter in found]
+        if samples:
+            tasks.append((basefile, samples))
+        last["k*".join(basefile)] = max if smin <= max else smin - 1
+    args = [(basefile, samples, fields, nside, list(fwhms), pol, use_pixweights, pixweight, persample, commands, q) for basefile, samples in tasks]
+    if nproc > 1 and tasks:
+        print("{:-^48}".format(f" Reading samples on {nproc} processes "))
+        with process_pool(nproc) as executor:
+            parts = [fits_partial(*arg, pool=executor, depth=2 * nproc) for arg in args]
+    else:
+        parts = [fits_partial(*arg) for arg in args]
+
+    # Merge partial results in chain and sample order
+    for part, part_nest in parts:
+        # Samples are accumulated in the pixel ordering of the chain
+        if nest != None and part_nest != nest:
+            print("Chains are not all in the same pixel ordering. Exiting")
+            exit()
+        nest = part_nest
+        for i in range(len(accs)):
+            if (streaming):
+                accs[i].merge(part[i])
+            else:
+                accs[i] += part[i]
+
+    if state != None:
+        meta.update(last=last, nest=nest)
+        save_state(state, {tuple(key): acc for key, acc in zip(meta["keys"], accs)}, meta)
+
+    if (not streaming):
+        # Convert list to array
+        accs = [np.array(acc) for acc in accs]
+
+    results = []
+    smoothed = {}
+    for i, f in enumerate(fwhms):
+        acc = accs[i if persample else 0]
+        outputs = []
+        for cmd in commands:
+            # Calculate std or mean
+            outdata = acc.result(cmd) if streaming else cmd(acc, axis=0)
+            if nest:
+                # Reorder only the output to ring
+                outdata = reorder(outdata, n2r=True)
+
+            # Smoothing afterwards when calculating mean, one map2alm for all fwhms
+            if f > 0.0 and not persample:
+                if cmd not in smoothed:
+                    positive = [f for f in fwhms if f > 0.0]
+                    print(f"--- Smoothing mean map with {', '.join(str(f) for f in positive)} arcmin,---")
+                    smoothed[cmd] = dict(zip(positive, smooth_map(outdata, positive, pol, pixweight)))
+                outdata = smoothed[cmd][f]
+
+            # Outputs fits map if output name is .fits
+            if write:
+                write_output(output, outdata, cmd, q, suffix=len(commands) > 1, fwhm=f if len(fwhms) > 1 else None)
+            outputs.append(outdata)
+        results.append(tuple(outputs) if isinstance(command, (tuple, list)) else outputs[0])
+
+    if not write:
+        if isinstance(fwhm, (tuple, list)):
+            return results
+        return results[0]
+
+
+def fits_samples(basefile, index):
+    """
+    Sample numbers found of the fits chain basefile[0]k{sample}basefile[1].
+    Its directory is scanned once, with the samples of every chain in it
+    (..._c{chain}_k{sample}.fits) recorded in index, so further chains in
+    the same directory need no scan.
+    """
+    import os
+    import re
+
+    directory, prefix = os.path.split(basefile[0])
+    directory = directory or "."
+    if directory not in index:
+        pattern = re.compile(r"^(.*)k(\d{6})(.*\.fits)$")
+        chains = {}
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            entries = []
+        for entry in entries:
+            match = pattern.match(entry.name)
+            if match:
+                chains.setdefault((match.group(1), match.group(3)), set()).add(int(match.group(2)))
+        index[directory] = chains
+    return index[directory].get((prefix, basefile[1]), set())
+
+
+def fits_partial(basefile, samples, fields, nside, fwhm, pol, use_pixweights, pixweight, persample, commands, q, progress=True, pool=None, depth=2):
+    """
+    Reduces the given samples of a single fits chain for fits_handler.
+    Returns the partial accumulators (Moments, Quantiles or list of samples),
+    one per fwhm if smoothing each sample, else one.
+    With a process pool, up to depth samples are read and preprocessed by
+    its workers at a time, and accumulated from shared memory in order.
+    """
+    from tqdm import tqdm
+    from multiprocessing import shared_memory
+    from src.fitsmap import header as read_header
+
+    fwhms = fwhm if isinstance(fwhm, (tuple, list)) else [fwhm]
+    accs = [accumulator(commands, q) for f in (fwhms if persample else [None])]
+    streaming = not isinstance(accs[0], list)
+
+    print("{:-^48}".format(f" Samples {samples[0]} to {samples[-1]} in {basefile[0]}k*{basefile[1]}"))
+
+    # dataset sample formatting
+    files = [basefile[0]+'k'+str(sample).zfill(6)+basefile[1] for sample in samples]
+
+    # Check which fields the input maps have
+    header = read_header(files[0])
+    if fields!=None:
+        nfields = 0
+        for par in header:
+            if (par[0] == 'TFIELDS'):
+                nfields = par[1]
+                break
+        if (nfields == 0):
+            print('No fields/maps in input file')
+            exit()
+        elif (nfields == 1):
+            fields=(0)
+        elif (nfields == 2):
+            fields=(0,1)
+        elif (nfields == 3):
+            fields=(0,1,2)
+    #print('   Reading fields ',fields)
+
+    nest = False
+    for par in header:
+        if (par[0] == 'ORDERING'):
+            if (not par[1] == 'RING'):
+                nest = True
+            break
 
-        else:
-            if (first_samp):
-                for chiter in range(minchain,maxchain + 1):
-                    if (chdir==None):
-                        tempname = input.replace("c0001", "c" + str(c).zfill(4))
+    for par in header:
+        if (par[0] == 'NSIDE'):
+            nside_map = par[1]
+            break
+
+
+    if (not nside == None):
+        if (nside > nside_map):
+            print('   Specified nside larger than that of the input maps')
+            print('   Not up-grading the maps')
+            print('')
+
+    args = (fields, nest, nside, nside_map, fwhms, pol, pixweight, persample)
+    if pool is None:
+        samples = (fits_sample(filename, *args) for filename in files)
+    else:
+        # Blocks of samples read ahead but not accumulated are unlinked on errors
+        samples = pooled(pool, fits_sample_shared, [(filename,) + args for filename in files], depth, discard=unlink_shared)
+
+    try:
+        for maps in tqdm(samples, total=len(files), ncols=80, disable=not progress):
+            shms = []
+            if pool is not None:
+                # Accumulate straight from the workers' shared memory
+                blocks, maps = maps, []
+                try:
+                    shms = [shared_memory.SharedMemory(name=name) for name, shape, dtype in blocks]
+                    maps = [np.ndarray(shape, dtype, buffer=shm.buf) for shm, (name, shape, dtype) in zip(shms, blocks)]
+                except BaseException:
+                    unlink_shared(blocks)
+                    raise
+
+            try:
+                for acc, m in zip(accs, maps):
+                    if (streaming):
+                        acc.add(m)
                     else:
-                        tempname = chdir+'_c%i/'%(c)+input
-                        temp = tempname.split("k000001")
+                        # Append sample to list
+                        acc.append(np.array(m) if shms else m)
+            finally:
+                maps = m = None
+                for shm in shms:
+                    shm.unlink()
+                    try:
+                        shm.close()
+                    except BufferError:
+                        pass # Still viewed from a traceback, unmapped with it
+    finally:
+        if pool is not None:
+            samples.close()
+    # Samples are only reordered to ring if smoothed
+    return accs, nest and not fits_smoothed(fwhms, persample)
 
-                    for siter in range(min,max+1):
-                        tempf = temp[0]+'k'+str(siter).zfill(6)+temp[1]
 
-                        if (not os.path.isfile(tempf)):
-                            print('chain %i, sample %i missing'%(c,siter))
-                            print(tempf)
-                            if (not drop_missing):
-                                exit()
+def fits_smoothed(fwhms, persample):
+    return persample and any(f > 0.0 for f in fwhms)
 
 
-        print("{:-^48}".format(f" Samples {min} to {max} in {filename}"))
+def fits_sample(filename, fields, nest, nside, nside_map, fwhms, pol, pixweight, persample):
+    """
+    Reads a fits sample for fits_partial, degraded to nside if lower, and
+    if persample, smoothed to each of fwhms. Nested maps are degraded in
+    nest, and only reordered to ring if smoothed.
+    Returns a list of maps, one per fwhm if persample, else one.
+    """
+    from src.fitsmap import read_map
 
-        for sample in tqdm(range(min, max + 1), ncols=80):
-                # dataset sample formatting
-                filename = basefile[0]+'k'+str(sample).zfill(6)+basefile[1]                
-                if (first_samp):
-                    # Check which fields the input maps have
-                    if (not os.path.isfile(filename)):
-                        if (not drop_missing):
-                            exit()
-                        else:
-                            continue
-                    
-                    _, header = hp.fitsfunc.read_map(filename, verbose=False, h=True, dtype=None)
-                    if fields!=None:
-                        nfields = 0
-                        for par in header:
-                            if (par[0] == 'TFIELDS'):
-                                nfields = par[1]
-                                break
-                        if (nfields == 0):
-                            print('No fields/maps in input file')
-                            exit()
-                        elif (nfields == 1):
-                            fields=(0)
-                        elif (nfields == 2):
-                            fields=(0,1)
-                        elif (nfields == 3):
-                            fields=(0,1,2)
-                    #print('   Reading fields ',fields)
-
-                    nest = False
-                    for par in header:
-                        if (par[0] == 'ORDERING'):
-                            if (not par[1] == 'RING'):
-                                nest = True
-                            break
-
-                    nest = False
-                    for par in header:
-                        if (par[0] == 'NSIDE'):
-                            nside_map = par[1]
-                            break
-
-
-                    if (not nside == None):
-                        if (nside > nside_map):
-                            print('   Specified nside larger than that of the input maps')
-                            print('   Not up-grading the maps')
-                            print('')
-
-                if (not os.path.isfile(filename)):
-                    if (not drop_missing):
-                        exit()
-                    else:
-                        continue
+    data = read_map(filename, field=fields, nest=None)
 
-                data = hp.fitsfunc.read_map(filename,field=fields,verbose=False,h=False, nest=nest, dtype=None)
-                if (nest): #need to reorder to ring-ordering
-                    data = hp.pixelfunc.reorder(data,n2r=True)
+    # degrading if relevant
+    if (not nside == None):
+        if (nside < nside_map):
+            data = degrade(data, nside, nest)
 
-                # degrading if relevant
-                if (not nside == None):
-                    if (nside < nside_map):
-                        data=hp.pixelfunc.ud_grade(data,nside) #ordering=ring by default
+    if nest and fits_smoothed(fwhms, persample):
+        data = reorder(data, n2r=True)
 
-                if data.shape[0] == 1:
-                    # Make sure its interprated as I by healpy
-                    # For non-polarization data, (1,npix) is not accepted by healpy
-                    data = data.ravel()
+    if data.shape[0] == 1:
+        # Make sure its interprated as I by healpy
+        # For non-polarization data, (1,npix) is not accepted by healpy
+        data = data.ravel()
 
-                # If smoothing applied and calculating stddev, smooth first.
-                if fwhm > 0.0 and command == np.std:
-                    #print(f"#{sample} --- Smoothing map ---")
-                    if use_pixweights:
-                        data = hp.sphtfunc.smoothing(data, fwhm=arcmin2rad(fwhm),verbose=False,pol=pol,use_pixel_weights=True,datapath=pixweight)
-                    else: #use ring weights
-                        data = hp.sphtfunc.smoothing(data, fwhm=arcmin2rad(fwhm),verbose=False,pol=pol,use_weights=True)
-                    
-                if (lowmem):
-                    if (first_samp):
-                        if (command==np.mean):
-                            dats=data.copy()
-                        elif (command==np.std):
-                            dats=(mean_data - data)**2
-                        else:
-                            print('     Unknown command {command}. Exiting')
-                            exit()
-                    else:
-                        if (command==np.mean):
-                            dats=dats+data
-                        elif (command==np.std):
-                            dats=dats+(mean_data - data)**2
-                    nsamp+=1
-                else:
-                    # Append sample to list
-                    dats.append(data)
-                first_samp=False
-
-    if (lowmem):
-        if (command == np.mean):
-            outdata = dats/nsamp
-        elif (command == np.std):
-            outdata = np.sqrt(dats/nsamp)
-    else:
-        # Convert list to array
-        dats = np.array(dats)
-        # Calculate std or mean
-        outdata = command(dats, axis=0)
-
-    # Smoothing afterwards when calculating mean
-    if fwhm > 0.0 and command == np.mean:
-        print(f"--- Smoothing mean map with {fwhm} arcmin,---")
-        if use_pixweights:
-            outdata = hp.sphtfunc.smoothing(outdata, fwhm=arcmin2rad(fwhm),verbose=False,pol=pol,use_pixel_weights=True,datapath=pixweight)
-        else: #use ring weights
-            outdata = hp.sphtfunc.smoothing(outdata, fwhm=arcmin2rad(fwhm),verbose=False,pol=pol,use_weights=True)
-
-    # Outputs fits map if output name is .fits
-    if write:
-        if output.endswith(".fits"):
-            hp.write_map(output, outdata, overwrite=True, dtype=None)
-        elif output.endswith(".dat"):
-            np.savetxt(output, outdata)
-    else:
-        return outdata
+    # If smoothing applied and calculating stddev, smooth first.
+    if not persample:
+        return [data]
+    #print(f"#{sample} --- Smoothing map ---")
+    positive = [f for f in fwhms if f > 0.0]
+    smoothed = dict(zip(positive, smooth_map(data, positive, pol, pixweight))) if positive else {}
+    return [smoothed.get(f, data) for f in fwhms]
+
+
+def degrade(m, nside, nest=False):
+    """
+    Map(s) m, shape ([nmaps,] npix), degraded to nside as hp.ud_grade with
+    order_in = order_out. In nest, each output pixel is the mean of a
+    contiguous block of input pixels, ignoring bad ones, so this is a
+    reshape and a sum. Ring maps are reordered to nest and back.
+    """
+    import healpy as hp
+
+    m = np.asarray(m)
+    if not nest:
+        m = reorder(m, n2r=False)
+    npix = 12 * nside ** 2
+    block = m.reshape(m.shape[:-1] + (npix, m.shape[-1] // npix))
+    goods = ~(hp.mask_bad(block) | ~np.isfinite(block))
+    out = np.sum(np.where(goods, block, 0), axis=-1).astype(m.dtype)
+    nhit = goods.sum(axis=-1)
+    out[nhit != 0] /= nhit[nhit != 0]
+    out[nhit == 0] = hp.UNSEEN
+    return out if nest else reorder(out, n2r=True)
+
+
+def reorder(m, n2r=False):
+    """
+    Map(s) m, shape ([nmaps,] npix), reordered from nest to ring (n2r) or
+    ring to nest, as hp.reorder without masking bad pixels.
+    """
+    import healpy as hp
+
+    return np.take(m, reorder_index(hp.npix2nside(np.shape(m)[-1]), n2r), axis=-1)
+
+
+@functools.lru_cache(maxsize=None)
+def reorder_index(nside, n2r):
+    import healpy as hp
 
+    pix = np.arange(12 * nside ** 2)
+    return hp.ring2nest(nside, pix) if n2r else hp.nest2ring(nside, pix)
+
+
+def fits_sample_shared(filename, *args):
+    """
+    fits_sample in a worker process, with each map copied to a new shared
+    memory block. Returns their (name, shape, dtype), the receiver unlinks them.
+    """
+    from multiprocessing import shared_memory
+
+    blocks = []
+    try:
+        for m in fits_sample(filename, *args):
+            m = np.ascontiguousarray(m)
+            shm = shared_memory.SharedMemory(create=True, size=m.nbytes or 1)
+            blocks.append((shm.name, m.shape, m.dtype.str))
+            np.ndarray(m.shape, m.dtype, buffer=shm.buf)[...] = m
+            shm.close()
+    except BaseException:
+        # Nobody receives the blocks made so far
+        unlink_shared(blocks)
+        raise
+    return blocks
+
+
+def unlink_shared(blocks):
+    """
+    Unlinks the shared memory blocks (name, shape, dtype) of fits_sample_shared.
+    """
+    from multiprocessing import shared_memory
+
+    for name, shape, dtype in blocks:
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            continue
+        shm.close()
+        shm.unlink()
+
+
+def pooled(executor, fn, args, depth=2, discard=None):
+    """
+    Results of fn(*arg) for each arg in args, in order, computed by executor
+    with at most depth calls in flight. If a call fails or the generator is
+    closed early, the calls not started are cancelled, and discard is called
+    on the results of the others, which are never yielded.
+    """
+    import collections
+
+    pending = collections.deque()
+    try:
+        for arg in args:
+            pending.append(executor.submit(fn, *arg))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            if future.cancel() or discard == None:
+                continue
+            try:
+                result = future.result()
+            except Exception:
+                continue
+            discard(result)
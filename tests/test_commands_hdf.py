@@ -0,0 +1,19 @@
+import numpy as np
+
+from src.commands_hdf import sigma_l2fits
+
+
+def test_sigma_l2fits_row_0_counts_top_level_groups(tmp_path):
+    import h5py
+
+    rng = np.random.default_rng(4)
+    for nc, nsamples in [(1, 5), (2, 4)]:
+        with h5py.File(tmp_path / f"chain_c{nc:04d}.h5", "w") as f:
+            for s in range(nsamples):
+                f[f"{s:06d}/cmb/sigma_l"] = rng.normal(size=(6, 11))
+            f.create_group("parameters")
+
+    dset = sigma_l2fits.callback(str(tmp_path / "chain"), 2, 0, "cmb/sigma_l", "", "", save=False)
+    assert dset.shape == (6, 2, 6, 11)
+    # 4 samples and parameters in the last chain, as counted before ChainIndex
+    assert np.all(dset[0] == 4 + 1 - 2)
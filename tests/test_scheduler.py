@@ -0,0 +1,45 @@
+import os
+import time
+
+from src.scheduler import run_tasks
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+
+
+def crash(seconds):
+    # As a worker killed for running out of memory
+    time.sleep(seconds)
+    os._exit(1)
+
+
+def task(fn, seconds, deps=()):
+    return {"fn": fn, "kwargs": {"seconds": seconds}, "deps": list(deps), "memory": 0.0}
+
+
+def test_worker_crash_fails_only_its_task(capsys):
+    tasks = {
+        "crash": task(crash, 0.5),
+        "sleep": task(sleep, 1.0),
+        "after crash": task(sleep, 0.0, ["crash"]),
+        "after sleep": task(sleep, 0.0, ["sleep"]),
+    }
+    report = run_tasks(tasks, nproc=2)
+    status = {name: status for name, (status, seconds, error) in report.items()}
+    assert status == {"crash": "failed", "sleep": "ok", "after crash": "skipped", "after sleep": "ok"}
+    assert "worker process died" in report["crash"][2]
+    assert "2 of 4 tasks succeeded" in capsys.readouterr().out
+
+
+def test_summary_printed_when_a_task_stops_run_tasks(capsys):
+    def stop(name):
+        raise KeyboardInterrupt
+
+    tasks = {"first": task(sleep, 0.0), "second": task(sleep, 0.0, ["first"])}
+    try:
+        run_tasks(tasks, done=stop)
+    except KeyboardInterrupt:
+        pass
+    out = capsys.readouterr().out
+    assert "Summary" in out and "not run" in out
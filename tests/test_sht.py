@@ -0,0 +1,99 @@
+import numpy as np
+import healpy as hp
+import pytest
+
+from src import sht
+
+needs_ducc0 = pytest.mark.skipif(not sht.has_ducc0(), reason="ducc0 not installed")
+BACKENDS = ["healpy", pytest.param("ducc0", marks=needs_ducc0)]
+
+
+def random_alms(lmax, ncomp, seed=0):
+    """
+    Random healpy alms, shape (ncomp, nalm), real for m=0, and without
+    l < 2 in E and B.
+    """
+    rng = np.random.default_rng(seed)
+    nalm = hp.Alm.getsize(lmax)
+    alms = rng.normal(size=(ncomp, nalm)) + 1j * rng.normal(size=(ncomp, nalm))
+    alms[:, :lmax + 1] = alms[:, :lmax + 1].real
+    if ncomp == 3:
+        alms[1:, hp.Alm.getidx(lmax, np.array([0, 1, 1]), np.array([0, 0, 1]))] = 0.0
+    return alms
+
+
+def relative(a, b):
+    return np.max(np.abs(a - b)) / np.max(np.abs(b))
+
+
+@needs_ducc0
+@pytest.mark.parametrize("pol", [False, True])
+def test_ducc0_synthesis_matches_healpy(monkeypatch, pol):
+    # Ring geometry and, with pol, spin 2 E/B to Q/U conventions
+    nside, lmax = 32, 64
+    alms = random_alms(lmax, 3 if pol else 1)
+    healpy = hp.alm2map(list(alms) if pol else alms[0], nside, lmax=lmax, pol=pol)
+    monkeypatch.setenv("C3PP_SHT", "ducc0")
+    ducc0 = sht.alm2map(alms if pol else alms[0], nside, lmax=lmax, pol=pol)
+    assert relative(ducc0, healpy) < 1e-10
+
+
+@needs_ducc0
+@pytest.mark.parametrize("pol", [False, True])
+def test_ducc0_round_trip_matches_healpy(monkeypatch, pol):
+    # Band-limited maps back to alms, with healpy's Jacobi iterations
+    nside, lmax = 32, 64
+    alms = random_alms(lmax, 3 if pol else 1)
+    maps = hp.alm2map(list(alms) if pol else alms[0], nside, lmax=lmax, pol=pol)
+    healpy = hp.map2alm(maps, lmax=lmax, iter=3, pol=pol)
+    monkeypatch.setenv("C3PP_SHT", "ducc0")
+    ducc0 = sht.map2alm(maps, lmax=lmax, iter=3, pol=pol)
+    assert relative(ducc0, healpy) < 1e-8
+    assert relative(ducc0, alms if pol else alms[0]) < 1e-4
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("pol", [False, True])
+def test_alm2maps_matches_healpy(monkeypatch, backend, pol):
+    nside, lmax, fwhm = 16, 47, 120.0
+    alms = np.array([random_alms(lmax, 3 if pol else 1, seed) for seed in range(3)])
+    monkeypatch.setenv("C3PP_SHT", backend)
+    maps = sht.alm2maps(alms if pol else alms[:, 0], nside, lmax, fwhm, pixwin=False, pol=pol)
+    assert maps.shape == ((3, 3, 12 * nside ** 2) if pol else (3, 12 * nside ** 2))
+    for alm, m in zip(alms, maps):
+        healpy = hp.alm2map(list(alm) if pol else alm[0], nside, lmax=lmax, fwhm=np.radians(fwhm / 60.0), pol=pol)
+        assert relative(m, healpy) < 1e-10
+
+
+@pytest.mark.parametrize("fwhm, nside", [(60.0, 32), (180.0, 16)])
+@pytest.mark.parametrize("pol", [False, True])
+def test_smoothing_to_nside_matches_ud_grade(fwhm, nside, pol):
+    # As the release diff maps were made before: hp.smoothing, then
+    # hp.ud_grade, to 1e-10 of the peak outside the mask
+    rng = np.random.default_rng(1)
+    maps = rng.normal(size=(3, 12 * 64 ** 2) if pol else 12 * 64 ** 2)
+    maps[..., :500] = hp.UNSEEN
+    healpy = hp.ud_grade(hp.smoothing(maps, fwhm=np.radians(fwhm / 60.0), pol=pol), nside)
+    smoothed = sht.smoothing(maps, fwhm, pol=pol, nside=nside)
+    bad = healpy == hp.UNSEEN
+    assert bad.any() and np.array_equal(smoothed == hp.UNSEEN, bad)
+    assert relative(smoothed[~bad], healpy[~bad]) < 1e-10
+
+
+def test_pool_worker_splits_cores(monkeypatch):
+    import os
+    import numba
+    from src import tools
+
+    monkeypatch.setattr(os, "cpu_count", lambda: 8)
+    monkeypatch.setattr(os, "environ", {})
+    monkeypatch.setattr(tools, "kernel_threads", 0)
+    tools.pool_worker(4)
+    assert sht.threads() == 2
+    assert sht.threads(3) == 3
+    assert tools.kernel_threads == min(2, numba.config.NUMBA_NUM_THREADS)
+
+
+def test_default_backend_is_healpy(monkeypatch):
+    monkeypatch.delenv("C3PP_SHT", raising=False)
+    assert sht.backend() == "healpy"
@@ -0,0 +1,84 @@
+import os
+import numpy as np
+import healpy as hp
+
+from src.tools import reference_map
+
+
+def write_maps(tmp_path, nside=32):
+    rng = np.random.default_rng(2)
+    maps = rng.normal(size=(3, 12 * nside ** 2))
+    filename = str(tmp_path / "maps.fits")
+    hp.write_map(filename, maps, dtype=np.float64)
+    return filename, maps
+
+
+def test_reference_map_caches_only_smoothed_maps_on_request(tmp_path, monkeypatch):
+    monkeypatch.delenv("C3PP_CACHE", raising=False)
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    filename, maps = write_maps(tmp_path)
+    cache = tmp_path / "cache"
+
+    assert np.array_equal(reference_map(filename, field=0, cache=str(cache)), maps[0])
+    assert not cache.exists()
+    reference_map(filename, 60.0, nside=16, monopole=True)
+    assert not (tmp_path / "home").exists()
+
+    # As release_diff did before: hp.smoothing, ud_grade, monopoles removed
+    healpy = hp.ud_grade(hp.smoothing(maps, fwhm=np.radians(1.0)), 16)
+    healpy -= np.mean(healpy, axis=1).reshape(-1, 1)
+    smoothed = reference_map(filename, 60.0, nside=16, monopole=True, cache=str(cache))
+    assert len(list(cache.glob("*.npy"))) == 1
+    assert np.max(np.abs(smoothed - healpy)) < 1e-10 * np.max(np.abs(healpy))
+    assert np.array_equal(reference_map(filename, 60.0, nside=16, monopole=True, cache=str(cache)), smoothed)
+
+
+def test_alm_mean_without_alm2map_keeps_alms(tmp_path):
+    import h5py
+    from src.tools import h5reduce, unpack_alms
+
+    rng = np.random.default_rng(3)
+    lmax, filename = 8, str(tmp_path / "chain_c0001.h5")
+    alms = rng.normal(size=(3, 3, (lmax + 1) ** 2))
+    with h5py.File(filename, "w") as f:
+        for s, alm in enumerate(alms):
+            f[f"{s:06d}/cmb/amp_alm"] = alm
+            f[f"{s:06d}/cmb/amp_lmax"] = lmax
+        f.create_group("parameters")
+
+    mean, = h5reduce(filename, [("cmb/amp_alm", np.mean, 0.0, 4)], 0, None, 1, alm2map=False)
+    assert mean.shape == (3, hp.Alm.getsize(lmax))
+    assert np.allclose(mean, np.mean([unpack_alms(alm, lmax) for alm in alms], axis=0))
+
+
+def test_degrade_ignores_unseen_and_nan_pixels():
+    from src.tools import degrade
+
+    rng = np.random.default_rng(5)
+    maps = rng.normal(size=(3, 12 * 16 ** 2))
+    maps[:, :3] = hp.UNSEEN
+    maps[:, 3] = np.nan
+    maps[:, 4:8] = np.nan
+    for nest in (False, True):
+        healpy = hp.ud_grade(np.where(np.isnan(maps), hp.UNSEEN, maps), 8, order_in="NEST" if nest else "RING")
+        degraded = degrade(maps, 8, nest=nest)
+        assert np.isfinite(degraded).all()
+        assert np.array_equal(degraded == hp.UNSEEN, healpy == hp.UNSEEN)
+        assert np.allclose(degraded, healpy, rtol=0.0, atol=1e-12)
+
+
+def test_pooled_fits_reads_leave_no_shared_memory_on_errors(tmp_path):
+    import pytest
+    from src.tools import fits_partial, process_pool
+
+    rng = np.random.default_rng(6)
+    for sample in range(1, 7):
+        hp.write_map(str(tmp_path / f"res_k{sample:06d}.fits"), rng.normal(size=(3, 12 * 8 ** 2)), dtype=np.float64)
+    # Fails in a worker, with the samples after it read ahead
+    (tmp_path / "res_k000004.fits").write_bytes(b"not a fits file")
+
+    before = set(os.listdir("/dev/shm"))
+    with process_pool(2) as executor, pytest.raises(Exception):
+        fits_partial((str(tmp_path / "res_"), ".fits"), list(range(1, 7)), (0, 1, 2), None, [0.0], True, False, None,
+                     False, (np.mean,), (16, 50, 84), progress=False, pool=executor, depth=4)
+    assert set(os.listdir("/dev/shm")) <= before